@@ -0,0 +1,437 @@
+'''
+Load test of the shop catalog, cart and auth routes against a seeded catalog.
+
+    python benchmarks/load_test.py --seed --products 50000 --output load.json
+    python benchmarks/load_test.py --requests 500 --concurrency 32 --baseline load.json
+    python benchmarks/load_test.py --base-url http://127.0.0.1:8000 --only products_ --skip photo
+
+Every endpoint runs in its own phase: --concurrency async clients, each logged in as
+another seeded user, send --requests requests in total. RPS and latency percentiles
+are per endpoint, DB time and statements per request come from the /metrics deltas
+of the phase. The app runs in process with its startup handlers (Redis is required),
+or use --base-url with a server started with a single worker, /metrics is per process.
+
+Write endpoints work on rows the run creates, named after the run, which are removed
+at the end; users created by auth_register stay. Seeding TRUNCATEs every shop and user table, only point it at a throwaway database.
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import httpx  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+from sqlalchemy.ext.asyncio import create_async_engine  # noqa: E402
+
+from database import DATABASE_URL  # noqa: E402
+from pagination import encode_cursor  # noqa: E402
+
+import seed as seeding  # noqa: E402
+
+
+AUTH_COOKIE = 'fastapiusersauth'
+METRIC_LINE = re.compile(r'^(\w+)\{method="(\w+)",route="([^"]*)"(?:,status="\d+")?\} (\S+)$')
+PIXEL_PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d4944415478da63f8ffff3f0005fe02fea7d6a4ef0000000049454e44ae426082')
+
+
+@dataclass
+class Endpoint:
+    name: str
+    method: str
+    # Route template as labelled in /metrics
+    route: str
+    # (context, request number) -> keyword arguments of httpx request, path included as 'url'
+    request: Callable[['Context', int], dict]
+    auth: bool = False
+    # Called with the context and the responses of the phase, e.g. to remember created ids
+    collect: Optional[Callable[['Context', List[httpx.Response]], None]] = None
+
+
+@dataclass
+class Context:
+    tag: str
+    random: random.Random
+    product_ids: List[int]
+    category_ids: List[int]
+    warehouse_ids: List[int]
+    stock_ids: List[int]
+    created: Dict[str, list] = field(default_factory=lambda: defaultdict(list))
+
+    def product(self) -> int:
+        return self.random.choice(self.product_ids)
+
+    def created_item(self, kind: str, number: int, default=0):
+        # default stands in when the create phase made nothing, the request then just fails
+        items = self.created[kind]
+        return items[number % len(items)] if items else default
+
+
+def product_payload(ctx: Context, number: int) -> dict:
+    return {
+        'name': f'{ctx.tag} product {number}',
+        'articul': f'{ctx.tag}-{number:06d}',
+        'description': f'Load test product {number}',
+        'price': round(ctx.random.uniform(1, 10000), 2),
+        'category_id': ctx.random.choice(ctx.category_ids),
+    }
+
+
+def collect_ids(kind: str):
+    def collect(ctx: Context, responses: List[httpx.Response]):
+        for response in responses:
+            if response.status_code == 200:
+                ctx.created[kind].extend(response.json()['result']['ids'])
+    return collect
+
+
+def collect_stocks(ctx: Context, responses: List[httpx.Response]):
+    for response in responses:
+        if response.status_code == 200:
+            ctx.created['stocks'].append(response.json()['result'])
+
+
+def stock_pair(ctx: Context, number: int) -> dict:
+    # Every created product gets a stock row in every created warehouse at most once
+    products, warehouses = ctx.created['products'], ctx.created['warehouses']
+    if not products or not warehouses:
+        return {'warehouse_id': 0, 'product_id': 0}
+    return {'warehouse_id': warehouses[number % len(warehouses)],
+            'product_id': products[number // len(warehouses) % len(products)]}
+
+
+def import_file(ctx: Context, number: int) -> dict:
+    lines = ['warehouse_id,product_id,quantity'] + [
+        f"{stock['warehouse_id']},{stock['product_id']},{ctx.random.randint(0, 100)}"
+        for stock in ctx.created['stocks'][number % 10::10][:50]]
+    return {'url': '/shop/stocks/import', 'files': {'file': ('stocks.csv', '\n'.join(lines).encode(), 'text/csv')}}
+
+
+def endpoints() -> List[Endpoint]:
+    shop = '/shop'
+    return [
+        # Catalog reads
+        Endpoint('category_list', 'GET', f'{shop}/category/list',
+                 lambda ctx, n: {'url': f'{shop}/category/list'}),
+        Endpoint('products_list', 'GET', f'{shop}/products/list',
+                 lambda ctx, n: {'url': f'{shop}/products/list',
+                                 'params': {'cursor': encode_cursor([ctx.product()])}}),
+        Endpoint('products_list_sparse', 'GET', f'{shop}/products/list',
+                 lambda ctx, n: {'url': f'{shop}/products/list', 'params': {
+                     'cursor': encode_cursor([ctx.product()]), 'fields': 'id,name,price'}}),
+        Endpoint('products_search', 'GET', f'{shop}/products/search',
+                 lambda ctx, n: {'url': f'{shop}/products/search', 'params': {'q': f'product {ctx.product()}'}}),
+        Endpoint('products_filter', 'GET', f'{shop}/products/filter',
+                 lambda ctx, n: {'url': f'{shop}/products/filter', 'params': {
+                     'category_id': ctx.random.choice(ctx.category_ids),
+                     'price_max': ctx.random.choice((100, 1000, 5000))}}),
+        Endpoint('product_detail', 'GET', f'{shop}/products/{{product_id}}',
+                 lambda ctx, n: {'url': f'{shop}/products/{ctx.product()}'}),
+        Endpoint('products_in_category', 'GET', f'{shop}/products/list_in_category/{{category_id}}',
+                 lambda ctx, n: {'url': f'{shop}/products/list_in_category/{ctx.random.choice(ctx.category_ids)}'}),
+        Endpoint('product_reviews', 'GET', f'{shop}/products/{{product_id}}/reviews',
+                 lambda ctx, n: {'url': f'{shop}/products/{ctx.product()}/reviews'}),
+        Endpoint('stocks_list', 'GET', f'{shop}/stocks/list',
+                 lambda ctx, n: {'url': f'{shop}/stocks/list',
+                                 'params': {'cursor': encode_cursor([ctx.random.choice(ctx.stock_ids)])}}),
+        Endpoint('warehouses_list', 'GET', f'{shop}/warehouses/list',
+                 lambda ctx, n: {'url': f'{shop}/warehouses/list'}),
+
+        # Catalog writes, on rows created by the run
+        Endpoint('category_create', 'POST', f'{shop}/category/create',
+                 lambda ctx, n: {'url': f'{shop}/category/create', 'data': {'new_category': json.dumps({
+                     'name': f'{ctx.tag} category {n}', 'discount': 0, 'is_active': True,
+                     'parent_id': ctx.random.choice(ctx.category_ids)})}}),
+        Endpoint('category_update', 'PATCH', f'{shop}/category/update/{{id}}',
+                 lambda ctx, n: {'url': f"{shop}/category/update/{ctx.created_item('categories', n)}",
+                                 'json': {'discount': n % 50}}),
+        Endpoint('products_batch_create', 'POST', f'{shop}/products/batch_create',
+                 lambda ctx, n: {'url': f'{shop}/products/batch_create',
+                                 'json': [product_payload(ctx, n * 10 + item) for item in range(10)]},
+                 collect=collect_ids('products')),
+        Endpoint('products_batch_update', 'PATCH', f'{shop}/products/batch_update',
+                 lambda ctx, n: {'url': f'{shop}/products/batch_update', 'json': [
+                     {'id': ctx.created_item('products', n * 10 + item), 'price': round(ctx.random.uniform(1, 10000), 2)}
+                     for item in range(10)]}),
+        Endpoint('product_update', 'PATCH', f'{shop}/products/update/{{id}}',
+                 lambda ctx, n: {'url': f"{shop}/products/update/{ctx.created_item('products', n)}",
+                                 'data': {'updated_data': json.dumps(product_payload(ctx, 2 * 10 ** 6 + n))},
+                                 'files': [('new_photos', ('photo.png', PIXEL_PNG, 'image/png'))]}),
+        Endpoint('product_create', 'POST', f'{shop}/products/create',
+                 lambda ctx, n: {'url': f'{shop}/products/create',
+                                 'data': {'new_product': json.dumps(product_payload(ctx, 10 ** 6 + n))},
+                                 'files': [('photos', ('photo.png', PIXEL_PNG, 'image/png'))]}),
+        Endpoint('product_photos', 'POST', f'{shop}/products/{{product_id}}/photos',
+                 lambda ctx, n: {'url': f"{shop}/products/{ctx.created_item('products', n)}/photos",
+                                 'files': [('photos', ('photo.png', PIXEL_PNG, 'image/png'))]}),
+        Endpoint('warehouse_create', 'POST', f'{shop}/warehouses/create',
+                 lambda ctx, n: {'url': f'{shop}/warehouses/create', 'json': {'name': f'{ctx.tag} warehouse {n}'}}),
+        Endpoint('warehouse_update', 'PATCH', f'{shop}/warehouses/update/{{id}}',
+                 lambda ctx, n: {'url': f"{shop}/warehouses/update/{ctx.created_item('warehouses', n)}",
+                                 'json': {'id': ctx.created_item('warehouses', n), 'name': f'{ctx.tag} warehouse {n}'}}),
+        Endpoint('stock_create', 'POST', f'{shop}/stocks/create',
+                 lambda ctx, n: {'url': f'{shop}/stocks/create', 'json': {**stock_pair(ctx, n), 'quantity': 10}},
+                 collect=collect_stocks),
+        Endpoint('stock_update', 'PATCH', f'{shop}/stocks/update/{{id}}',
+                 lambda ctx, n: {'url': f"{shop}/stocks/update/{ctx.created_item('stocks', n, {'id': 0})['id']}",
+                                 'json': {**ctx.created_item('stocks', n, {'id': 0}), 'quantity': ctx.random.randint(0, 100)}}),
+        Endpoint('stocks_import', 'POST', f'{shop}/stocks/import', import_file),
+        Endpoint('stock_delete', 'DELETE', f'{shop}/stocks/delete/{{id}}',
+                 lambda ctx, n: {'url': f"{shop}/stocks/delete/{ctx.created_item('stocks', n, {'id': 0})['id']}"}),
+        Endpoint('product_delete', 'DELETE', f'{shop}/products/delete/{{id}}',
+                 lambda ctx, n: {'url': f"{shop}/products/delete/{ctx.created_item('products', n)}"}),
+        Endpoint('warehouse_delete', 'DELETE', f'{shop}/warehouses/delete/{{id}}',
+                 lambda ctx, n: {'url': f"{shop}/warehouses/delete/{ctx.created_item('warehouses', n)}"}),
+        Endpoint('category_delete', 'DELETE', f'{shop}/category/delete/{{id}}',
+                 lambda ctx, n: {'url': f"{shop}/category/delete/{ctx.created_item('categories', n)}"}),
+
+        # Cart of the logged in user of every client
+        Endpoint('cart_add', 'POST', f'{shop}/cart/add',
+                 lambda ctx, n: {'url': f'{shop}/cart/add', 'json': {'product_id': ctx.product(), 'amount': 1}},
+                 auth=True),
+        Endpoint('cart_list', 'GET', f'{shop}/cart/list', lambda ctx, n: {'url': f'{shop}/cart/list'}, auth=True),
+        Endpoint('cart_summary', 'GET', f'{shop}/cart/summary',
+                 lambda ctx, n: {'url': f'{shop}/cart/summary'}, auth=True),
+        Endpoint('cart_update', 'PATCH', f'{shop}/cart/update',
+                 lambda ctx, n: {'url': f'{shop}/cart/update',
+                                 'json': {'product_id': ctx.product(), 'amount': ctx.random.randint(1, 3)}},
+                 auth=True),
+        Endpoint('cart_delete', 'DELETE', f'{shop}/cart/delete/{{product_id}}',
+                 lambda ctx, n: {'url': f'{shop}/cart/delete/{ctx.product()}'}, auth=True),
+        Endpoint('cart_clear', 'DELETE', f'{shop}/cart/clear', lambda ctx, n: {'url': f'{shop}/cart/clear'}, auth=True),
+
+        # Auth
+        Endpoint('auth_login', 'POST', '/auth/jwt/login',
+                 lambda ctx, n: {'url': '/auth/jwt/login', 'data': {
+                     'username': f'user{n % 100 + 1}@example.com', 'password': seeding.PASSWORD}}),
+        Endpoint('auth_register', 'POST', '/auth/register',
+                 lambda ctx, n: {'url': '/auth/register', 'json': {
+                     'email': f'{ctx.tag}-{n}@example.com', 'password': seeding.PASSWORD}}),
+        Endpoint('auth_logout', 'POST', '/auth/jwt/logout', lambda ctx, n: {'url': '/auth/jwt/logout'}, auth=True),
+    ]
+
+
+# Rows the write endpoints created without returning their ids
+CREATED_BY_NAME = {
+    'category_create': ('categories', 'SELECT id FROM category WHERE name LIKE :prefix ORDER BY id'),
+    'warehouse_create': ('warehouses', 'SELECT id FROM warehouse WHERE name LIKE :prefix ORDER BY id'),
+}
+
+
+async def sample_context(engine, tag: str, seed: int, sample_size: int = 5000) -> Context:
+    rng = random.Random(seed)
+
+    async with engine.connect() as connection:
+        async def ids(sql: str, sample: bool = False) -> List[int]:
+            # Sampled with the seeded generator, not ORDER BY random(), so a seed picks the same ids
+            rows = (await connection.execute(text(sql))).scalars().all()
+            return rng.sample(rows, sample_size) if sample and len(rows) > sample_size else rows
+        context = Context(
+            tag=tag,
+            random=rng,
+            product_ids=await ids('SELECT id FROM product WHERE is_active ORDER BY id', sample=True),
+            category_ids=await ids('SELECT id FROM category WHERE is_active ORDER BY id'),
+            warehouse_ids=await ids('SELECT id FROM warehouse ORDER BY id'),
+            stock_ids=await ids('SELECT id FROM stock ORDER BY id', sample=True),
+        )
+    if not (context.product_ids and context.category_ids and context.warehouse_ids and context.stock_ids):
+        sys.exit('Seed the database first (--seed or benchmarks/seed.py)')
+    return context
+
+
+async def remove_created(engine, tag: str):
+    '''
+    Rows of the run the delete endpoints did not get to, batch_create makes ten products
+    per request and failed phases leave theirs behind. Stock and photos cascade.
+    '''
+    async with engine.begin() as connection:
+        await connection.execute(text('DELETE FROM product WHERE articul LIKE :prefix'), {'prefix': f'{tag}-%'})
+        await connection.execute(text('DELETE FROM warehouse WHERE name LIKE :prefix'), {'prefix': f'{tag} %'})
+        await connection.execute(text('DELETE FROM category WHERE name LIKE :prefix'), {'prefix': f'{tag} %'})
+
+
+async def collect_by_name(engine, ctx: Context, endpoint: Endpoint):
+    kind, sql = CREATED_BY_NAME[endpoint.name]
+    async with engine.connect() as connection:
+        result = await connection.execute(text(sql), {'prefix': f'{ctx.tag} %'})
+        ctx.created[kind] = result.scalars().all()
+
+
+def parse_metrics(body: str) -> Dict[tuple, float]:
+    values = defaultdict(float)
+    for line in body.splitlines():
+        match = METRIC_LINE.match(line)
+        if match and match.group(1).endswith(('_sum', '_count')):
+            name, method, route, value = match.groups()
+            values[(name, method, route)] += float(value)
+    return values
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    return values[max(int(round(len(values) * fraction)) - 1, 0)]
+
+
+async def login(client: httpx.AsyncClient, number: int):
+    response = await client.post('/auth/jwt/login', data={
+        'username': f'user{number + 1}@example.com', 'password': seeding.PASSWORD})
+    response.raise_for_status()
+    # Set without the secure flag, so the cookie is also sent to a plain http --base-url
+    client.cookies.set(AUTH_COOKIE, response.cookies[AUTH_COOKIE])
+
+
+async def run_endpoint(endpoint: Endpoint, clients: List[httpx.AsyncClient], ctx: Context,
+                       requests: int) -> dict:
+    before = parse_metrics((await clients[0].get('/metrics')).text)
+    if endpoint.auth:
+        await asyncio.gather(*(login(client, number) for number, client in enumerate(clients)))
+    # Request arguments are built up front, so the phase measures the server only
+    pending = [endpoint.request(ctx, number) for number in range(requests)]
+    latencies, statuses, responses = [], Counter(), []
+
+    async def worker(client: httpx.AsyncClient):
+        while pending:
+            kwargs = pending.pop()
+            started = time.perf_counter()
+            try:
+                response = await client.request(endpoint.method, **kwargs)
+            except httpx.HTTPError as e:
+                statuses[type(e).__name__] += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] += 1
+            if endpoint.collect is not None:
+                responses.append(response)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(client) for client in clients))
+    elapsed = time.perf_counter() - started
+    after = parse_metrics((await clients[0].get('/metrics')).text)
+
+    if endpoint.collect is not None:
+        endpoint.collect(ctx, responses)
+
+    def delta(name: str) -> float:
+        key = (name, endpoint.method, endpoint.route)
+        return after.get(key, 0.0) - before.get(key, 0.0)
+
+    measured = delta('http_request_sql_statements_count')
+    latencies.sort()
+    return {
+        'requests': requests,
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'rps': round(requests / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        'db_ms_per_request': round(delta('http_request_sql_duration_seconds_sum') / measured * 1000, 3)
+        if measured else None,
+        'statements_per_request': round(delta('http_request_sql_statements_sum') / measured, 2)
+        if measured else None,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None or not current['p95_ms'] or not previous['p95_ms']:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance) and current['p95_ms'] - previous['p95_ms'] > 1:
+            regressions.append(f"{name}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+        if current['rps'] < previous['rps'] / (1 + tolerance):
+            regressions.append(f"{name}: {previous['rps']} -> {current['rps']} requests/s")
+        if (current['statements_per_request'] or 0) > (previous['statements_per_request'] or 0) + 0.5:
+            regressions.append(f"{name}: {previous['statements_per_request']} -> "
+                               f"{current['statements_per_request']} statements per request")
+    return regressions
+
+
+def selected(endpoint: Endpoint, args) -> bool:
+    if args.only and not any(pattern in endpoint.name for pattern in args.only):
+        return False
+    return not any(pattern in endpoint.name for pattern in args.skip or ())
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--seed', action='store_true',
+                        help='truncate the database and seed a synthetic catalog first')
+    parser.add_argument('--base-url', help='server to test instead of the app in process')
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=16, help='clients sending requests at once')
+    parser.add_argument('--only', action='append', help='run endpoints whose name contains this, repeatable')
+    parser.add_argument('--skip', action='append', help='skip endpoints whose name contains this, repeatable')
+    parser.add_argument('--random-seed', type=int, default=0, help='makes the requested ids reproducible')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON output of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed relative slowdown against the baseline')
+    seeding.add_size_arguments(parser)
+    args = parser.parse_args()
+
+    engine = create_async_engine(DATABASE_URL)
+    if args.seed:
+        await seeding.seed(engine, seeding.size_from_args(args))
+    ctx = await sample_context(engine, f'bench-{int(time.time())}', args.random_seed)
+
+    app = None
+    if args.base_url:
+        make_client = lambda: httpx.AsyncClient(base_url=args.base_url, timeout=60)  # noqa: E731
+    else:
+        from main import app
+        await app.router.startup()
+        make_client = lambda: httpx.AsyncClient(  # noqa: E731
+            # Errors of the app come back as 500 responses, as from a server
+            transport=httpx.ASGITransport(app=app, raise_app_exceptions=False), base_url='https://bench', timeout=60)
+
+    clients = [make_client() for _ in range(args.concurrency)]
+    results = {}
+    try:
+        for endpoint in endpoints():
+            if not selected(endpoint, args):
+                continue
+            results[endpoint.name] = result = await run_endpoint(endpoint, clients, ctx, args.requests)
+            if endpoint.name in CREATED_BY_NAME:
+                await collect_by_name(engine, ctx, endpoint)
+            db = f"{result['db_ms_per_request']}ms db, {result['statements_per_request']} statements" \
+                if result['db_ms_per_request'] is not None else 'no db metrics'
+            print(f"{endpoint.name:>24}: {result['rps']:8.1f} req/s  p50 {result['p50_ms']}ms  "
+                  f"p95 {result['p95_ms']}ms  p99 {result['p99_ms']}ms  {db}  {result['statuses']}")
+    finally:
+        for client in clients:
+            await client.aclose()
+        if app is not None:
+            await app.router.shutdown()
+        await remove_created(engine, ctx.tag)
+        await engine.dispose()
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({
+                'config': {key: getattr(args, key) for key in ('base_url', 'requests', 'concurrency', 'random_seed')},
+                'endpoints': results,
+            }, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)['endpoints'], args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
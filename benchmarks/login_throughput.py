@@ -0,0 +1,119 @@
+'''
+Login throughput against event-loop lag, with bcrypt in the hashing thread pool or on the loop.
+
+    python benchmarks/login_throughput.py --logins 200 --concurrency 20
+    python benchmarks/login_throughput.py --mode blocking
+
+Logs the seeded users (benchmarks/seed.py) in through the app, in process, while a probe
+task measures how late the event loop wakes it up: the delay every other request of the
+worker would see. --mode blocking replays the stock fastapi-users manager, which hashes
+on the event loop, for comparison.
+'''
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import httpx  # noqa: E402
+from fastapi import Depends  # noqa: E402
+from fastapi_users import BaseUserManager, IntegerIDMixin  # noqa: E402
+from fastapi_users.password import PasswordHelper  # noqa: E402
+
+from auth.manager import get_user_manager  # noqa: E402
+from auth.models import User  # noqa: E402
+from auth.password import password_helper  # noqa: E402
+from auth.utils import get_user_db  # noqa: E402
+from main import app  # noqa: E402
+
+from seed import PASSWORD  # noqa: E402
+
+
+class BlockingUserManager(IntegerIDMixin, BaseUserManager[User, int]):
+    pass
+
+
+async def get_blocking_user_manager(user_db=Depends(get_user_db)):
+    yield BlockingUserManager(user_db, PasswordHelper(password_helper.context))
+
+
+def percentile(values: list, fraction: float) -> float:
+    return values[max(int(len(values) * fraction) - 1, 0)]
+
+
+async def probe_lag(interval: float, lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def run(args) -> dict:
+    if args.mode == 'blocking':
+        app.dependency_overrides[get_user_manager] = get_blocking_user_manager
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    outcomes = Counter()
+    latencies = []
+    lags = []
+    stop = asyncio.Event()
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='https://bench') as client:
+        async def login(number: int):
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post('/auth/jwt/login', data={
+                    'username': f'user{number % args.users + 1}@example.com', 'password': PASSWORD})
+                latencies.append(time.perf_counter() - started)
+                outcomes[response.status_code] += 1
+
+        # Warm up the connection pool outside of the measurement
+        await login(0)
+        latencies.clear()
+        outcomes.clear()
+
+        probe = asyncio.create_task(probe_lag(args.probe_interval / 1000, lags, stop))
+        started = time.perf_counter()
+        await asyncio.gather(*(login(number) for number in range(args.logins)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await probe
+
+    latencies.sort()
+    lags.sort()
+    return {
+        'per_second': args.logins / elapsed,
+        'outcomes': dict(outcomes),
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'lag_p50_ms': statistics.median(lags) * 1000,
+        'lag_p99_ms': percentile(lags, 0.99) * 1000,
+        'lag_max_ms': lags[-1] * 1000,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--mode', choices=('pool', 'blocking'), default='pool')
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20, help='logins in flight')
+    parser.add_argument('--users', type=int, default=100, help='distinct seeded users logging in')
+    parser.add_argument('--probe-interval', type=float, default=5, help='milliseconds between lag probes')
+    args = parser.parse_args()
+
+    result = await run(args)
+    print(f"{args.mode}: {args.logins} logins, {args.concurrency} in flight, "
+          f"bcrypt rounds {password_helper.rounds}, {password_helper.executor._max_workers} hashing threads")
+    print(f"  {result['per_second']:.1f} logins/s, p50 {result['p50_ms']:.0f}ms, p95 {result['p95_ms']:.0f}ms, "
+          f"responses {result['outcomes']}")
+    print(f"  event loop lag: p50 {result['lag_p50_ms']:.1f}ms, p99 {result['lag_p99_ms']:.1f}ms, "
+          f"max {result['lag_max_ms']:.1f}ms")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
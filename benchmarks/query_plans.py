@@ -0,0 +1,201 @@
+'''
+EXPLAIN ANALYZE timings of the router queries on a synthetic catalog.
+
+    python benchmarks/query_plans.py --seed --products 200000 --output plans.json
+    python benchmarks/query_plans.py --baseline plans.json
+
+Each query runs --repeat times, the median execution time and the scan nodes
+of the plan are recorded. With --baseline the run is compared to an earlier
+output file and queries that got slower than --tolerance, or started doing
+sequential scans, are reported and make the script exit with status 1.
+'''
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from sqlalchemy import func, literal_column, select, text, union  # noqa: E402
+from sqlalchemy.ext.asyncio import create_async_engine  # noqa: E402
+
+from config import SEARCH_CANDIDATE_LIMIT, SEARCH_SIMILARITY_THRESHOLD  # noqa: E402
+from database import DATABASE_URL  # noqa: E402
+from pagination import apply_keyset, encode_cursor  # noqa: E402
+from shop.models import *  # noqa: E402,F401,F403
+from shop.cart import models as cart_md  # noqa: E402
+from shop.products import models as md  # noqa: E402
+
+import seed as seeding  # noqa: E402
+
+
+async def sample_ids(connection) -> dict:
+    '''
+    Ids the queries are run with: a product from the middle of the catalog,
+    a root category, a user with a cart and a cursor deep into the lists.
+    '''
+    row = (await connection.execute(text(
+        'SELECT (SELECT percentile_disc(0.5) WITHIN GROUP (ORDER BY id) FROM product) AS product_id, '
+        '(SELECT min(id) FROM category WHERE parent_id IS NULL) AS category_id, '
+        '(SELECT min(user_id) FROM cart) AS user_id, '
+        '(SELECT percentile_disc(0.9) WITHIN GROUP (ORDER BY price) FROM product) AS price, '
+        '(SELECT percentile_disc(0.9) WITHIN GROUP (ORDER BY id) FROM stock) AS stock_id'
+    ))).mappings().one()
+    subtree = (await connection.execute(
+        select(md.CategoryClosure.descendant_id).where(
+            md.CategoryClosure.ancestor_id == row['category_id']))).scalars().all()
+    return {**row, 'subtree': subtree}
+
+
+def search_query(q: str, subtree=None):
+    # The router binds the configuration as a parameter, which literal_binds cannot render
+    ts_query = func.websearch_to_tsquery(literal_column("'simple'::regconfig"), q)
+    conditions = [md.Product.is_active == True]
+    if subtree is not None:
+        conditions.append(md.Product.category_id.in_(subtree))
+    text_rank = func.ts_rank_cd(md.Product.search_vector, ts_query)
+    text_matches = select(md.Product.id).where(
+        *conditions, md.Product.search_vector.bool_op('@@')(ts_query)).order_by(
+        text_rank.desc(), md.Product.id).limit(SEARCH_CANDIDATE_LIMIT)
+    articul_matches = select(md.Product.id).where(
+        *conditions, md.Product.articul.bool_op('%')(q)).order_by(
+        md.Product.articul.op('<->')(q), md.Product.id).limit(SEARCH_CANDIDATE_LIMIT)
+    candidates = union(text_matches, articul_matches).subquery()
+    rank = func.greatest(text_rank, func.similarity(md.Product.articul, q))
+    return select(md.Product).join(candidates, candidates.c.id == md.Product.id).order_by(
+        rank.desc(), md.Product.id).limit(25)
+
+
+def router_queries(ids: dict) -> dict:
+    product_id = ids['product_id']
+    active_products = select(md.Product).where(md.Product.is_active == True)
+    return {
+        'category_list': select(md.Category).where(md.Category.is_active == True),
+        'products_list': apply_keyset(active_products, (md.Product.id,), None, 25),
+        'products_list_deep': apply_keyset(
+            active_products, (md.Product.id,), encode_cursor([product_id]), 25),
+        'products_list_by_price_deep': apply_keyset(
+            active_products, (md.Product.price, md.Product.id),
+            encode_cursor([ids['price'], 0]), 25, parsers=(Decimal, int)),
+        'products_list_in_stock': apply_keyset(
+            active_products.where(md.Product.in_stock == True), (md.Product.id,), None, 25),
+        'product_photos': select(md.ProductPhoto).where(
+            md.ProductPhoto.product_id.in_(range(product_id, product_id + 25))),
+        'product_by_id': select(md.Product).where(md.Product.id == product_id),
+        'product_stocks': select(md.Stock).where(md.Stock.product_id == product_id),
+        'product_reviews': apply_keyset(
+            select(md.Review).where(md.Review.product_id == product_id),
+            (md.Review.created_at, md.Review.id), None, 10, descending=True),
+        'product_rating': select(md.ProductRating).where(
+            md.ProductRating.product_id == product_id),
+        'list_in_category': active_products.where(
+            md.Product.category_id.in_(ids['subtree'])).order_by(md.Product.category_id),
+        'search_name': search_query(f'product {product_id}'),
+        'search_articul_typo': search_query(f'ART-{product_id:08d}'.replace('0', 'O', 1)),
+        'search_common_word': search_query('product'),
+        'search_in_category': search_query('product', ids['subtree']),
+        'category_subtree': select(md.CategoryClosure.descendant_id).where(
+            md.CategoryClosure.ancestor_id == ids['category_id']),
+        'category_children': select(md.Category).where(
+            md.Category.parent_id == ids['category_id']),
+        'stocks_list_deep': apply_keyset(
+            select(md.Stock), (md.Stock.id,), encode_cursor([ids['stock_id']]), 25),
+        'warehouse_stocks': select(md.Stock).where(md.Stock.warehouse_id == 1),
+        'cart_by_user': select(cart_md.Cart).where(cart_md.Cart.user_id == ids['user_id']),
+    }
+
+
+def scan_nodes(plan: dict) -> list:
+    nodes = []
+    if 'Scan' in plan['Node Type']:
+        node = plan['Node Type']
+        if 'Relation Name' in plan:
+            node += f" on {plan['Relation Name']}"
+        if 'Index Name' in plan:
+            node += f" using {plan['Index Name']}"
+        nodes.append(node)
+    for child in plan.get('Plans', []):
+        nodes.extend(scan_nodes(child))
+    return nodes
+
+
+async def explain(connection, query, repeat: int) -> dict:
+    sql = str(query.compile(
+        dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+    timings = []
+    for _ in range(repeat):
+        result = await connection.execute(text(f'EXPLAIN (ANALYZE, FORMAT JSON) {sql}'))
+        plan = result.scalar()
+        plan = plan[0] if isinstance(plan, list) else json.loads(plan)[0]
+        timings.append(plan['Execution Time'])
+    return {
+        'execution_ms': round(statistics.median(timings), 3),
+        'planning_ms': round(plan['Planning Time'], 3),
+        'rows': plan['Plan']['Actual Rows'],
+        'scans': scan_nodes(plan['Plan']),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        limit = previous['execution_ms'] * (1 + tolerance)
+        if current['execution_ms'] > limit and current['execution_ms'] - previous['execution_ms'] > 0.5:
+            regressions.append(
+                f"{name}: {previous['execution_ms']}ms -> {current['execution_ms']}ms")
+        new_seq_scans = {scan for scan in current['scans'] if scan.startswith('Seq Scan')} \
+            - set(previous['scans'])
+        if new_seq_scans:
+            regressions.append(f"{name}: new {', '.join(sorted(new_seq_scans))}")
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--seed', action='store_true',
+                        help='truncate the database and seed a synthetic catalog first')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON output of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed relative slowdown against the baseline')
+    seeding.add_size_arguments(parser)
+    args = parser.parse_args()
+
+    engine = create_async_engine(DATABASE_URL)
+    if args.seed:
+        await seeding.seed(engine, seeding.size_from_args(args))
+
+    results = {}
+    async with engine.connect() as connection:
+        await connection.execute(select(func.set_config(
+            'pg_trgm.similarity_threshold', str(SEARCH_SIMILARITY_THRESHOLD), False)))
+        ids = await sample_ids(connection)
+        for name, query in router_queries(ids).items():
+            results[name] = await explain(connection, query, args.repeat)
+            scans = '; '.join(results[name]['scans'])
+            print(f"{name:>28}: {results[name]['execution_ms']:9.3f}ms  {scans}")
+    await engine.dispose()
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
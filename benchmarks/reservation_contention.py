@@ -0,0 +1,187 @@
+'''
+Concurrent checkouts of one hot product against the stock reservation engine.
+
+    python benchmarks/reservation_contention.py --concurrency 300 --checkouts 3000 --warehouses 4
+    python benchmarks/reservation_contention.py --mode naive
+
+Every checkout reserves --amount units of the same product, spread over --warehouses
+stock rows. The script reports throughput, latency percentiles and outcomes, then
+checks that stock was neither oversold nor lost and that the product stock summary,
+folded from the changes the checkouts appended, matches the stock rows. --mode naive replays the old
+read-then-overwrite update_stock pattern for comparison.
+
+The product's stock rows are replaced, only point it at a throwaway database.
+'''
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from sqlalchemy import select, text  # noqa: E402
+from sqlalchemy.exc import SQLAlchemyError  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from database import DATABASE_URL  # noqa: E402
+from shop.models import *  # noqa: E402,F401,F403
+from shop.checkout import service  # noqa: E402
+from shop.products.stock_summary import fold_stock_changes  # noqa: E402
+from shop.products import models as md  # noqa: E402
+
+
+async def prepare(engine, warehouses: int, quantity: int) -> dict:
+    async with engine.begin() as connection:
+        product_id = (await connection.execute(text('SELECT min(id) FROM product'))).scalar()
+        warehouse_ids = (await connection.execute(text(
+            'SELECT id FROM warehouse ORDER BY id LIMIT :warehouses'), {'warehouses': warehouses})).scalars().all()
+        user_ids = (await connection.execute(text('SELECT id FROM "user" ORDER BY id LIMIT 1000'))).scalars().all()
+        if len(warehouse_ids) < warehouses or not user_ids:
+            sys.exit('Seed the database first (benchmarks/seed.py)')
+
+        await connection.execute(text(
+            "UPDATE reservation SET status = 'released' WHERE id IN "
+            "(SELECT reservation_id FROM reservation_item WHERE product_id = :product_id)"),
+            {'product_id': product_id})
+        await connection.execute(text('DELETE FROM stock WHERE product_id = :product_id'),
+                                 {'product_id': product_id})
+        await connection.execute(
+            text('INSERT INTO stock (warehouse_id, product_id, quantity) VALUES (:warehouse_id, :product_id, :quantity)'),
+            [{'warehouse_id': warehouse_id, 'product_id': product_id, 'quantity': quantity}
+             for warehouse_id in warehouse_ids])
+    return {'product_id': product_id, 'user_ids': user_ids, 'total': quantity * warehouses}
+
+
+async def naive_checkout(user_id: int, product_id: int, amount: int, session: AsyncSession):
+    '''
+    The read-then-overwrite pattern of update_stock, without any reservation.
+    '''
+    async with session.begin():
+        stock = await session.scalar(select(md.Stock).where(
+            md.Stock.product_id == product_id, md.Stock.quantity >= amount).order_by(md.Stock.id).limit(1))
+        if stock is None:
+            raise service.OutOfStock(product_id, amount, 0)
+        quantity = stock.quantity
+        await asyncio.sleep(0)
+        stock.quantity = quantity - amount
+
+
+async def run(args, engine, setup: dict) -> dict:
+    session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    outcomes = Counter()
+    latencies = []
+
+    async def checkout(number: int):
+        user_id = setup['user_ids'][number % len(setup['user_ids'])]
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                async with session_maker() as session:
+                    if args.mode == 'naive':
+                        await naive_checkout(user_id, setup['product_id'], args.amount, session)
+                    else:
+                        await service.reserve(user_id, {setup['product_id']: args.amount}, session)
+                outcomes['reserved'] += 1
+            except service.OutOfStock:
+                outcomes['out_of_stock'] += 1
+            except SQLAlchemyError as e:
+                outcomes['lock_timeout' if service.is_lock_timeout(e) else 'error'] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(checkout(number) for number in range(args.checkouts)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'elapsed': elapsed,
+        'outcomes': outcomes,
+        'per_second': args.checkouts / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+async def fold(engine) -> dict:
+    '''
+    Fold the stock changes the checkouts appended, as the stock summary folder would.
+    '''
+    session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    folded = 0
+    started = time.perf_counter()
+    while True:
+        async with session_maker() as session:
+            count, _ = await fold_stock_changes(session)
+        if not count:
+            break
+        folded += count
+    return {'changes': folded, 'ms': (time.perf_counter() - started) * 1000}
+
+
+async def verify(engine, args, setup: dict, outcomes: Counter) -> dict:
+    async with engine.connect() as connection:
+        row = (await connection.execute(text(
+            'SELECT sum(quantity) AS remaining, min(quantity) AS lowest FROM stock WHERE product_id = :product_id'),
+            {'product_id': setup['product_id']})).one()
+        reserved = (await connection.execute(text(
+            "SELECT coalesce(sum(i.quantity), 0) FROM reservation_item i "
+            "JOIN reservation r ON r.id = i.reservation_id "
+            "WHERE i.product_id = :product_id AND r.status = 'active'"),
+            {'product_id': setup['product_id']})).scalar()
+        summary = (await connection.execute(text(
+            'SELECT stock_quantity FROM product WHERE id = :product_id'),
+            {'product_id': setup['product_id']})).scalar()
+    sold = outcomes['reserved'] * args.amount
+    return {
+        'remaining': row.remaining,
+        'reserved': reserved,
+        'sold': sold,
+        # Units handed out beyond the initial stock
+        'oversold': max(sold - setup['total'], 0) + max(-row.lowest, 0),
+        'consistent': row.remaining + sold == setup['total'],
+        'summary': summary,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--mode', choices=('reserve', 'naive'), default='reserve')
+    parser.add_argument('--concurrency', type=int, default=300, help='checkouts in flight')
+    parser.add_argument('--checkouts', type=int, default=3000)
+    parser.add_argument('--connections', type=int, default=40, help='database pool size')
+    parser.add_argument('--warehouses', type=int, default=4, help='stock rows of the hot product')
+    parser.add_argument('--quantity', type=int, default=500, help='units per stock row')
+    parser.add_argument('--amount', type=int, default=1, help='units per checkout')
+    args = parser.parse_args()
+
+    engine = create_async_engine(
+        DATABASE_URL, pool_size=args.connections, max_overflow=0, pool_timeout=300)
+    setup = await prepare(engine, args.warehouses, args.quantity)
+    result = await run(args, engine, setup)
+    folded = await fold(engine)
+    check = await verify(engine, args, setup, result['outcomes'])
+    await engine.dispose()
+
+    print(f"{args.mode}: {args.checkouts} checkouts of product {setup['product_id']}, "
+          f"{args.concurrency} in flight, {args.connections} connections, "
+          f"{args.warehouses} x {args.quantity} units")
+    print(f"  {result['per_second']:.0f} checkouts/s, p50 {result['p50_ms']:.1f}ms, "
+          f"p95 {result['p95_ms']:.1f}ms, p99 {result['p99_ms']:.1f}ms")
+    print(f"  outcomes: {dict(result['outcomes'])}")
+    print(f"  stock: {setup['total']} initial, {check['sold']} handed out, {check['remaining']} remaining, "
+          f"oversold {check['oversold']}, consistent {check['consistent']}")
+    print(f"  summary: {folded['changes']} stock changes folded in {folded['ms']:.1f}ms, "
+          f"stock_quantity {check['summary']}")
+    if args.mode == 'reserve' and (check['oversold'] or not check['consistent']
+                                   or check['summary'] != check['remaining']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
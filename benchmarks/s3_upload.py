@@ -0,0 +1,85 @@
+'''
+Product photo upload throughput against a local S3 stand-in.
+
+Start moto (`moto_server -p 5000`) or MinIO and point the app settings to it:
+
+    AWS_ENDPOINT_URL=http://127.0.0.1:5000 AWS_KEY_ID=test AWS_SECRET=test \
+        python benchmarks/s3_upload.py --photos 32 --size 2097152
+
+Compares the old path (read into a temp file, blocking upload_file, one photo
+after another) with the async pipeline from shop.products.utils and reports the
+event loop lag observed while each of them runs.
+'''
+import argparse
+import asyncio
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from fastapi import UploadFile  # noqa: E402
+
+from aws_config import s3_client  # noqa: E402
+from config import AWS_BUCKET  # noqa: E402
+from shop.products import utils as ut  # noqa: E402
+
+
+def make_photos(count: int, size: int):
+    payload = os.urandom(size)
+    return [UploadFile(file=io.BytesIO(payload), filename=f'photo_{i}.png') for i in range(count)]
+
+
+async def blocking_upload(photos):
+    for index, photo in enumerate(photos):
+        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+            temp_url = temp_file.name
+            temp_file.write(await photo.read())
+        try:
+            s3_client.upload_file(temp_url, AWS_BUCKET, f'static/product/bench_{index}.png')
+        finally:
+            os.remove(temp_url)
+
+
+async def measure(name, coroutine_factory, photos):
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker():
+        interval = 0.005
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append(time.perf_counter() - started - interval)
+
+    size = sum(len(photo.file.getvalue()) for photo in photos)
+    ticker_task = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await coroutine_factory(photos)
+    elapsed = time.perf_counter() - started
+    done.set()
+    await ticker_task
+
+    print(f'{name:>10}: {elapsed:7.3f}s  {len(photos) / elapsed:8.1f} photos/s  '
+          f'{size / elapsed / 2 ** 20:8.1f} MiB/s  max loop lag {max(lags or [0]) * 1000:7.1f}ms')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--photos', type=int, default=16)
+    parser.add_argument('--size', type=int, default=1024 * 1024)
+    args = parser.parse_args()
+
+    try:
+        s3_client.create_bucket(Bucket=AWS_BUCKET)
+    except s3_client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+    await measure('blocking', blocking_upload, make_photos(args.photos, args.size))
+    await measure('async', ut.upload_product_photos, make_photos(args.photos, args.size))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,133 @@
+'''
+Synthetic catalog for benchmarks: category tree, products, photos, warehouses,
+stocks, users, reviews and carts, generated inside Postgres with generate_series.
+
+Seeding TRUNCATEs every shop and user table, only point it at a throwaway database.
+'''
+import argparse
+import asyncio
+import os
+import sys
+from dataclasses import dataclass, fields
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from passlib.context import CryptContext  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine  # noqa: E402
+
+from database import DATABASE_URL  # noqa: E402
+
+
+# Every seeded user logs in with this password
+PASSWORD = 'benchmark'
+
+
+@dataclass
+class CatalogSize:
+    categories: int = 1000
+    category_fanout: int = 10
+    products: int = 200000
+    photos_per_product: int = 2
+    warehouses: int = 20
+    stocks_per_product: int = 3
+    users: int = 1000
+    reviews_per_product: int = 3
+    cart_items_per_user: int = 5
+
+
+def seed_statements(size: CatalogSize, password_hash: str):
+    yield (
+        'TRUNCATE cart, review, stock, product_photo, product, warehouse, '
+        'category_closure, category, "user" RESTART IDENTITY CASCADE'
+    ), {}
+    # Every category below the first category_fanout ones hangs under (id - 1) / fanout
+    yield (
+        'INSERT INTO category (id, name, discount, is_active, parent_id) '
+        'SELECT g, \'Category \' || g, (g % 4) * 5, true, '
+        'CASE WHEN g <= :fanout THEN NULL ELSE (g - 1) / :fanout END '
+        'FROM generate_series(1, :categories) g'
+    ), {'categories': size.categories, 'fanout': size.category_fanout}
+    yield (
+        "SELECT setval(pg_get_serial_sequence('category', 'id'), :categories)"
+    ), {'categories': size.categories}
+    yield (
+        'WITH RECURSIVE tree(ancestor_id, descendant_id, depth) AS ('
+        ' SELECT id, id, 0 FROM category'
+        ' UNION ALL'
+        ' SELECT tree.ancestor_id, category.id, tree.depth + 1'
+        ' FROM tree JOIN category ON category.parent_id = tree.descendant_id) '
+        'INSERT INTO category_closure (ancestor_id, descendant_id, depth) '
+        'SELECT ancestor_id, descendant_id, depth FROM tree'
+    ), {}
+    yield (
+        'INSERT INTO product (name, articul, description, is_active, price, category_id) '
+        'SELECT \'Product \' || g, \'ART-\' || lpad(g::text, 8, \'0\'), '
+        '\'Description of product \' || g || \' \' || md5(g::text), '
+        'random() < 0.9, round((random() * 10000)::numeric, 2), '
+        '1 + floor(random() * :categories)::int '
+        'FROM generate_series(1, :products) g'
+    ), {'products': size.products, 'categories': size.categories}
+    yield (
+        'INSERT INTO product_photo (product_id, photo_url) '
+        'SELECT p, \'https://cdn.example.com/static/product/\' || p || \'_\' || n || \'.png\' '
+        'FROM generate_series(1, :products) p, generate_series(1, :photos) n'
+    ), {'products': size.products, 'photos': size.photos_per_product}
+    yield (
+        'INSERT INTO warehouse (name) '
+        'SELECT \'Warehouse \' || g FROM generate_series(1, :warehouses) g'
+    ), {'warehouses': size.warehouses}
+    yield (
+        'INSERT INTO stock (warehouse_id, product_id, quantity) '
+        'SELECT (p + n) % :warehouses + 1, p, floor(random() * 100)::int '
+        'FROM generate_series(1, :products) p, generate_series(1, :stocks) n'
+    ), {'products': size.products, 'warehouses': size.warehouses,
+        'stocks': min(size.stocks_per_product, size.warehouses)}
+    yield (
+        'INSERT INTO "user" (email, hashed_password, registered_at, is_active, is_superuser, is_verified) '
+        'SELECT \'user\' || g || \'@example.com\', :password_hash, now(), true, false, true '
+        'FROM generate_series(1, :users) g'
+    ), {'users': size.users, 'password_hash': password_hash}
+    yield (
+        'INSERT INTO review (user_id, product_id, estimate, body, created_at) '
+        'SELECT 1 + floor(random() * :users)::int, p, '
+        '(ARRAY[\'ONE\', \'TWO\', \'THREE\', \'FOUR\', \'FIVE\'])[1 + floor(random() * 5)::int]::estimate, '
+        '\'Review \' || n || \' of product \' || p, now() - random() * interval \'365 days\' '
+        'FROM generate_series(1, :products) p, generate_series(1, :reviews) n'
+    ), {'products': size.products, 'users': size.users, 'reviews': size.reviews_per_product}
+    yield (
+        'INSERT INTO cart (product_id, user_id, amount) '
+        'SELECT 1 + floor(random() * :products)::int, u, 1 + floor(random() * 3)::int '
+        'FROM generate_series(1, :users) u, generate_series(1, :items) n'
+    ), {'products': size.products, 'users': size.users, 'items': size.cart_items_per_user}
+
+
+async def seed(engine: AsyncEngine, size: CatalogSize):
+    password_hash = CryptContext(schemes=['bcrypt']).hash(PASSWORD)
+    async with engine.begin() as connection:
+        for statement, params in seed_statements(size, password_hash):
+            await connection.execute(text(statement), params)
+        await connection.execute(text('ANALYZE'))
+
+
+def add_size_arguments(parser: argparse.ArgumentParser):
+    for field in fields(CatalogSize):
+        parser.add_argument(f'--{field.name.replace("_", "-")}', type=int, default=field.default)
+
+
+def size_from_args(args) -> CatalogSize:
+    return CatalogSize(**{field.name: getattr(args, field.name) for field in fields(CatalogSize)})
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    add_size_arguments(parser)
+    args = parser.parse_args()
+
+    engine = create_async_engine(DATABASE_URL)
+    await seed(engine, size_from_args(args))
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+'''
+Per-item serialization cost of a product list.
+
+    python benchmarks/serialization.py --products 10000
+
+"pydantic" is what FastAPI does for a route returning ORM objects with a
+response_model: from_orm validation of Response[List[ProductForList]],
+jsonable_encoder and stdlib json. "orjson" is ResponseData with the
+compiled ProductForList encoder.
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from decimal import Decimal
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+
+from responses import ResponseData  # noqa: E402
+from schemas import Response  # noqa: E402
+from shop.models import *  # noqa: E402,F401,F403
+from shop.products import models as md  # noqa: E402
+from shop.products import schemas as sc  # noqa: E402
+
+
+def make_products(count: int) -> List[md.Product]:
+    products = []
+    for index in range(1, count + 1):
+        product = md.Product(
+            id=index, name=f'Product {index}', articul=f'ART-{index:08d}',
+            description='Lorem ipsum dolor sit amet ' * 8, is_active=True,
+            price=Decimal(index % 10000) / 100, category_id=index % 50 + 1)
+        product.photos = [
+            md.ProductPhoto(id=index * 2 + offset, product_id=index,
+                            photo_url=f'https://cdn.example.com/static/product/{index}_{offset}.png')
+            for offset in range(2)
+        ]
+        products.append(product)
+    return products
+
+
+def pydantic_path(products) -> bytes:
+    model = Response[List[sc.ProductForList]](result=products, details='success')
+    return json.dumps(jsonable_encoder(model)).encode()
+
+
+def orjson_path(products) -> bytes:
+    return ResponseData(products, schema=sc.ProductForList).body
+
+
+def measure(name, serialize, products, repeat: int):
+    serialize(products)
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = serialize(products)
+        timings.append(time.perf_counter() - started)
+    best = min(timings)
+    print(f'{name:>9}: {best * 1000:8.1f}ms per list  '
+          f'{best / len(products) * 1e6:6.2f}us per item  {len(body) / 2 ** 20:5.2f} MiB')
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    products = make_products(args.products)
+    before = measure('pydantic', pydantic_path, products, args.repeat)
+    after = measure('orjson', orjson_path, products, args.repeat)
+    print(f'speedup: {before / after:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
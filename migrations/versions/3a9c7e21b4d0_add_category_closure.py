@@ -0,0 +1,45 @@
+"""Add category closure
+
+Revision ID: 3a9c7e21b4d0
+Revises: f1353005c8cf
+Create Date: 2026-10-18 11:03:47.518920
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a9c7e21b4d0'
+down_revision = 'f1353005c8cf'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('category_closure',
+    sa.Column('ancestor_id', sa.Integer(), nullable=False),
+    sa.Column('descendant_id', sa.Integer(), nullable=False),
+    sa.Column('depth', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['ancestor_id'], ['category.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['descendant_id'], ['category.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('ancestor_id', 'descendant_id')
+    )
+    op.create_index(op.f('ix_category_closure_descendant_id'), 'category_closure', ['descendant_id'], unique=False)
+
+    # Backfill the closure of the existing tree
+    op.execute("""
+        WITH RECURSIVE tree(ancestor_id, descendant_id, depth) AS (
+            SELECT id, id, 0 FROM category
+            UNION ALL
+            SELECT tree.ancestor_id, category.id, tree.depth + 1
+            FROM tree JOIN category ON category.parent_id = tree.descendant_id
+        )
+        INSERT INTO category_closure (ancestor_id, descendant_id, depth)
+        SELECT ancestor_id, descendant_id, depth FROM tree
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_category_closure_descendant_id'), table_name='category_closure')
+    op.drop_table('category_closure')
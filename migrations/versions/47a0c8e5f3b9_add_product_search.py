@@ -0,0 +1,30 @@
+"""Add product search
+
+Revision ID: 47a0c8e5f3b9
+Revises: 9e4f1c3b7d52
+Create Date: 2026-10-18 15:31:44.208614
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '47a0c8e5f3b9'
+down_revision = '9e4f1c3b7d52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.add_column('product', sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed("setweight(to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(articul, '')), 'A') || setweight(to_tsvector('simple', coalesce(description, '')), 'B')", persisted=True), nullable=True))
+    op.create_index('ix_product_search_vector', 'product', ['search_vector'], unique=False, postgresql_using='gin')
+    op.create_index('ix_product_articul_trgm', 'product', ['articul'], unique=False, postgresql_using='gin', postgresql_ops={'articul': 'gin_trgm_ops'})
+
+
+def downgrade() -> None:
+    op.drop_index('ix_product_articul_trgm', table_name='product', postgresql_using='gin', postgresql_ops={'articul': 'gin_trgm_ops'})
+    op.drop_index('ix_product_search_vector', table_name='product', postgresql_using='gin')
+    op.drop_column('product', 'search_vector')
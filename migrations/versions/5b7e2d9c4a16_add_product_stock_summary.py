@@ -0,0 +1,90 @@
+"""Add product stock summary
+
+Revision ID: 5b7e2d9c4a16
+Revises: c52e9d7a1f38
+Create Date: 2026-10-18 14:02:31.518243
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e2d9c4a16'
+down_revision = 'c52e9d7a1f38'
+branch_labels = None
+depends_on = None
+
+
+# Statement level, so bulk imports update every product once per statement.
+# Warehouses are counted while they hold a positive quantity.
+SUMMARY_FUNCTION = """
+CREATE FUNCTION product_stock_summary() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE product p
+        SET stock_quantity = p.stock_quantity - d.quantity,
+            stock_warehouses = p.stock_warehouses - d.warehouses
+        FROM (
+            SELECT product_id,
+                   coalesce(sum(quantity), 0)::integer AS quantity,
+                   count(*) FILTER (WHERE quantity > 0)::integer AS warehouses
+            FROM old_rows GROUP BY product_id
+        ) d
+        WHERE p.id = d.product_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE product p
+        SET stock_quantity = p.stock_quantity + d.quantity,
+            stock_warehouses = p.stock_warehouses + d.warehouses
+        FROM (
+            SELECT product_id,
+                   coalesce(sum(quantity), 0)::integer AS quantity,
+                   count(*) FILTER (WHERE quantity > 0)::integer AS warehouses
+            FROM new_rows GROUP BY product_id
+        ) d
+        WHERE p.id = d.product_id;
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+# Transition tables allow a single event per trigger
+TRIGGERS = {
+    'stock_summary_insert': 'AFTER INSERT ON stock REFERENCING NEW TABLE AS new_rows',
+    'stock_summary_update': 'AFTER UPDATE ON stock REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows',
+    'stock_summary_delete': 'AFTER DELETE ON stock REFERENCING OLD TABLE AS old_rows',
+}
+
+
+def upgrade() -> None:
+    op.add_column('product', sa.Column('stock_quantity', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('product', sa.Column('stock_warehouses', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('product', sa.Column('in_stock', sa.Boolean(), sa.Computed('stock_quantity > 0', persisted=True), nullable=True))
+    op.execute("""
+        UPDATE product p
+        SET stock_quantity = d.quantity, stock_warehouses = d.warehouses
+        FROM (
+            SELECT product_id,
+                   coalesce(sum(quantity), 0)::integer AS quantity,
+                   count(*) FILTER (WHERE quantity > 0)::integer AS warehouses
+            FROM stock GROUP BY product_id
+        ) d
+        WHERE p.id = d.product_id
+    """)
+    op.create_index('ix_product_active_in_stock_id', 'product', ['id'], unique=False, postgresql_where=sa.text('is_active AND in_stock'))
+
+    op.execute(SUMMARY_FUNCTION)
+    for name, event in TRIGGERS.items():
+        op.execute(f'CREATE TRIGGER {name} {event} FOR EACH STATEMENT EXECUTE FUNCTION product_stock_summary()')
+
+
+def downgrade() -> None:
+    for name in TRIGGERS:
+        op.execute(f'DROP TRIGGER IF EXISTS {name} ON stock')
+    op.execute('DROP FUNCTION IF EXISTS product_stock_summary()')
+    op.drop_index('ix_product_active_in_stock_id', table_name='product', postgresql_where=sa.text('is_active AND in_stock'))
+    op.drop_column('product', 'in_stock')
+    op.drop_column('product', 'stock_warehouses')
+    op.drop_column('product', 'stock_quantity')
@@ -0,0 +1,43 @@
+"""Add stock unique warehouse product
+
+Revision ID: 8d41f0b6e2a7
+Revises: 3a9c7e21b4d0
+Create Date: 2026-10-18 12:20:05.913402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d41f0b6e2a7'
+down_revision = '3a9c7e21b4d0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Merge every duplicated warehouse/product pair into its newest row, summing the quantities
+    op.execute("""
+        UPDATE stock s
+        SET quantity = totals.quantity
+        FROM (
+            SELECT max(id) AS id, sum(coalesce(quantity, 0)) AS quantity
+            FROM stock
+            GROUP BY warehouse_id, product_id
+            HAVING count(*) > 1
+        ) totals
+        WHERE s.id = totals.id
+    """)
+    op.execute("""
+        DELETE FROM stock s
+        USING stock newer
+        WHERE newer.warehouse_id = s.warehouse_id
+          AND newer.product_id = s.product_id
+          AND newer.id > s.id
+    """)
+    op.create_unique_constraint('uq_stock_warehouse_id_product_id', 'stock', ['warehouse_id', 'product_id'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_stock_warehouse_id_product_id', 'stock', type_='unique')
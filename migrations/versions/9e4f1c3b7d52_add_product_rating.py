@@ -0,0 +1,103 @@
+"""Add product rating
+
+Revision ID: 9e4f1c3b7d52
+Revises: 5b7e2d9c4a16
+Create Date: 2026-10-18 14:48:12.730915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e4f1c3b7d52'
+down_revision = '5b7e2d9c4a16'
+branch_labels = None
+depends_on = None
+
+
+# Per product deltas of a set of review rows
+DELTAS = """
+    SELECT product_id,
+           count(*)::integer AS count,
+           sum(stars)::integer AS total,
+           count(*) FILTER (WHERE stars = 1)::integer AS star_1,
+           count(*) FILTER (WHERE stars = 2)::integer AS star_2,
+           count(*) FILTER (WHERE stars = 3)::integer AS star_3,
+           count(*) FILTER (WHERE stars = 4)::integer AS star_4,
+           count(*) FILTER (WHERE stars = 5)::integer AS star_5
+    FROM (
+        SELECT product_id,
+               CASE estimate WHEN 'ONE' THEN 1 WHEN 'TWO' THEN 2 WHEN 'THREE' THEN 3
+                             WHEN 'FOUR' THEN 4 WHEN 'FIVE' THEN 5 END AS stars
+        FROM {rows}
+    ) r
+    GROUP BY product_id
+"""
+
+COLUMNS = ('count', 'total', 'star_1', 'star_2', 'star_3', 'star_4', 'star_5')
+
+
+def merge(rows: str, sign: str) -> str:
+    updates = ', '.join(f'{column} = product_rating.{column} + EXCLUDED.{column}' for column in COLUMNS)
+    values = ', '.join(f'{sign}d.{column}' for column in COLUMNS)
+    return (
+        f'INSERT INTO product_rating (product_id, {", ".join(COLUMNS)}) '
+        f'SELECT d.product_id, {values} FROM ({DELTAS.format(rows=rows)}) d '
+        f'JOIN product p ON p.id = d.product_id '
+        f'ON CONFLICT (product_id) DO UPDATE SET {updates};'
+    )
+
+
+# Statement level, a bulk load of reviews touches every product once
+SUMMARY_FUNCTION = f"""
+CREATE FUNCTION product_rating_summary() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        {merge('old_rows', '-')}
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        {merge('new_rows', '')}
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+# Transition tables allow a single event per trigger
+TRIGGERS = {
+    'review_rating_insert': 'AFTER INSERT ON review REFERENCING NEW TABLE AS new_rows',
+    'review_rating_update': 'AFTER UPDATE ON review REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows',
+    'review_rating_delete': 'AFTER DELETE ON review REFERENCING OLD TABLE AS old_rows',
+}
+
+
+def upgrade() -> None:
+    op.create_table('product_rating',
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('total', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('star_1', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('star_2', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('star_3', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('star_4', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('star_5', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('average', sa.DECIMAL(precision=3, scale=2), sa.Computed('CASE WHEN count > 0 THEN round(total::numeric / count, 2) END', persisted=True), nullable=True),
+    sa.ForeignKeyConstraint(['product_id'], ['product.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('product_id')
+    )
+    op.execute(
+        f'INSERT INTO product_rating (product_id, {", ".join(COLUMNS)}) '
+        f'SELECT product_id, {", ".join(COLUMNS)} FROM ({DELTAS.format(rows="review")}) d'
+    )
+
+    op.execute(SUMMARY_FUNCTION)
+    for name, event in TRIGGERS.items():
+        op.execute(f'CREATE TRIGGER {name} {event} FOR EACH STATEMENT EXECUTE FUNCTION product_rating_summary()')
+
+
+def downgrade() -> None:
+    for name in TRIGGERS:
+        op.execute(f'DROP TRIGGER IF EXISTS {name} ON review')
+    op.execute('DROP FUNCTION IF EXISTS product_rating_summary()')
+    op.drop_table('product_rating')
@@ -0,0 +1,40 @@
+"""Use a GiST articul trigram index
+
+Revision ID: a4c81f6d2b93
+Revises: d6a3f8b1c947
+Create Date: 2026-10-18 19:12:40.518237
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c81f6d2b93'
+down_revision = 'd6a3f8b1c947'
+branch_labels = None
+depends_on = None
+
+# Product search orders the articul candidates by distance (<->), which only GiST supports.
+# The new index is built under a temporary name, so search keeps an index while it builds.
+
+
+def upgrade() -> None:
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_product_articul_trgm_gist')  # leftover of an interrupted build
+        op.create_index('ix_product_articul_trgm_gist', 'product', ['articul'], unique=False,
+                        postgresql_using='gist', postgresql_ops={'articul': 'gist_trgm_ops'},
+                        postgresql_concurrently=True)
+        op.drop_index('ix_product_articul_trgm', table_name='product', postgresql_concurrently=True)
+        op.execute('ALTER INDEX ix_product_articul_trgm_gist RENAME TO ix_product_articul_trgm')
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_product_articul_trgm_gin')
+        op.create_index('ix_product_articul_trgm_gin', 'product', ['articul'], unique=False,
+                        postgresql_using='gin', postgresql_ops={'articul': 'gin_trgm_ops'},
+                        postgresql_concurrently=True)
+        op.drop_index('ix_product_articul_trgm', table_name='product', postgresql_concurrently=True)
+        op.execute('ALTER INDEX ix_product_articul_trgm_gin RENAME TO ix_product_articul_trgm')
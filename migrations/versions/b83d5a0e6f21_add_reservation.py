@@ -0,0 +1,54 @@
+"""Add reservation
+
+Revision ID: b83d5a0e6f21
+Revises: 47a0c8e5f3b9
+Create Date: 2026-10-18 17:05:26.094417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b83d5a0e6f21'
+down_revision = '47a0c8e5f3b9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('reservation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.Enum('active', 'completed', 'released', 'expired', name='reservation_status'), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_reservation_active_expires_at', 'reservation', ['expires_at'], unique=False, postgresql_where=sa.text("status = 'active'"))
+    op.create_index(op.f('ix_reservation_user_id'), 'reservation', ['user_id'], unique=False)
+    op.create_table('reservation_item',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('reservation_id', sa.Integer(), nullable=False),
+    sa.Column('stock_id', sa.Integer(), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('warehouse_id', sa.Integer(), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['product_id'], ['product.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['reservation_id'], ['reservation.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['stock_id'], ['stock.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_reservation_item_reservation_id'), 'reservation_item', ['reservation_id'], unique=False)
+    op.create_index(op.f('ix_reservation_item_stock_id'), 'reservation_item', ['stock_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_reservation_item_stock_id'), table_name='reservation_item')
+    op.drop_index(op.f('ix_reservation_item_reservation_id'), table_name='reservation_item')
+    op.drop_table('reservation_item')
+    op.drop_index(op.f('ix_reservation_user_id'), table_name='reservation')
+    op.drop_index('ix_reservation_active_expires_at', table_name='reservation', postgresql_where=sa.text("status = 'active'"))
+    op.drop_table('reservation')
+    sa.Enum(name='reservation_status').drop(op.get_bind(), checkfirst=False)
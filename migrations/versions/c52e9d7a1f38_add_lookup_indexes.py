@@ -0,0 +1,41 @@
+"""Add lookup indexes
+
+Revision ID: c52e9d7a1f38
+Revises: 8d41f0b6e2a7
+Create Date: 2026-10-18 13:41:22.086519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c52e9d7a1f38'
+down_revision = '8d41f0b6e2a7'
+branch_labels = None
+depends_on = None
+
+# stock.warehouse_id lookups use uq_stock_warehouse_id_product_id,
+# active product lookups use the partial ix_product_active_* indexes.
+INDEXES = [
+    ('ix_stock_product_id', 'stock', ['product_id']),
+    ('ix_review_product_id_created_at', 'review', ['product_id', 'created_at', 'id']),
+    ('ix_product_category_id', 'product', ['category_id']),
+    ('ix_product_photo_product_id', 'product_photo', ['product_id']),
+    ('ix_category_parent_id', 'category', ['parent_id']),
+    ('ix_cart_user_id', 'cart', ['user_id']),
+]
+
+
+def upgrade() -> None:
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')  # leftover of an interrupted build
+            op.create_index(name, table, columns, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
@@ -0,0 +1,51 @@
+"""Add dashboard summary
+
+Revision ID: d6a3f8b1c947
+Revises: b83d5a0e6f21
+Create Date: 2026-10-18 17:48:12.305961
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd6a3f8b1c947'
+down_revision = 'b83d5a0e6f21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('dashboard_review_day',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('total', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('star_1', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('star_2', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('star_3', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('star_4', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('star_5', sa.Integer(), server_default='0', nullable=False),
+    sa.PrimaryKeyConstraint('day')
+    )
+    op.create_table('dashboard_summary',
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('data', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('computed_at', sa.DateTime(), nullable=False),
+    sa.Column('watermark_at', sa.DateTime(), nullable=True),
+    sa.Column('watermark_id', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_review_created_at_id')  # leftover of an interrupted build
+        op.create_index('ix_review_created_at_id', 'review', ['created_at', 'id'], unique=False,
+                        postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_review_created_at_id', table_name='review', postgresql_concurrently=True)
+    op.drop_table('dashboard_summary')
+    op.drop_table('dashboard_review_day')
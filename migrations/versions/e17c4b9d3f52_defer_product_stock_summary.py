@@ -0,0 +1,110 @@
+"""Defer the product stock summary
+
+Revision ID: e17c4b9d3f52
+Revises: a4c81f6d2b93
+Create Date: 2026-10-18 21:06:14.207319
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e17c4b9d3f52'
+down_revision = 'a4c81f6d2b93'
+branch_labels = None
+depends_on = None
+
+# Stock writes only append their per product change to product_stock_delta, the stock
+# summary folder adds the deltas to product. Appending takes no lock on product, so
+# checkouts, imports and stock updates of one product no longer queue on its row.
+# Updates leaving quantity and the counted warehouses alone append nothing.
+DELTA_FUNCTION = """
+CREATE OR REPLACE FUNCTION product_stock_summary() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO product_stock_delta (product_id, quantity, warehouses)
+        SELECT product_id, sum(quantity)::integer, count(*) FILTER (WHERE quantity > 0)::integer
+        FROM new_rows GROUP BY product_id HAVING sum(quantity) <> 0;
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO product_stock_delta (product_id, quantity, warehouses)
+        SELECT product_id, -sum(quantity)::integer, -count(*) FILTER (WHERE quantity > 0)::integer
+        FROM old_rows GROUP BY product_id HAVING sum(quantity) <> 0;
+    ELSE
+        INSERT INTO product_stock_delta (product_id, quantity, warehouses)
+        SELECT product_id, sum(quantity)::integer, sum(warehouses)::integer
+        FROM (
+            SELECT product_id, quantity, (quantity > 0)::integer AS warehouses FROM new_rows
+            UNION ALL
+            SELECT product_id, -quantity, -(quantity > 0)::integer FROM old_rows
+        ) d
+        GROUP BY product_id
+        HAVING sum(quantity) <> 0 OR sum(warehouses) <> 0;
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+# product_stock_summary of 5b7e2d9c4a16, updating product in the stock writing transaction
+SUMMARY_FUNCTION = """
+CREATE OR REPLACE FUNCTION product_stock_summary() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE product p
+        SET stock_quantity = p.stock_quantity - d.quantity,
+            stock_warehouses = p.stock_warehouses - d.warehouses
+        FROM (
+            SELECT product_id,
+                   coalesce(sum(quantity), 0)::integer AS quantity,
+                   count(*) FILTER (WHERE quantity > 0)::integer AS warehouses
+            FROM old_rows GROUP BY product_id
+        ) d
+        WHERE p.id = d.product_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE product p
+        SET stock_quantity = p.stock_quantity + d.quantity,
+            stock_warehouses = p.stock_warehouses + d.warehouses
+        FROM (
+            SELECT product_id,
+                   coalesce(sum(quantity), 0)::integer AS quantity,
+                   count(*) FILTER (WHERE quantity > 0)::integer AS warehouses
+            FROM new_rows GROUP BY product_id
+        ) d
+        WHERE p.id = d.product_id;
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+FOLD_PENDING_SQL = """
+UPDATE product p
+SET stock_quantity = p.stock_quantity + d.quantity,
+    stock_warehouses = p.stock_warehouses + d.warehouses
+FROM (
+    SELECT product_id, sum(quantity)::integer AS quantity, sum(warehouses)::integer AS warehouses
+    FROM product_stock_delta GROUP BY product_id
+) d
+WHERE p.id = d.product_id
+"""
+
+
+def upgrade() -> None:
+    # No foreign key: appending must not lock the product row either
+    op.create_table('product_stock_delta',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.Column('warehouses', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute(DELTA_FUNCTION)
+
+
+def downgrade() -> None:
+    op.execute('LOCK TABLE stock IN SHARE MODE')
+    op.execute(FOLD_PENDING_SQL)
+    op.execute(SUMMARY_FUNCTION)
+    op.drop_table('product_stock_delta')
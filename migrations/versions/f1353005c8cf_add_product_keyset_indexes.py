@@ -0,0 +1,39 @@
+"""Add product keyset indexes
+
+Revision ID: f1353005c8cf
+Revises: 02b6360ff102
+Create Date: 2026-10-18 10:12:31.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1353005c8cf'
+down_revision = '02b6360ff102'
+branch_labels = None
+depends_on = None
+
+
+# Partial indexes of the active product keyset orderings
+INDEXES = [
+    ('ix_product_active_id', ['id']),
+    ('ix_product_active_price_id', ['price', 'id']),
+    ('ix_product_active_category_id_id', ['category_id', 'id']),
+]
+
+
+def upgrade() -> None:
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, columns in INDEXES:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')  # leftover of an interrupted build
+            op.create_index(name, 'product', columns, postgresql_where=sa.text('is_active'),
+                            postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, columns in reversed(INDEXES):
+            op.drop_index(name, table_name='product', postgresql_concurrently=True)
@@ -1,15 +1,82 @@
+import time
+from typing import Optional
+
+import jwt
+from fastapi_users import exceptions
 from fastapi_users.authentication import CookieTransport, JWTStrategy, AuthenticationBackend
 from fastapi_users import FastAPIUsers
+from fastapi_users.jwt import decode_jwt, generate_jwt
+from fastapi_users.manager import BaseUserManager
 from .models import User
 from .manager import get_user_manager
+from .utils import detached_user, user_cache
+from config import AUTH_TRUST_JWT_CLAIMS, AUTH_TOKEN_LIFETIME
 
 
-cookie_transport = CookieTransport(cookie_max_age=3600)
+cookie_transport = CookieTransport(cookie_max_age=AUTH_TOKEN_LIFETIME)
 
 SECRET = "SECRET"
 
+# User flags carried by the token
+CLAIMS = ('is_active', 'is_superuser', 'is_verified')
+
+
+class CachedJWTStrategy(JWTStrategy):
+    '''
+    JWT strategy resolving the user without a database round trip when it can (trust_claims):
+    from the in-process user cache, or from the flags signed into the token. Tokens issued
+    before the user was changed in this process fall back to the database.
+    Without trust_claims the user is always loaded from the database, the cache is only
+    filled for the other strategy, since it is not invalidated by other processes.
+    '''
+
+    def __init__(self, *args, trust_claims: bool = AUTH_TRUST_JWT_CLAIMS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.trust_claims = trust_claims
+
+    async def read_token(self, token: Optional[str], user_manager: BaseUserManager) -> Optional[User]:
+        if token is None:
+            return None
+
+        try:
+            data = decode_jwt(
+                token, self.decode_key, self.token_audience, algorithms=[self.algorithm])
+            user_id = user_manager.parse_id(data['sub'])
+        except (jwt.PyJWTError, KeyError, exceptions.InvalidID):
+            return None
+
+        if self.trust_claims:
+            user = user_cache.get(user_id)
+            if user is not None:
+                return user
+            if all(claim in data for claim in CLAIMS) \
+                    and not user_cache.changed_since(user_id, data.get('iat')):
+                return detached_user({'id': user_id, **{claim: data[claim] for claim in CLAIMS}})
+
+        try:
+            user = await user_manager.get(user_id)
+        except exceptions.UserNotExists:
+            return None
+        user_cache.set(user)
+        return user
+
+    async def write_token(self, user: User) -> str:
+        data = {
+            'sub': str(user.id),
+            'aud': self.token_audience,
+            'iat': int(time.time()),
+            **{claim: getattr(user, claim) for claim in CLAIMS},
+        }
+        return generate_jwt(
+            data, self.encode_key, self.lifetime_seconds, algorithm=self.algorithm)
+
+
 def get_jwt_strategy() -> JWTStrategy:
-    return JWTStrategy(secret=SECRET, lifetime_seconds=3600)
+    return CachedJWTStrategy(secret=SECRET, lifetime_seconds=AUTH_TOKEN_LIFETIME)
+
+
+def get_db_jwt_strategy() -> JWTStrategy:
+    return CachedJWTStrategy(secret=SECRET, lifetime_seconds=AUTH_TOKEN_LIFETIME, trust_claims=False)
 
 auth_backend = AuthenticationBackend(
     name="jwt",
@@ -17,9 +84,19 @@ auth_backend = AuthenticationBackend(
     get_strategy=get_jwt_strategy,
 )
 
+# Same cookie, but the user always comes from the database
+db_auth_backend = AuthenticationBackend(
+    name="jwt-db",
+    transport=cookie_transport,
+    get_strategy=get_db_jwt_strategy,
+)
+
 fastapi_users = FastAPIUsers[User, int](
     get_user_manager,
-    [auth_backend],
+    [auth_backend, db_auth_backend],
 )
 
-current_user = fastapi_users.current_user()
\ No newline at end of file
+current_user = fastapi_users.current_user()
+# For writes that must see deactivated users right away, e.g. checkout
+current_db_user = fastapi_users.current_user(
+    active=True, get_enabled_backends=lambda: [db_auth_backend])
\ No newline at end of file
@@ -1,11 +1,13 @@
-from typing import Optional
+from typing import Any, Dict, Optional
 
 from fastapi import Depends, Request
-from fastapi_users import BaseUserManager, IntegerIDMixin
+from fastapi.security import OAuth2PasswordRequestForm
+from fastapi_users import BaseUserManager, IntegerIDMixin, exceptions, schemas
 from idna import intranges_contain
 
 from auth.models import User
-from auth.utils import get_user_db
+from auth.password import AsyncPasswordHelper, password_helper
+from auth.utils import get_user_db, user_cache
 
 
 SECRET = "SECRET"
@@ -14,10 +16,81 @@ SECRET = "SECRET"
 class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
     reset_password_token_secret = SECRET
     verification_token_secret = SECRET
+    password_helper: AsyncPasswordHelper
+
+    async def create(self, user_create: schemas.UC, safe: bool = False,
+                     request: Optional[Request] = None) -> User:
+        '''
+        BaseUserManager.create, hashing the password in the thread pool of the password helper.
+        '''
+        await self.validate_password(user_create.password, user_create)
+
+        existing_user = await self.user_db.get_by_email(user_create.email)
+        if existing_user is not None:
+            raise exceptions.UserAlreadyExists()
+
+        user_dict = (
+            user_create.create_update_dict()
+            if safe
+            else user_create.create_update_dict_superuser()
+        )
+        password = user_dict.pop("password")
+        user_dict["hashed_password"] = await self.password_helper.hash_async(password)
+
+        created_user = await self.user_db.create(user_dict)
+
+        await self.on_after_register(created_user, request)
+
+        return created_user
+
+    async def authenticate(self, credentials: OAuth2PasswordRequestForm) -> Optional[User]:
+        '''
+        BaseUserManager.authenticate, verifying the password in the thread pool of the password helper.
+        '''
+        try:
+            user = await self.get_by_email(credentials.username)
+        except exceptions.UserNotExists:
+            # Run the hasher anyway to mitigate timing attacks
+            await self.password_helper.hash_async(credentials.password)
+            return None
+
+        verified, updated_password_hash = await self.password_helper.verify_and_update_async(
+            credentials.password, user.hashed_password
+        )
+        if not verified:
+            return None
+        # Hashes of another work factor are replaced while the password is at hand
+        if updated_password_hash is not None:
+            await self.user_db.update(user, {"hashed_password": updated_password_hash})
+
+        return user
+
+    async def _update(self, user: User, update_dict: Dict[str, Any]) -> User:
+        '''
+        Hash a new password in the thread pool of the password helper, then update as usual.
+        '''
+        if "password" in update_dict:
+            update_dict = dict(update_dict)
+            password = update_dict.pop("password")
+            await self.validate_password(password, user)
+            update_dict["hashed_password"] = await self.password_helper.hash_async(password)
+        return await super()._update(user, update_dict)
 
     async def on_after_register(self, user: User, request: Optional[Request] = None):
         print(f"User {user.id} has registered.")
 
+    async def on_after_update(self, user: User, update_dict: Dict[str, Any], request: Optional[Request] = None):
+        user_cache.invalidate(user.id)
+
+    async def on_after_verify(self, user: User, request: Optional[Request] = None):
+        user_cache.invalidate(user.id)
+
+    async def on_after_reset_password(self, user: User, request: Optional[Request] = None):
+        user_cache.invalidate(user.id)
+
+    async def on_after_delete(self, user: User, request: Optional[Request] = None):
+        user_cache.invalidate(user.id)
+
     # async def on_after_forgot_password(
     #     self, user: User, token: str, request: Optional[Request] = None
     # ):
@@ -30,4 +103,4 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
 
 
 async def get_user_manager(user_db=Depends(get_user_db)):
-    yield UserManager(user_db)
+    yield UserManager(user_db, password_helper)
@@ -0,0 +1,41 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from fastapi_users.password import PasswordHelper
+from passlib.context import CryptContext
+
+from config import AUTH_BCRYPT_ROUNDS, AUTH_HASHING_WORKERS
+
+
+class AsyncPasswordHelper(PasswordHelper):
+    '''
+    bcrypt password helper with awaitable hashing and verification.
+
+    bcrypt releases the GIL, so the work runs in a bounded thread pool and a burst of
+    logins no longer stalls every other request of the worker. Hashes made with another
+    work factor than rounds are reported by verify_and_update and replaced on login.
+    '''
+
+    def __init__(self, rounds: int = AUTH_BCRYPT_ROUNDS, workers: int = AUTH_HASHING_WORKERS):
+        super().__init__(CryptContext(
+            schemes=['bcrypt'], deprecated='auto',
+            bcrypt__default_rounds=rounds, bcrypt__min_rounds=rounds, bcrypt__max_rounds=rounds))
+        self.rounds = rounds
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password')
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def hash_async(self, password: str) -> str:
+        return await self._run(self.hash, password)
+
+    async def verify_and_update_async(self, plain_password: str,
+                                      hashed_password: str) -> Tuple[bool, Optional[str]]:
+        return await self._run(self.verify_and_update, plain_password, hashed_password)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+password_helper = AsyncPasswordHelper()
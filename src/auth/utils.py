@@ -1,12 +1,88 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
 
 from fastapi import Depends
 from fastapi_users.db import SQLAlchemyUserDatabase
 # import fastapi_users
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
 
 from auth.models import User
+from config import AUTH_USER_CACHE_TTL, AUTH_USER_CACHE_SIZE, AUTH_TOKEN_LIFETIME
 from database import get_async_session
 
+# Columns kept by the user cache, the password hash is loaded on demand
+CACHED_COLUMNS = ('id', 'email', 'registered_at', 'is_active', 'is_superuser', 'is_verified')
+
 async def get_user_db(session: AsyncSession = Depends(get_async_session)):
     yield SQLAlchemyUserDatabase(session, User)
 
+
+def detached_user(data: Dict[str, Any]) -> User:
+    '''
+    Build a user from plain column values. It is detached rather than new, so a session
+    it is added to (e.g. by an update) treats it as the existing row.
+    '''
+    user = User(**data)
+    make_transient_to_detached(user)
+    return user
+
+
+class UserCache:
+    '''
+    In-process LRU cache of users with a TTL.
+
+    Plain column values are stored and every get() builds a fresh detached user, so no
+    ORM instance is shared between requests. invalidate() drops a user and remembers when
+    it happened, so tokens issued before a change of the user are no longer trusted in
+    this process. Other processes load the user again once their entry expires, but keep
+    trusting the claims of older tokens until those expire.
+    '''
+
+    def __init__(self, ttl: int = AUTH_USER_CACHE_TTL, max_size: int = AUTH_USER_CACHE_SIZE,
+                 token_lifetime: int = AUTH_TOKEN_LIFETIME):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.token_lifetime = token_lifetime
+        self._users: 'OrderedDict[int, tuple[float, Dict[str, Any]]]' = OrderedDict()
+        # Oldest invalidation first, tokens older than token_lifetime have expired anyway
+        self._invalidated_at: 'OrderedDict[int, float]' = OrderedDict()
+
+    def get(self, user_id: int) -> Optional[User]:
+        entry = self._users.get(user_id)
+        if entry is None:
+            return None
+        expires_at, data = entry
+        if expires_at < time.monotonic():
+            del self._users[user_id]
+            return None
+        self._users.move_to_end(user_id)
+        return detached_user(data)
+
+    def set(self, user: User):
+        data = {column: getattr(user, column) for column in CACHED_COLUMNS}
+        self._users[user.id] = (time.monotonic() + self.ttl, data)
+        self._users.move_to_end(user.id)
+        while len(self._users) > self.max_size:
+            self._users.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._users.pop(user_id, None)
+        now = time.time()
+        self._invalidated_at.pop(user_id, None)
+        self._invalidated_at[user_id] = now
+        while next(iter(self._invalidated_at.values())) < now - self.token_lifetime:
+            self._invalidated_at.popitem(last=False)
+
+    def changed_since(self, user_id: int, issued_at: Optional[float]) -> bool:
+        '''
+        True if the user was invalidated after a token issued at issued_at (unix time).
+        '''
+        invalidated_at = self._invalidated_at.get(user_id)
+        if invalidated_at is None:
+            return False
+        return issued_at is None or issued_at <= invalidated_at
+
+
+user_cache = UserCache()
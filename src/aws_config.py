@@ -1,15 +1,26 @@
 import boto3
 import os
 
-from config import AWS_KEY_ID, AWS_SECRET
+from boto3.s3.transfer import TransferConfig
+
+from config import AWS_KEY_ID, AWS_SECRET, AWS_ENDPOINT_URL, S3_MULTIPART_CHUNK_SIZE
 
 aws_session = boto3.Session()
 
 s3_client = aws_session.client(
     service_name='s3',
-    endpoint_url='https://hb.bizmrg.com',
+    endpoint_url=AWS_ENDPOINT_URL,
     aws_access_key_id=AWS_KEY_ID,
     aws_secret_access_key=AWS_SECRET
 )
 
+# Files above one chunk are sent as multipart uploads, parts are read from the
+# upload stream one chunk at a time instead of loading the whole file
+s3_transfer_config = TransferConfig(
+    multipart_threshold=S3_MULTIPART_CHUNK_SIZE,
+    multipart_chunksize=S3_MULTIPART_CHUNK_SIZE,
+    # parts of a single file sent in parallel
+    max_concurrency=4,
+)
+
 AWS_FILTEPATH_GET = os.environ.get('AWS_FILTEPATH_GET')
@@ -0,0 +1,213 @@
+import hashlib
+import inspect
+import logging
+import time
+from enum import Enum
+from functools import wraps
+from typing import Callable, Dict, Iterable, List, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+from redis.exceptions import RedisError
+
+from config import CATALOG_CACHE_TTL
+
+
+logger = logging.getLogger(__name__)
+
+SIMPLE_TYPES = (str, int, float, bool, Enum, type(None))
+
+# Writes a response and registers it under its tags unless a tag version changed since the
+# lookup, in one step so an invalidate() cannot slip in between the check and the write.
+# KEYS: response key, version keys, tag keys. ARGV: body, expire, tag expire, versions.
+STORE_SCRIPT = '''
+local tags = (#KEYS - 1) / 2
+for i = 1, tags do
+    if redis.call('GET', KEYS[1 + i]) ~= ARGV[3 + i] then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+for i = 1, tags do
+    redis.call('SADD', KEYS[1 + tags + i], KEYS[1])
+    redis.call('EXPIRE', KEYS[1 + tags + i], ARGV[3])
+end
+return 1
+'''
+
+
+class CatalogCache:
+    '''
+    Redis cache of catalog responses.
+
+    Every cached response is registered in the sets of its entity tags
+    (product:{id}, category:{id}, stock:{product_id}, product:list, ...).
+    invalidate() purges exactly the responses built from the changed entities and
+    bumps a version counter per tag, so a response computed while one of its tags
+    was invalidated is never written back.
+
+    The ETag of a response hashes the versions of its tags and the body. A request whose
+    If-None-Match matches the cached body gets a 304 without running the route, once the
+    entry has expired the route runs again, so a change no tag records ends with the TTL.
+    A rebuilt body whose ETag matches If-None-Match is stored and answered with a 304 too.
+    '''
+
+    def __init__(self, prefix: str = 'catalog', expire: int = CATALOG_CACHE_TTL):
+        self.prefix = prefix
+        self.expire = expire
+        self.redis = None
+        self._max_expire = expire
+        self._store_script = None
+
+    def init(self, redis):
+        self.redis = redis
+        self._store_script = redis.register_script(STORE_SCRIPT)
+
+    def _tag_key(self, tag: str) -> str:
+        return f'{self.prefix}:tag:{tag}'
+
+    def _version_key(self, tag: str) -> str:
+        return f'{self.prefix}:version:{tag}'
+
+    def _build_key(self, func: Callable, kwargs: dict, normalize: Dict[str, Callable]) -> str:
+        # Only plain query/path values take part in the key, dependencies like the session are skipped
+        kwargs = {name: normalize[name](value) if name in normalize else value
+                  for name, value in kwargs.items()}
+        params = sorted(
+            (name, value.value if isinstance(value, Enum) else value)
+            for name, value in kwargs.items() if isinstance(value, SIMPLE_TYPES))
+        digest = hashlib.md5(repr(params).encode()).hexdigest()
+        return f'{self.prefix}:{func.__module__}.{func.__name__}:{digest}'
+
+    async def version(self, tag: str) -> Optional[str]:
+        '''
+        Current version of a tag, None when it has none yet or Redis is unavailable.
+        '''
+        if self.redis is None:
+            return None
+        try:
+            return await self.redis.get(self._version_key(tag))
+        except RedisError:
+            logger.exception('Catalog cache is unavailable')
+            return None
+
+    async def _versions(self, tags: List[str]) -> list:
+        return await self.redis.mget([self._version_key(tag) for tag in tags])
+
+    async def _lookup(self, key: str, tags: List[str]) -> tuple:
+        '''
+        The cached body of key and the current versions of the tags. Missing counters start
+        from the current time, so an ETag issued before Redis lost them cannot match again.
+        '''
+        pipe = self.redis.pipeline()
+        pipe.get(key)
+        pipe.mget([self._version_key(tag) for tag in tags])
+        body, versions = await pipe.execute()
+        missing = [tag for tag, version in zip(tags, versions) if version is None]
+        if missing:
+            pipe = self.redis.pipeline()
+            for tag in missing:
+                pipe.set(self._version_key(tag), time.time_ns(), nx=True)
+            await pipe.execute()
+            versions = await self._versions(tags)
+        return body, versions
+
+    @staticmethod
+    def _etag(key: str, versions: list, body: bytes) -> str:
+        digest = hashlib.md5(repr((key, versions)).encode())
+        digest.update(body)
+        return 'W/"%s"' % digest.hexdigest()
+
+    @staticmethod
+    def _not_modified(request: Request, etag: str) -> bool:
+        header = request.headers.get('if-none-match')
+        if not header:
+            return False
+        candidates = {candidate.strip() for candidate in header.split(',')}
+        return '*' in candidates or etag in candidates or etag[2:] in candidates
+
+    async def _store(self, key: str, body: bytes, expire: int, tags: List[str], versions: list):
+        self._max_expire = max(self._max_expire, expire)
+        await self._store_script(
+            keys=[key, *(self._version_key(tag) for tag in tags), *(self._tag_key(tag) for tag in tags)],
+            args=[body, expire, self._max_expire, *versions])
+
+    def cached(self, tags: Callable[..., Iterable[str]], expire: Optional[int] = None,
+               normalize: Optional[Dict[str, Callable]] = None):
+        '''
+        Cache successful JSON responses of a route and answer conditional requests.
+        tags receives the keyword arguments of the route and returns its entity tags,
+        normalize maps a parameter to the function giving its value in the cache key.
+        '''
+        expire = expire or self.expire
+        normalize = normalize or {}
+
+        def decorator(func):
+            signature = inspect.signature(func)
+            # The request is needed for If-None-Match, routes that do not take it get it added
+            pass_request = 'request' in signature.parameters
+
+            @wraps(func)
+            async def wrapper(*args, request: Request, **kwargs):
+                if pass_request:
+                    kwargs['request'] = request
+                if self.redis is None:
+                    return await func(*args, **kwargs)
+
+                key = self._build_key(func, kwargs, normalize)
+                entry_tags = list(tags(**kwargs))
+                try:
+                    body, versions = await self._lookup(key, entry_tags)
+                    # Only a cached body can be answered with a 304, an expired one is rebuilt
+                    if body is not None:
+                        etag = self._etag(key, versions, body.encode())
+                        if self._not_modified(request, etag):
+                            return Response(status_code=304, headers={'ETag': etag})
+                        return Response(body, media_type='application/json', headers={'ETag': etag})
+                except RedisError:
+                    logger.exception('Catalog cache is unavailable')
+                    return await func(*args, **kwargs)
+
+                response = await func(*args, **kwargs)
+                if isinstance(response, Response) and response.status_code == 200:
+                    etag = self._etag(key, versions, response.body)
+                    response.headers['ETag'] = etag
+                    try:
+                        await self._store(key, response.body, expire, entry_tags, versions)
+                    except RedisError:
+                        logger.exception('Catalog cache is unavailable')
+                    # A client still holding the rebuilt body only needs the 304
+                    if self._not_modified(request, etag):
+                        return Response(status_code=304, headers={'ETag': etag})
+                return response
+
+            if not pass_request:
+                wrapper.__signature__ = signature.replace(parameters=[
+                    *signature.parameters.values(),
+                    inspect.Parameter('request', inspect.Parameter.KEYWORD_ONLY, annotation=Request),
+                ])
+            return wrapper
+        return decorator
+
+    async def invalidate(self, *tags: str):
+        '''
+        Purge every cached response registered under any of the tags.
+        '''
+        if self.redis is None or not tags:
+            return
+        tag_keys = [self._tag_key(tag) for tag in tags]
+        try:
+            keys = await self.redis.sunion(tag_keys)
+            pipe = self.redis.pipeline()
+            now = time.time_ns()
+            for tag in tags:
+                # Seeded like in _lookup(), a counter lost with a flush must not restart at 1
+                pipe.set(self._version_key(tag), now, nx=True)
+                pipe.incr(self._version_key(tag))
+            pipe.delete(*tag_keys, *keys)
+            await pipe.execute()
+        except RedisError:
+            logger.exception('Catalog cache invalidation failed for %s', tags)
+
+
+catalog_cache = CatalogCache()
@@ -8,9 +8,105 @@ DB_PORT = os.environ.get('DB_PORT')
 DB_NAME = os.environ.get('DB_NAME')
 DB_USER = os.environ.get('DB_USER')
 DB_PASS = os.environ.get('DB_PASS')
-# SMTP_USER = os.environ.get('SMTP_USER')
-# SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD')
+SMTP_USER = os.environ.get('SMTP_USER')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD')
+SMTP_HOST = os.environ.get('SMTP_HOST', 'smtp.gmail.com')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 465))
+# Implicit TLS (SMTP_SSL), off for a local debugging server
+SMTP_SSL = os.environ.get('SMTP_SSL', 'true').lower() in ('1', 'true', 'yes')
+# Authenticated connections kept open per worker process, and seconds one may idle
+# before it is checked with NOOP
+SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', 2))
+SMTP_IDLE_TIMEOUT = int(os.environ.get('SMTP_IDLE_TIMEOUT', 60))
+# Queued mail is delivered in batches: seconds the first message of a batch waits for
+# more, and messages sent per batch
+MAIL_BATCH_DELAY = float(os.environ.get('MAIL_BATCH_DELAY', 5))
+MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE', 100))
+# Seconds a queued report blocks identical requests of the same user if it is never delivered
+MAIL_DEDUPE_TTL = int(os.environ.get('MAIL_DEDUPE_TTL', 15 * 60))
 
 
 AWS_KEY_ID = os.environ.get('AWS_KEY_ID')
 AWS_SECRET = os.environ.get('AWS_SECRET')
+
+
+# Seconds an in-process copy of the category tree is trusted before reloading, only while
+# the catalog cache has no category:list version to check it against
+CATEGORY_TREE_TTL = int(os.environ.get('CATEGORY_TREE_TTL', 60))
+
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://127.0.0.1')
+# Seconds catalog responses stay in the Redis cache
+CATALOG_CACHE_TTL = int(os.environ.get('CATALOG_CACHE_TTL', 300))
+
+AWS_ENDPOINT_URL = os.environ.get('AWS_ENDPOINT_URL', 'https://hb.bizmrg.com')
+AWS_BUCKET = os.environ.get('AWS_BUCKET', 'bat_test')
+# Photo uploads running at the same time in one worker process
+S3_UPLOAD_CONCURRENCY = int(os.environ.get('S3_UPLOAD_CONCURRENCY', 8))
+S3_MULTIPART_CHUNK_SIZE = int(os.environ.get('S3_MULTIPART_CHUNK_SIZE', 8 * 1024 * 1024))
+
+# Local storage of uploaded files
+UPLOAD_DIR = os.environ.get('UPLOAD_DIR', './path')
+UPLOAD_MAX_SIZE = int(os.environ.get('UPLOAD_MAX_SIZE', 10 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+
+# Products accepted by one batch create/update request
+PRODUCT_BATCH_MAX_SIZE = int(os.environ.get('PRODUCT_BATCH_MAX_SIZE', 5000))
+
+# Database connection pool of every worker process
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+# Behind pgbouncer in transaction mode: no prepared statement caches and no app side pool
+DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', 'false').lower() in ('1', 'true', 'yes')
+
+# Product search: minimal trigram similarity of articul typos and matches ranked per query
+SEARCH_SIMILARITY_THRESHOLD = float(os.environ.get('SEARCH_SIMILARITY_THRESHOLD', 0.5))
+SEARCH_CANDIDATE_LIMIT = int(os.environ.get('SEARCH_CANDIDATE_LIMIT', 1000))
+
+# Upper bounds of the price facet buckets of /products/filter, the last bucket is open ended
+PRICE_FACET_BOUNDS = [float(bound) for bound in os.environ.get(
+    'PRICE_FACET_BOUNDS', '100,500,1000,5000,10000').split(',')]
+
+# Redis carts: idle lifetime of a cart hash, the largest amount of one product (the cart
+# table column is a 32-bit integer) and write-behind flushing to the cart table
+CART_TTL = int(os.environ.get('CART_TTL', 7 * 24 * 3600))
+MAX_CART_AMOUNT = int(os.environ.get('MAX_CART_AMOUNT', 10000))
+CART_FLUSH_INTERVAL = float(os.environ.get('CART_FLUSH_INTERVAL', 2))
+CART_FLUSH_BATCH_SIZE = int(os.environ.get('CART_FLUSH_BATCH_SIZE', 500))
+
+# Seconds between folds of the pending stock changes into the product stock summary, and
+# changes folded per transaction
+STOCK_SUMMARY_INTERVAL = float(os.environ.get('STOCK_SUMMARY_INTERVAL', 1))
+STOCK_SUMMARY_BATCH_SIZE = int(os.environ.get('STOCK_SUMMARY_BATCH_SIZE', 5000))
+
+# Checkout stock reservations
+RESERVATION_TTL = int(os.environ.get('RESERVATION_TTL', 15 * 60))
+RESERVATION_SWEEP_INTERVAL = float(os.environ.get('RESERVATION_SWEEP_INTERVAL', 30))
+RESERVATION_SWEEP_BATCH_SIZE = int(os.environ.get('RESERVATION_SWEEP_BATCH_SIZE', 500))
+# Milliseconds a reservation waits for a stock row lock before giving up
+RESERVATION_LOCK_TIMEOUT = int(os.environ.get('RESERVATION_LOCK_TIMEOUT', 2000))
+
+# Authentication: trust the is_active/is_superuser/is_verified claims of the JWT instead of
+# loading the user on every request, users loaded from the database are cached per process.
+# Routes loading the user see a change made through another process after at most the cache
+# TTL, which is capped at a tenth of the token lifetime. Trusted claims are only revoked in
+# the process that made the change, elsewhere they hold until the token expires.
+AUTH_TOKEN_LIFETIME = int(os.environ.get('AUTH_TOKEN_LIFETIME', 3600))
+AUTH_TRUST_JWT_CLAIMS = os.environ.get('AUTH_TRUST_JWT_CLAIMS', 'true').lower() in ('1', 'true', 'yes')
+AUTH_USER_CACHE_TTL = min(int(os.environ.get('AUTH_USER_CACHE_TTL', 60)), AUTH_TOKEN_LIFETIME // 10)
+AUTH_USER_CACHE_SIZE = int(os.environ.get('AUTH_USER_CACHE_SIZE', 10000))
+
+# Password hashing: bcrypt work factor (existing hashes are upgraded on login) and the
+# threads hashing passwords off the event loop
+AUTH_BCRYPT_ROUNDS = int(os.environ.get('AUTH_BCRYPT_ROUNDS', 12))
+AUTH_HASHING_WORKERS = int(os.environ.get('AUTH_HASHING_WORKERS', os.cpu_count() or 1))
+
+# Dashboard report: seconds a computed report is served as is, seconds the stock and category
+# snapshots are reused, reviews younger than DASHBOARD_REVIEW_LAG seconds wait for the next
+# refresh (so transactions committing late are not skipped) and days of the rating trend
+DASHBOARD_REFRESH_INTERVAL = int(os.environ.get('DASHBOARD_REFRESH_INTERVAL', 60))
+DASHBOARD_SNAPSHOT_TTL = int(os.environ.get('DASHBOARD_SNAPSHOT_TTL', 10 * 60))
+DASHBOARD_REVIEW_LAG = int(os.environ.get('DASHBOARD_REVIEW_LAG', 60))
+DASHBOARD_TREND_DAYS = int(os.environ.get('DASHBOARD_TREND_DAYS', 14))
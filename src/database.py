@@ -1,23 +1,151 @@
+import time
 from typing import AsyncGenerator
+from uuid import uuid4
 from sqlalchemy import MetaData
 
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import DeclarativeMeta, declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool
 
 
-from config import DB_HOST, DB_NAME, DB_PASS, DB_PORT, DB_USER
+from config import DB_HOST, DB_NAME, DB_PASS, DB_PORT, DB_USER, DB_POOL_SIZE, \
+    DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_PGBOUNCER
 
 
 DATABASE_URL = f'postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
 Base: DeclarativeMeta = declarative_base()
 metadata = MetaData()
 
-engine = create_async_engine(DATABASE_URL)
+
+class PoolMetrics:
+    '''
+    Connection acquire statistics of the pool of this worker process.
+    '''
+    # Upper bounds (seconds) of the acquire latency histogram
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.waiting = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.acquire_seconds_total = 0.0
+        self.acquire_seconds_max = 0.0
+        self.bucket_counts = [0] * len(self.BUCKETS)
+
+    def observe(self, seconds: float):
+        self.acquired += 1
+        self.acquire_seconds_total += seconds
+        self.acquire_seconds_max = max(self.acquire_seconds_max, seconds)
+        for index, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                self.bucket_counts[index] += 1
+                break
+
+
+pool_metrics = PoolMetrics()
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    '''
+    Queue pool recording how many callers wait for a connection and how long acquiring takes
+    (including pre-ping and opening new connections).
+    '''
+
+    def __init__(self, *args, max_overflow: int = 10, **kwargs):
+        super().__init__(*args, max_overflow=max_overflow, **kwargs)
+        self.overflow_limit = max_overflow
+
+    def exhausted(self) -> bool:
+        '''
+        No idle connection is left and no overflow connection may be opened:
+        a caller has to wait until a connection is returned.
+        '''
+        return self.checkedin() == 0 and -1 < self.overflow_limit <= self.overflow()
+
+    def connect(self):
+        waiting = self.exhausted()
+        if waiting:
+            pool_metrics.waiting += 1
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            pool_metrics.timeouts += 1
+            raise
+        finally:
+            if waiting:
+                pool_metrics.waiting -= 1
+        pool_metrics.observe(time.perf_counter() - started)
+        return connection
+
+
+class InstrumentedNullPool(NullPool):
+    '''
+    NullPool recording how long acquiring takes. Every checkout opens a new connection
+    (to pgbouncer), so the time is the connect time and nobody waits for the pool.
+    '''
+
+    def connect(self):
+        started = time.perf_counter()
+        connection = super().connect()
+        pool_metrics.observe(time.perf_counter() - started)
+        return connection
+
+
+def engine_options() -> dict:
+    if DB_PGBOUNCER:
+        # pgbouncer hands out server connections per transaction, prepared statements
+        # must neither be cached nor reuse names across connections
+        return {
+            'poolclass': InstrumentedNullPool,
+            'connect_args': {
+                'statement_cache_size': 0,
+                'prepared_statement_cache_size': 0,
+                'prepared_statement_name_func': lambda: f'__asyncpg_{uuid4()}__',
+            },
+        }
+    return {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+
+
+engine = create_async_engine(DATABASE_URL, **engine_options())
 async_session_maker = sessionmaker(
     engine, class_=AsyncSession, expire_on_commit=False)
 
 
+def get_pool_status() -> dict:
+    '''
+    Current saturation of the pool and acquire latency since the worker started.
+    '''
+    pool = engine.pool
+    status = {
+        'pool_class': type(pool).__name__,
+        'waiting': pool_metrics.waiting,
+        'acquired': pool_metrics.acquired,
+        'timeouts': pool_metrics.timeouts,
+        'acquire_seconds_total': round(pool_metrics.acquire_seconds_total, 6),
+        'acquire_seconds_max': round(pool_metrics.acquire_seconds_max, 6),
+        'acquire_seconds_buckets': dict(zip(PoolMetrics.BUCKETS, pool_metrics.bucket_counts)),
+    }
+    if isinstance(pool, InstrumentedQueuePool):
+        status.update({
+            'size': pool.size(),
+            'max_overflow': pool.overflow_limit,
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': pool.overflow(),
+        })
+    return status
+
+
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
     async with async_session_maker() as session:
         yield session
@@ -1,29 +1,75 @@
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from redis import asyncio as aioredis
 from fastapi_cache import FastAPICache
 from fastapi_cache.backends.redis import RedisBackend
 from fastapi_cache.decorator import cache
 
+from auth.password import password_helper
+from cache import catalog_cache
+from config import REDIS_URL
+from database import engine, get_pool_status
+from metrics import MetricsMiddleware, instrument_engine, metrics
+from shop.cart.service import cart_store
+from shop.checkout.router import invalidate_stocks
+from shop.checkout.service import ReservationSweeper
+from shop.products.stock_summary import StockSummaryFolder
 from shop.router import router as product_router
 from auth.router import router as auth_router
+from tasks.router import router as tasks_router
 
 
 app = FastAPI(
     title="BAT agregator",
     prefix='/api'
 )
+app.add_middleware(MetricsMiddleware)
+instrument_engine(engine)
+
+reservation_sweeper = ReservationSweeper(on_release=invalidate_stocks)
+stock_summary_folder = StockSummaryFolder(on_fold=invalidate_stocks)
 
 
 @app.on_event("startup")
 async def startap_event():
     redis = aioredis.from_url(
-        'redis://127.0.0.1', encoding='utf8', decode_responses=True)
+        REDIS_URL, encoding='utf8', decode_responses=True)
     FastAPICache.init(RedisBackend(redis), prefix="fastapi-cache")
+    catalog_cache.init(redis)
+    cart_store.init(redis)
+    cart_store.start()
+    reservation_sweeper.start()
+    stock_summary_folder.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await stock_summary_folder.stop()
+    await reservation_sweeper.stop()
+    await cart_store.stop()
+    password_helper.shutdown()
 
 app.include_router(auth_router)
 app.include_router(product_router)
+app.include_router(tasks_router)
 
 
 @app.get("/")
 async def gel_main():
     return {'message': 'Hello World'}
+
+
+@app.get("/health/db-pool")
+async def get_db_pool_status():
+    '''
+    Checked out and waiting connections and acquire latency of this worker's pool
+    '''
+    return get_pool_status()
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics():
+    '''
+    Request latency, SQL statements per request and pool statistics of this worker in the Prometheus text format
+    '''
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
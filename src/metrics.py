@@ -0,0 +1,214 @@
+'''
+Request and SQL metrics of this worker process in the Prometheus text format.
+
+MetricsMiddleware times every request per route template and, through the engine
+events installed by instrument_engine(), counts the SQL statements a request ran
+and the time they took. render() also exports the connection pool statistics.
+'''
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from database import PoolMetrics, get_pool_status, pool_metrics
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SQL_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Label of requests no route matched, keeps scanners from creating a series per path
+UNMATCHED_ROUTE = '<unmatched>'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    '''
+    Prometheus histogram with one series per label set.
+    '''
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float]):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._series: Dict[Labels, list] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        series = self._series.get(labels)
+        if series is None:
+            # Bucket counts (not cumulative yet), sum, count
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket{format_labels(labels + (("le", format_value(bound)),))} {cumulative}'
+            yield f'{self.name}_sum{format_labels(labels)} {format_value(total)}'
+            yield f'{self.name}_count{format_labels(labels)} {count}'
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        name + '="' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def sample(name: str, kind: str, documentation: str, value: float) -> List[str]:
+    return [f'# HELP {name} {documentation}', f'# TYPE {name} {kind}', f'{name} {format_value(value)}']
+
+
+class RequestStats:
+    '''
+    SQL statements run while handling one request.
+    '''
+    __slots__ = ('statements', 'sql_seconds')
+
+    def __init__(self):
+        self.statements = 0
+        self.sql_seconds = 0.0
+
+
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar('request_stats', default=None)
+
+
+class Metrics:
+    def __init__(self):
+        self.in_flight = 0
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.request_duration = Histogram(
+            'http_request_duration_seconds', 'Time to handle a request.', LATENCY_BUCKETS)
+        self.request_statements = Histogram(
+            'http_request_sql_statements', 'SQL statements run per request.', STATEMENT_BUCKETS)
+        self.request_sql_duration = Histogram(
+            'http_request_sql_duration_seconds', 'Time spent in SQL statements per request.',
+            SQL_LATENCY_BUCKETS)
+
+    def observe_statement(self, seconds: float):
+        self.statements += 1
+        self.sql_seconds += seconds
+        stats = request_stats.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.sql_seconds += seconds
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float, stats: RequestStats):
+        labels = (('method', method), ('route', route))
+        self.request_duration.observe(seconds, labels + (('status', str(status)),))
+        self.request_statements.observe(stats.statements, labels)
+        self.request_sql_duration.observe(stats.sql_seconds, labels)
+
+    def render(self) -> str:
+        lines = [
+            *sample('http_requests_in_flight', 'gauge', 'Requests being handled.', self.in_flight),
+            *self.request_duration.render(),
+            *self.request_statements.render(),
+            *self.request_sql_duration.render(),
+            *sample('db_statements_total', 'counter', 'SQL statements run, requests and background tasks.',
+                    self.statements),
+            *sample('db_statement_duration_seconds_total', 'counter', 'Time spent in SQL statements.',
+                    self.sql_seconds),
+            *render_pool(),
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+def render_pool() -> List[str]:
+    status = get_pool_status()
+    lines = []
+    for key, kind, documentation in (
+        ('size', 'gauge', 'Connections the pool keeps open.'),
+        ('checked_out', 'gauge', 'Connections in use.'),
+        ('overflow', 'gauge', 'Connections opened beyond the pool size.'),
+        ('waiting', 'gauge', 'Callers waiting for a connection.'),
+        ('timeouts', 'counter', 'Connection acquires that timed out.'),
+    ):
+        if key in status:
+            name = f'db_pool_{key}_total' if kind == 'counter' else f'db_pool_{key}'
+            # SQLAlchemy reports a negative overflow while the pool is not full yet
+            lines += sample(name, kind, documentation, max(status[key], 0))
+
+    name = 'db_pool_acquire_seconds'
+    lines += [f'# HELP {name} Time to acquire a connection.', f'# TYPE {name} histogram']
+    cumulative = 0
+    for bound, count in zip(PoolMetrics.BUCKETS, pool_metrics.bucket_counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{le="{format_value(bound)}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{le="+Inf"}} {pool_metrics.acquired}')
+    lines.append(f'{name}_sum {format_value(pool_metrics.acquire_seconds_total)}')
+    lines.append(f'{name}_count {pool_metrics.acquired}')
+    return lines
+
+
+metrics = Metrics()
+
+
+def instrument_engine(engine: AsyncEngine):
+    '''
+    Time every statement of the engine, per connection since statements of one
+    connection never overlap.
+    '''
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info['statement_started'] = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop('statement_started', None)
+        if started is not None:
+            metrics.observe_statement(time.perf_counter() - started)
+
+
+class MetricsMiddleware:
+    '''
+    ASGI middleware recording latency, status and SQL statements per route template.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        metrics.in_flight += 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            metrics.in_flight -= 1
+            request_stats.reset(token)
+            route = scope.get('route')
+            metrics.observe_request(
+                scope['method'], route.path if route is not None else UNMATCHED_ROUTE,
+                status, time.perf_counter() - started, stats)
@@ -0,0 +1,82 @@
+import base64
+import binascii
+import json
+from typing import Any, Callable, List, Optional, Sequence
+
+from fastapi import HTTPException
+from sqlalchemy import tuple_
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    '''
+    Pack the sort key values of the last row of a page into an opaque cursor.
+    '''
+    payload = json.dumps(list(values), separators=(',', ':'), default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def parse_int(value: Any) -> int:
+    '''
+    Cursor value parser for integer (bigint) keys.
+    '''
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise TypeError(f'Not an integer: {value!r}')
+    value = int(value)
+    if not -2 ** 63 <= value < 2 ** 63:
+        raise ValueError(f'Out of range: {value}')
+    return value
+
+
+def invalid_cursor() -> HTTPException:
+    return HTTPException(status_code=400, detail={
+        'status': 'error',
+        'data': None,
+        'details': 'Invalid cursor'
+    })
+
+
+def decode_cursor(cursor: str, size: int, parsers: Optional[Sequence[Callable]] = None) -> List[Any]:
+    '''
+    Unpack a cursor created by encode_cursor and convert its values with parsers.
+    Raises 400 for malformed cursors and values the parsers reject.
+    '''
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, ValueError):
+        values = None
+
+    if not isinstance(values, list) or len(values) != size:
+        raise invalid_cursor()
+    if parsers:
+        try:
+            values = [parse(value) for parse, value in zip(parsers, values)]
+        except (ValueError, TypeError, ArithmeticError):
+            raise invalid_cursor()
+    return values
+
+
+def apply_keyset(query, keys: Sequence, cursor: Optional[str], limit: int,
+                 descending: bool = False, parsers: Optional[Sequence[Callable]] = None):
+    '''
+    Restrict the query to rows after the cursor and order it by the keyset.
+    One extra row is fetched so split_page can tell whether a next page exists.
+    '''
+    if cursor is not None:
+        values = decode_cursor(cursor, len(keys), parsers)
+        bound = tuple_(*keys)
+        query = query.where(
+            bound < tuple_(*values) if descending else bound > tuple_(*values))
+
+    order = [key.desc() for key in keys] if descending else list(keys)
+    return query.order_by(*order).limit(limit + 1)
+
+
+def split_page(items: Sequence, limit: int, key: Callable[[Any], Sequence[Any]]):
+    '''
+    Drop the look-ahead row and build the cursor of the next page.
+    '''
+    if len(items) <= limit:
+        return list(items), None
+    items = list(items[:limit])
+    return items, encode_cursor(key(items[-1]))
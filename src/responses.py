@@ -1,13 +1,30 @@
 from fastapi.responses import JSONResponse
-from typing import Any
+from pydantic import BaseModel
+from typing import Any, Optional, Type
+
+from serializers import dumps, encode
 
 
 class ResponseData(JSONResponse):
-    def __init__(self, data: Any = None, status_code: int = 200, details: str = "success"):
+    '''
+    Success envelope rendered with orjson.
+    With a schema the ORM data is encoded by the compiled encoder of that schema,
+    so routes returning ResponseData skip pydantic validation of response_model.
+    '''
+
+    def __init__(self, data: Any = None, status_code: int = 200, details: str = "success",
+                 next_cursor: Optional[str] = None, schema: Optional[Type[BaseModel]] = None):
         if data is None:
             raise ValueError("Data cannot be None")
+        if schema is not None:
+            data = encode(data, schema)
         content = {
             "details": details,
             "result": data
         }
+        if next_cursor is not None:
+            content["next_cursor"] = next_cursor
         super().__init__(content=content, status_code=status_code)
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -19,6 +19,8 @@ class Response(GenericModel, Generic[DataT]):
     status: Represents the status of the response (e.g., "success", "error").
     result: Represents the actual data being returned. It uses the DataT type parameter, allowing you to specify the specific model you want to use.
     details: Represents additional details or information about the response. It is optional and can be None.
+    next_cursor: Opaque cursor of the next page for paginated lists. None on the last page.
     '''
     result: DataT
     details: Optional[str] = None
+    next_cursor: Optional[str] = None
@@ -0,0 +1,87 @@
+from decimal import Decimal
+from typing import Any, Callable, Dict, Optional, Type
+
+import orjson
+from pydantic import BaseModel
+from pydantic.fields import ModelField, SHAPE_SINGLETON, SHAPE_LIST, SHAPE_SEQUENCE, \
+    SHAPE_TUPLE_ELLIPSIS
+from sqlalchemy import inspect
+
+
+Encoder = Callable[[Any], Any]
+
+LIST_SHAPES = (SHAPE_LIST, SHAPE_SEQUENCE, SHAPE_TUPLE_ELLIPSIS)
+
+_encoders: Dict[Type[BaseModel], Encoder] = {}
+
+
+def default(obj: Any) -> Any:
+    '''
+    orjson fallback for values no compiled encoder took care of.
+    Decimals are money amounts and are kept exact as strings.
+    '''
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if hasattr(obj, '__mapper__'):
+        # Loaded column values of an ORM object, never triggers lazy loading
+        state = inspect(obj)
+        unloaded = state.unloaded
+        return {
+            attr.key: getattr(obj, attr.key)
+            for attr in state.mapper.column_attrs if attr.key not in unloaded
+        }
+    raise TypeError(f'Type is not JSON serializable: {type(obj).__name__}')
+
+
+def _value_encoder(field: ModelField) -> Optional[Encoder]:
+    type_ = field.type_
+    if isinstance(type_, type) and issubclass(type_, BaseModel):
+        item = compile_encoder(type_)
+    elif type_ is float:
+        item = float
+    else:
+        return None
+
+    if field.shape == SHAPE_SINGLETON:
+        return lambda value: None if value is None else item(value)
+    if field.shape in LIST_SHAPES:
+        return lambda values: None if values is None else [item(value) for value in values]
+    return None
+
+
+def compile_encoder(schema: Type[BaseModel]) -> Encoder:
+    '''
+    Build (once per schema) a function turning an ORM object into a dict with the
+    fields of the schema, ready for orjson. Nested schemas get their own encoders.
+    '''
+    if schema in _encoders:
+        return _encoders[schema]
+
+    fields = [
+        (field.alias, field.name, field.default, _value_encoder(field))
+        for field in schema.__fields__.values()
+    ]
+
+    def encode(obj: Any) -> dict:
+        content = {}
+        for alias, name, field_default, encode_value in fields:
+            value = getattr(obj, name, field_default)
+            content[alias] = value if encode_value is None else encode_value(value)
+        return content
+
+    _encoders[schema] = encode
+    return encode
+
+
+def encode(data: Any, schema: Type[BaseModel]) -> Any:
+    '''
+    Encode an ORM object or a list of them with the compiled encoder of the schema.
+    '''
+    encoder = compile_encoder(schema)
+    if isinstance(data, (list, tuple)):
+        return [encoder(item) for item in data]
+    return encoder(data)
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=default)
@@ -23,7 +23,7 @@ class Cart(Base):
         ForeignKey('product.id', ondelete='CASCADE')
     )
     user_id: Mapped[int] = mapped_column(
-        ForeignKey('user.id', ondelete='CASCADE')
+        ForeignKey('user.id', ondelete='CASCADE'), index=True
     )
     amount: Mapped[int] = mapped_column(Integer, default=1)
 
@@ -3,16 +3,20 @@ from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import selectinload, aliased
-from sqlalchemy import select, delete
+from sqlalchemy import select, delete, func
 from fastapi_cache.decorator import cache
+from redis.exceptions import RedisError
 from schemas import Response
+from responses import ResponseData
 
 from database import get_async_session
 from auth.models import User
-from auth.base_config import current_user
+from auth.base_config import current_db_user, current_user
 from shop.cart import utils as ut
 from shop.cart import models as md
 from shop.cart import schemas as sc
+from shop.cart.service import cart_store
+from shop.products.models import Product
 
 
 router = APIRouter(
@@ -20,31 +24,136 @@ router = APIRouter(
     tags=['Shop[Cart]']
 )
 
-# response_model=Response[sc.Cart]
-@router.get('/cart/list')
+async def check_product(product_id: int, session: AsyncSession):
+    product_id = await session.scalar(select(Product.id).where(
+        Product.id == product_id, Product.is_active == True))
+    if product_id is None:
+        raise HTTPException(status_code=404, detail={
+            'status': 'error',
+            'data': None,
+            'details': 'Product not found'
+        })
+
+
+def cart_unavailable(e: Exception) -> HTTPException:
+    return HTTPException(status_code=503, detail={
+        'status': 'error',
+        'data': None,
+        'details': f'Cart is unavailable: {e}'
+    })
+
+
+@router.get('/cart/list', response_model=Response[List[sc.CartItem]])
 async def get_cart_by_user(user:  User = Depends(current_user), session: AsyncSession = Depends(get_async_session)):
     '''
     Retrieving a list of products in the shopping cart for the currently authenticated user.
     '''
-    try: 
-        query = select(md.Cart).where(md.Cart.user_id == user.id)
-        result = await session.execute(query)
-        products = result.scalars().all()
-
-
-        return {
-            'status': 'success',
-            'data': products,
-            'details': None
-        }
-    except Exception as e:
+    try:
+        items = await cart_store.get(user.id)
+    except RedisError:
+        # Without Redis the last flushed cart is the best answer
+        query = select(md.Cart.product_id, func.sum(md.Cart.amount)).where(
+            md.Cart.user_id == user.id).group_by(md.Cart.product_id)
+        items = dict((await session.execute(query)).all())
+
+    return ResponseData([
+        {'product_id': product_id, 'amount': amount}
+        for product_id, amount in sorted(items.items())
+    ])
+
+
+@router.get('/cart/summary', response_model=Response[sc.CartSummary])
+async def get_cart_summary(user: User = Depends(current_user), session: AsyncSession = Depends(get_async_session)):
+    '''
+    Priced cart of the current user: line items with unit prices, category discounts and totals
+    '''
+    try:
+        items = await cart_store.get(user.id)
+    except RedisError as e:
+        raise cart_unavailable(e)
+
+    try:
+        return ResponseData(await ut.get_cart_summary(items, session))
+    except SQLAlchemyError as e:
         raise HTTPException(status_code=500, detail={
             'status': 'error',
             'data': None,
-            'details': str(e)
+            'details': str(e.__dict__['orig'])
         })
 
 
+@router.post('/cart/add', response_model=Response[sc.CartItem])
+async def add_to_cart(
+    item: sc.CartItemAdd,
+    user: User = Depends(current_db_user),
+    session: AsyncSession = Depends(get_async_session)
+):
+    '''
+    Add amount (may be negative) of a product to the cart of the current user
+    '''
+    try:
+        if item.amount > 0 and not await cart_store.contains(user.id, item.product_id):
+            await check_product(item.product_id, session)
+        amount = await cart_store.add(user.id, item.product_id, item.amount)
+    except RedisError as e:
+        raise cart_unavailable(e)
+
+    return ResponseData({'product_id': item.product_id, 'amount': amount})
+
+
+@router.patch('/cart/update', response_model=Response[sc.CartItem])
+async def update_cart_item(
+    item: sc.CartItemUpdate,
+    user: User = Depends(current_db_user),
+    session: AsyncSession = Depends(get_async_session)
+):
+    '''
+    Set the amount of a product in the cart of the current user, 0 removes it
+    '''
+    try:
+        if item.amount > 0 and not await cart_store.contains(user.id, item.product_id):
+            await check_product(item.product_id, session)
+        await cart_store.set(user.id, item.product_id, item.amount)
+    except RedisError as e:
+        raise cart_unavailable(e)
+
+    return ResponseData({'product_id': item.product_id, 'amount': item.amount})
+
+
+@router.delete('/cart/delete/{product_id}')
+async def delete_cart_item(product_id: int, user: User = Depends(current_db_user)):
+    '''
+    Remove a product from the cart of the current user
+    '''
+    try:
+        await cart_store.set(user.id, product_id, 0)
+    except RedisError as e:
+        raise cart_unavailable(e)
+
+    return {
+        'status': 'success',
+        'data': f'Deleted product_id = {product_id} from cart',
+        'details': None
+    }
+
+
+@router.delete('/cart/clear')
+async def clear_cart(user: User = Depends(current_db_user)):
+    '''
+    Remove every product from the cart of the current user
+    '''
+    try:
+        await cart_store.clear(user.id)
+    except RedisError as e:
+        raise cart_unavailable(e)
+
+    return {
+        'status': 'success',
+        'data': 'Cart cleared',
+        'details': None
+    }
+
+
 
 
 # @router.get('/products/{product_id}', response_model=sc.Response[sc.Product])
@@ -1,4 +1,7 @@
-from typing import Optional
+from decimal import Decimal
+from typing import List, Optional
+from pydantic import conint
+from config import MAX_CART_AMOUNT
 from schemas import BaseOrmModel
 import json
 
@@ -23,3 +26,38 @@ class CartCreate(CartBase):
 
 class Cart(CartBase):
     id: int
+
+
+class CartItem(BaseOrmModel):
+    product_id: int
+    amount: int
+
+
+class CartItemAdd(BaseOrmModel):
+    product_id: int
+    amount: conint(ge=-MAX_CART_AMOUNT, le=MAX_CART_AMOUNT) = 1
+
+
+class CartItemUpdate(BaseOrmModel):
+    product_id: int
+    amount: conint(ge=0, le=MAX_CART_AMOUNT)
+
+
+class CartLine(BaseOrmModel):
+    product_id: int
+    name: str
+    articul: str
+    amount: int
+    unit_price: Decimal
+    discount_percent: int
+    unit_discount: Decimal
+    line_total: Decimal
+
+
+class CartSummary(BaseOrmModel):
+    items: List[CartLine]
+    items_count: int
+    subtotal: Decimal
+    discount_total: Decimal
+    total: Decimal
+    unavailable_product_ids: List[int]
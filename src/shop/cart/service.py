@@ -0,0 +1,240 @@
+import asyncio
+import logging
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import delete, func, select, text
+
+from config import CART_TTL, CART_FLUSH_INTERVAL, CART_FLUSH_BATCH_SIZE, MAX_CART_AMOUNT
+from database import async_session_maker
+from shop.cart import models as md
+
+
+logger = logging.getLogger(__name__)
+
+# Present in every loaded cart hash, so an empty cart is not reloaded from Postgres
+LOADED_FIELD = '__loaded__'
+# Namespace of the advisory locks serialising flushes of the same cart
+FLUSH_LOCK_NAMESPACE = 7001
+# Head of the write scripts: a hash without LOADED_FIELD expired (or was never loaded), then
+# nothing is written and nil tells the caller to load the cart and retry. Otherwise the TTL
+# is refreshed and the cart marked dirty in the same step as the write, so a write never
+# creates a hash that has no TTL and does not hold the whole cart.
+# KEYS: cart, dirty set. ARGV: LOADED_FIELD, ttl, user id, product id, amount, ...
+WRITE_SCRIPT_HEAD = '''
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return false
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('SADD', KEYS[2], ARGV[3])
+'''
+# Increments an amount, capped at ARGV[6], and drops the product once it reaches zero
+ADD_SCRIPT = WRITE_SCRIPT_HEAD + '''
+local total = redis.call('HINCRBY', KEYS[1], ARGV[4], ARGV[5])
+if total <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[4])
+    total = 0
+elseif total > tonumber(ARGV[6]) then
+    total = tonumber(ARGV[6])
+    redis.call('HSET', KEYS[1], ARGV[4], total)
+end
+return total
+'''
+SET_SCRIPT = WRITE_SCRIPT_HEAD + '''
+if tonumber(ARGV[5]) > 0 then
+    redis.call('HSET', KEYS[1], ARGV[4], ARGV[5])
+else
+    redis.call('HDEL', KEYS[1], ARGV[4])
+end
+return 1
+'''
+
+
+class CartStore:
+    '''
+    Hot copy of the carts in Redis, one hash {product_id: amount} per user.
+
+    Reads and increments only touch Redis. Changed carts are collected in a dirty set
+    and written back to the cart table in batches by flush(), which the task of start()
+    runs every CART_FLUSH_INTERVAL seconds. The cart table stays the durable copy:
+    a cart missing in Redis is loaded from it on first access.
+    '''
+
+    def __init__(self, prefix: str = 'cart', ttl: int = CART_TTL,
+                 flush_interval: float = CART_FLUSH_INTERVAL, batch_size: int = CART_FLUSH_BATCH_SIZE,
+                 max_amount: int = MAX_CART_AMOUNT):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_amount = max_amount
+        self.redis = None
+        self._add_script = None
+        self._set_script = None
+        self._flusher: Optional[asyncio.Task] = None
+
+    def init(self, redis):
+        self.redis = redis
+        self._add_script = redis.register_script(ADD_SCRIPT)
+        self._set_script = redis.register_script(SET_SCRIPT)
+
+    def _key(self, user_id: int) -> str:
+        return f'{self.prefix}:{user_id}'
+
+    @property
+    def _dirty_key(self) -> str:
+        return f'{self.prefix}:dirty'
+
+    @staticmethod
+    def _items(values: Dict[str, str]) -> Dict[int, int]:
+        return {int(product_id): int(amount) for product_id, amount in values.items()
+                if product_id != LOADED_FIELD}
+
+    async def _load(self, user_id: int):
+        if await self.redis.expire(self._key(user_id), self.ttl):
+            return
+        await self._fill(user_id)
+
+    async def _fill(self, user_id: int):
+        '''
+        Copy the cart of the user from the cart table into Redis.
+        '''
+        key = self._key(user_id)
+        async with async_session_maker() as session:
+            result = await session.execute(
+                select(md.Cart.product_id, func.sum(md.Cart.amount))
+                .where(md.Cart.user_id == user_id).group_by(md.Cart.product_id))
+            rows = result.all()
+
+        # HSETNX keeps changes made by a concurrent request that loaded the cart first
+        pipe = self.redis.pipeline()
+        for product_id, amount in rows:
+            pipe.hsetnx(key, product_id, amount)
+        pipe.hsetnx(key, LOADED_FIELD, 1)
+        pipe.expire(key, self.ttl)
+        await pipe.execute()
+
+    async def get(self, user_id: int) -> Dict[int, int]:
+        await self._load(user_id)
+        return self._items(await self.redis.hgetall(self._key(user_id)))
+
+    async def contains(self, user_id: int, product_id: int) -> bool:
+        await self._load(user_id)
+        return await self.redis.hexists(self._key(user_id), product_id)
+
+    async def _write(self, script, user_id: int, *args) -> int:
+        '''
+        Run a write script on the cart of the user, loading the cart first when Redis lost it.
+        '''
+        keys = [self._key(user_id), self._dirty_key]
+        args = [LOADED_FIELD, self.ttl, user_id, *args]
+        result = await script(keys=keys, args=args)
+        while result is None:
+            await self._fill(user_id)
+            result = await script(keys=keys, args=args)
+        return int(result)
+
+    async def add(self, user_id: int, product_id: int, amount: int) -> int:
+        '''
+        Change the amount of a product by amount, the product is removed once it drops to zero.
+        '''
+        return await self._write(self._add_script, user_id, product_id, amount, self.max_amount)
+
+    async def set(self, user_id: int, product_id: int, amount: int):
+        await self._write(self._set_script, user_id, product_id, amount)
+
+    async def clear(self, user_id: int):
+        key = self._key(user_id)
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        pipe.hset(key, LOADED_FIELD, 1)
+        pipe.expire(key, self.ttl)
+        pipe.sadd(self._dirty_key, user_id)
+        await pipe.execute()
+
+    async def flush(self, user_ids: Optional[Iterable[int]] = None) -> int:
+        '''
+        Write dirty carts back to the cart table: the given users, or the next batch of
+        the dirty set. Returns the number of carts written.
+        '''
+        if user_ids is None:
+            members = await self.redis.spop(self._dirty_key, self.batch_size)
+        else:
+            members = list(user_ids)
+            if members:
+                await self.redis.srem(self._dirty_key, *members)
+        ids: List[int] = sorted({int(user_id) for user_id in members or []})
+        if not ids:
+            return 0
+
+        try:
+            async with async_session_maker() as session:
+                async with session.begin():
+                    # Concurrent flushes of a cart commit in the order they read it from Redis
+                    for user_id in ids:
+                        await session.execute(select(func.pg_advisory_xact_lock(
+                            FLUSH_LOCK_NAMESPACE, user_id)))
+
+                    pipe = self.redis.pipeline()
+                    for user_id in ids:
+                        pipe.hgetall(self._key(user_id))
+                    carts = dict(zip(ids, await pipe.execute()))
+                    # An expired hash has nothing newer than the table
+                    carts = {user_id: self._items(values)
+                             for user_id, values in carts.items() if LOADED_FIELD in values}
+                    if not carts:
+                        return 0
+
+                    rows = []
+                    for user_id, items in carts.items():
+                        for product_id, amount in items.items():
+                            # One amount the column cannot hold would fail the whole batch
+                            if 0 < amount <= self.max_amount:
+                                rows.append((user_id, product_id, amount))
+                            else:
+                                logger.warning('Dropping amount %s of product %s from the cart of user %s',
+                                               amount, product_id, user_id)
+                    await session.execute(delete(md.Cart).where(md.Cart.user_id.in_(list(carts))))
+                    if rows:
+                        users, products, amounts = (list(column) for column in zip(*rows))
+                        # Products and users deleted in the meantime are dropped instead of failing the batch
+                        await session.execute(text(
+                            'INSERT INTO cart (user_id, product_id, amount) '
+                            'SELECT t.user_id, t.product_id, t.amount '
+                            'FROM unnest(CAST(:users AS integer[]), CAST(:products AS integer[]), '
+                            'CAST(:amounts AS integer[])) AS t(user_id, product_id, amount) '
+                            'JOIN product ON product.id = t.product_id '
+                            'JOIN "user" ON "user".id = t.user_id'
+                        ), {'users': users, 'products': products, 'amounts': amounts})
+            return len(carts)
+        except Exception:
+            # Connection failures surface as OSError/TimeoutError too, the carts stay dirty either way
+            await self.redis.sadd(self._dirty_key, *ids)
+            raise
+
+    async def flush_all(self):
+        while await self.redis.scard(self._dirty_key):
+            await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush_all()
+            except Exception:
+                logger.exception('Cart flush failed, retrying in %ss', self.flush_interval)
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        try:
+            await self.flush_all()
+        except Exception:
+            logger.exception('Final cart flush failed, carts stay dirty in Redis')
+
+
+cart_store = CartStore()
@@ -0,0 +1,69 @@
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from shop.products import models as product_md
+
+
+CENT = Decimal('0.01')
+
+
+def to_money(value: Decimal) -> Decimal:
+    return value.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+async def get_cart_summary(items: Dict[int, int], session: AsyncSession) -> dict:
+    '''
+    Price the cart {product_id: amount} with one query over product and category.
+    Discounts are the percentage of the product's category, rounded per unit.
+    Products that were deleted or deactivated are reported in unavailable_product_ids.
+    Every amount is quantized to cents, the responses render them as exact strings.
+    '''
+    lines = []
+    subtotal = discount_total = Decimal(0)
+    if items:
+        query = select(
+            product_md.Product.id,
+            product_md.Product.name,
+            product_md.Product.articul,
+            product_md.Product.price,
+            product_md.Category.discount,
+        ).outerjoin(product_md.Category, product_md.Category.id == product_md.Product.category_id).where(
+            product_md.Product.id.in_(list(items)),
+            product_md.Product.is_active == True).order_by(product_md.Product.id)
+        rows = (await session.execute(query)).all()
+    else:
+        rows = []
+
+    for product_id, name, articul, price, discount in rows:
+        amount = items[product_id]
+        unit_price = to_money(Decimal(price or 0))
+        discount_percent = discount or 0
+        unit_discount = to_money(unit_price * discount_percent / 100)
+        line_subtotal = to_money(unit_price * amount)
+        line_discount = to_money(unit_discount * amount)
+
+        lines.append({
+            'product_id': product_id,
+            'name': name,
+            'articul': articul,
+            'amount': amount,
+            'unit_price': unit_price,
+            'discount_percent': discount_percent,
+            'unit_discount': unit_discount,
+            'line_total': line_subtotal - line_discount,
+        })
+        subtotal += line_subtotal
+        discount_total += line_discount
+
+    priced = {line['product_id'] for line in lines}
+    return {
+        'items': lines,
+        'items_count': sum(line['amount'] for line in lines),
+        'subtotal': to_money(subtotal),
+        'discount_total': to_money(discount_total),
+        'total': to_money(subtotal - discount_total),
+        'unavailable_product_ids': sorted(set(items) - priced),
+    }
@@ -0,0 +1,73 @@
+from datetime import datetime
+from typing import List
+from enum import Enum
+
+from sqlalchemy import Integer, ForeignKey, Enum as EnumType, DateTime, Index, func, text
+from sqlalchemy.orm import Mapped, mapped_column, relationship
+from auth.models import User
+from shop.products.models import Product, Stock
+
+from database import Base, metadata
+
+
+class Reservation(Base):
+    '''
+    Stock held for a checkout. Active reservations past expires_at are released by the sweeper.
+    '''
+    class Status(Enum):
+        active = 'active'
+        completed = 'completed'
+        released = 'released'
+        expired = 'expired'
+
+    __tablename__ = 'reservation'
+    __table_args__ = (
+        # The sweeper only scans active reservations by expiry
+        Index('ix_reservation_active_expires_at', 'expires_at',
+              postgresql_where=text("status = 'active'")),
+    )
+
+    metadata = metadata
+
+    id: Mapped[int] = mapped_column(
+        Integer, primary_key=True
+    )
+    user_id: Mapped[int] = mapped_column(
+        ForeignKey('user.id', ondelete='CASCADE'), index=True
+    )
+    status: Mapped[Status] = mapped_column(
+        EnumType(Status, name='reservation_status'), default=Status.active, nullable=False
+    )
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime, default=func.now(), nullable=False)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    items: Mapped[List['ReservationItem']] = relationship(
+        'ReservationItem', back_populates='reservation')
+
+    def __repr__(self) -> str:
+        return f'Reservation(id={self.id!r}, user_id={self.user_id!r}, status={self.status!r})'
+
+
+class ReservationItem(Base):
+    __tablename__ = 'reservation_item'
+
+    metadata = metadata
+
+    id: Mapped[int] = mapped_column(
+        Integer, primary_key=True
+    )
+    reservation_id: Mapped[int] = mapped_column(
+        ForeignKey('reservation.id', ondelete='CASCADE'), index=True
+    )
+    stock_id: Mapped[int] = mapped_column(
+        ForeignKey('stock.id', ondelete='CASCADE'), index=True
+    )
+    product_id: Mapped[int] = mapped_column(
+        ForeignKey('product.id', ondelete='CASCADE')
+    )
+    warehouse_id: Mapped[int] = mapped_column(Integer)
+    quantity: Mapped[int] = mapped_column(Integer)
+
+    reservation: Mapped['Reservation'] = relationship(
+        'Reservation', back_populates='items')
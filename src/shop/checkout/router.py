@@ -0,0 +1,140 @@
+import logging
+
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import SQLAlchemyError
+from redis.exceptions import RedisError
+from schemas import Response
+from responses import ResponseData
+from cache import catalog_cache
+
+from database import get_async_session
+from auth.models import User
+from auth.base_config import current_db_user
+from shop.cart.service import cart_store
+from shop.checkout import service
+from shop.checkout import schemas as sc
+
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    prefix='',
+    tags=['Shop[Checkout]']
+)
+
+
+async def invalidate_stocks(product_ids):
+    await catalog_cache.invalidate(*(f'stock:{product_id}' for product_id in product_ids))
+
+
+def reservation_not_found(reservation_id: int) -> HTTPException:
+    return HTTPException(status_code=404, detail={
+        'status': 'error',
+        'data': None,
+        'details': f'No active reservation {reservation_id}'
+    })
+
+
+@router.post('/checkout/reserve', response_model=Response[sc.Reservation])
+async def reserve_cart(user: User = Depends(current_db_user), session: AsyncSession = Depends(get_async_session)):
+    '''
+    Reserve the stock of every product in the cart of the current user.
+    The reservation is released automatically once it expires.
+    '''
+    try:
+        items = await cart_store.get(user.id)
+    except RedisError as e:
+        raise HTTPException(status_code=503, detail={
+            'status': 'error',
+            'data': None,
+            'details': f'Cart is unavailable: {e}'
+        })
+    if not items:
+        raise HTTPException(status_code=400, detail={
+            'status': 'error',
+            'data': None,
+            'details': 'Cart is empty'
+        })
+
+    try:
+        reservation, replaced_product_ids = await service.reserve(user.id, items, session)
+    except service.OutOfStock as e:
+        raise HTTPException(status_code=409, detail={
+            'status': 'error',
+            'data': {'product_id': e.product_id, 'requested': e.requested, 'available': e.available},
+            'details': str(e)
+        })
+    except SQLAlchemyError as e:
+        if service.is_lock_timeout(e):
+            raise HTTPException(status_code=409, detail={
+                'status': 'error',
+                'data': None,
+                'details': 'Stock is busy, retry the checkout'
+            })
+        raise HTTPException(status_code=500, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(getattr(e, 'orig', e))
+        })
+
+    # Lists show stock sums too but are left to expire, a hot product would flush them on every checkout
+    await invalidate_stocks({*items, *replaced_product_ids})
+    return ResponseData(reservation, schema=sc.Reservation)
+
+
+@router.post('/checkout/{reservation_id}/complete', response_model=Response[sc.Reservation])
+async def complete_reservation(
+    reservation_id: int,
+    user: User = Depends(current_db_user),
+    session: AsyncSession = Depends(get_async_session)
+):
+    '''
+    Complete the checkout: the reserved stock is sold and the cart is emptied
+    '''
+    try:
+        reservation = await service.complete(reservation_id, user.id, session)
+    except service.ReservationNotFound:
+        raise reservation_not_found(reservation_id)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(getattr(e, 'orig', e))
+        })
+
+    try:
+        await cart_store.clear(user.id)
+    except RedisError:
+        # The sale is already committed, a stale cart must not turn it into an error
+        logger.exception('Could not clear the cart of user %s after reservation %s', user.id, reservation_id)
+    await session.refresh(reservation, ['items'])
+    return ResponseData(reservation, schema=sc.Reservation)
+
+
+@router.delete('/checkout/{reservation_id}')
+async def release_reservation(
+    reservation_id: int,
+    user: User = Depends(current_db_user),
+    session: AsyncSession = Depends(get_async_session)
+):
+    '''
+    Cancel the checkout and give the reserved stock back
+    '''
+    try:
+        product_ids = await service.release(reservation_id, user.id, session)
+    except service.ReservationNotFound:
+        raise reservation_not_found(reservation_id)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(getattr(e, 'orig', e))
+        })
+
+    await invalidate_stocks(product_ids)
+    return {
+        'status': 'success',
+        'data': f'Released reservation.id = {reservation_id}',
+        'details': None
+    }
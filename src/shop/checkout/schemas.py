@@ -0,0 +1,18 @@
+from datetime import datetime
+from typing import List
+
+from schemas import BaseOrmModel
+
+
+class ReservationItem(BaseOrmModel):
+    product_id: int
+    warehouse_id: int
+    quantity: int
+
+
+class Reservation(BaseOrmModel):
+    id: int
+    status: str
+    created_at: datetime
+    expires_at: datetime
+    items: List[ReservationItem]
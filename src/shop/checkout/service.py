@@ -0,0 +1,292 @@
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, insert, select, text, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+
+from config import RESERVATION_TTL, RESERVATION_SWEEP_INTERVAL, RESERVATION_SWEEP_BATCH_SIZE, \
+    RESERVATION_LOCK_TIMEOUT
+from database import async_session_maker
+from shop.checkout import models as md
+from shop.products import models as product_md
+
+
+logger = logging.getLogger(__name__)
+
+# (stock_id, warehouse_id, quantity) taken from one stock row
+Allocation = Tuple[int, int, int]
+
+
+class OutOfStock(Exception):
+    def __init__(self, product_id: int, requested: int, available: int):
+        super().__init__(
+            f'Not enough stock of product {product_id}: requested {requested}, available {available}')
+        self.product_id = product_id
+        self.requested = requested
+        self.available = available
+
+
+class ReservationNotFound(Exception):
+    pass
+
+
+def is_lock_timeout(e: SQLAlchemyError) -> bool:
+    '''
+    True when a statement gave up waiting for a row lock (lock_timeout, SQLSTATE 55P03).
+    '''
+    orig = getattr(e, 'orig', None)
+    return '55P03' in (getattr(orig, 'sqlstate', None), getattr(orig, 'pgcode', None),
+                       getattr(getattr(orig, '__cause__', None), 'sqlstate', None))
+
+
+async def end_transaction(session: AsyncSession):
+    '''
+    Commit what the request session did so far (e.g. loading the current user), so the
+    service calls below can run in their own short transaction.
+    '''
+    if session.in_transaction():
+        await session.commit()
+
+
+# Units of a stock row held by active reservations. Reserving takes them off stock.quantity,
+# so writers setting an absolute (on hand) quantity have to take them off as well.
+HELD_SQL = '''
+SELECT coalesce(sum(reservation_item.quantity), 0)
+FROM reservation_item JOIN reservation ON reservation.id = reservation_item.reservation_id
+WHERE reservation_item.stock_id = {stock_id} AND reservation.status = 'active'
+'''
+
+
+async def held_quantity(stock_id: int, session: AsyncSession) -> int:
+    return await session.scalar(text(HELD_SQL.format(stock_id=':stock_id')), {'stock_id': stock_id})
+
+
+async def take_from_one_warehouse(product_id: int, amount: int, session: AsyncSession) -> Optional[Allocation]:
+    '''
+    Decrement the fullest stock row that holds the whole amount and is not locked by another
+    checkout. SKIP LOCKED lets concurrent checkouts of a product spread over its warehouses
+    instead of queueing on one row.
+    '''
+    candidate = select(product_md.Stock.id).where(
+        product_md.Stock.product_id == product_id,
+        product_md.Stock.quantity >= amount,
+    ).order_by(product_md.Stock.quantity.desc(), product_md.Stock.id).limit(1).with_for_update(
+        skip_locked=True).scalar_subquery()
+    stmt = update(product_md.Stock).where(
+        product_md.Stock.id == candidate,
+        product_md.Stock.quantity >= amount,
+    ).values(quantity=product_md.Stock.quantity - amount).returning(
+        product_md.Stock.id, product_md.Stock.warehouse_id)
+    row = (await session.execute(stmt)).first()
+    return (row.id, row.warehouse_id, amount) if row else None
+
+
+async def take_from_warehouses(product_id: int, amount: int, session: AsyncSession) -> List[Allocation]:
+    '''
+    Slow path: wait for the locks of every stock row of the product (in id order, so
+    checkouts cannot deadlock on them) and split the amount over the fullest rows.
+    '''
+    # Sold out products fail without queueing for the row locks
+    available = await session.scalar(select(func.coalesce(func.sum(product_md.Stock.quantity), 0)).where(
+        product_md.Stock.product_id == product_id, product_md.Stock.quantity > 0))
+    if available < amount:
+        raise OutOfStock(product_id, amount, available)
+
+    rows = (await session.execute(
+        select(product_md.Stock.id, product_md.Stock.warehouse_id, product_md.Stock.quantity)
+        .where(product_md.Stock.product_id == product_id, product_md.Stock.quantity > 0)
+        .order_by(product_md.Stock.id).with_for_update())).all()
+
+    available = sum(row.quantity for row in rows)
+    if available < amount:
+        raise OutOfStock(product_id, amount, available)
+
+    allocations = []
+    remaining = amount
+    for row in sorted(rows, key=lambda row: (-row.quantity, row.id)):
+        take = min(row.quantity, remaining)
+        # The rows are locked, the condition only guards against negative stock
+        await session.execute(update(product_md.Stock).where(
+            product_md.Stock.id == row.id, product_md.Stock.quantity >= take,
+        ).values(quantity=product_md.Stock.quantity - take))
+        allocations.append((row.id, row.warehouse_id, take))
+        remaining -= take
+        if not remaining:
+            break
+    return allocations
+
+
+# Finishes the selected reservations and gives their stock back. The reservation ids come
+# from the finished rows themselves, so a reservation whose stock rows are gone is still closed.
+# Stock rows are locked in (product_id, id) order, the order reserve takes them in, so a
+# release of several products cannot deadlock with checkouts.
+RELEASE_SQL = '''
+WITH finished AS (
+    UPDATE reservation SET status = :status
+    WHERE id IN ({reservations})
+    RETURNING id
+), items AS (
+    SELECT stock_id, sum(quantity) AS quantity
+    FROM reservation_item
+    WHERE reservation_id IN (SELECT id FROM finished)
+    GROUP BY stock_id
+), locked AS (
+    SELECT id FROM stock WHERE id IN (SELECT stock_id FROM items) ORDER BY product_id, id FOR UPDATE
+), restocked AS (
+    UPDATE stock SET quantity = stock.quantity + items.quantity
+    FROM items
+    WHERE stock.id = items.stock_id AND stock.id IN (SELECT id FROM locked)
+    RETURNING stock.product_id
+)
+SELECT (SELECT array_agg(id) FROM finished) AS reservation_ids,
+       (SELECT array_agg(DISTINCT product_id) FROM restocked) AS product_ids
+'''
+
+
+async def reserve(user_id: int, items: Dict[int, int], session: AsyncSession,
+                  ttl: int = RESERVATION_TTL) -> Tuple[md.Reservation, List[int]]:
+    '''
+    Atomically reserve {product_id: amount} for the user: either every product is taken
+    from stock or nothing is (OutOfStock). Products are handled in id order, the lock
+    wait is bounded by RESERVATION_LOCK_TIMEOUT. Stock writes only append to the stock
+    summary changes, so checkouts of a product do not queue on its product row.
+    The new reservation replaces an active one of the user, whose stock is given back.
+    Returns the reservation and the product ids of the replaced reservation.
+    '''
+    await end_transaction(session)
+    async with session.begin():
+        await session.execute(select(func.set_config(
+            'lock_timeout', f'{RESERVATION_LOCK_TIMEOUT}ms', True)))
+
+        # Repeated checkouts must not stack holds on the inventory
+        replaced = (await session.execute(text(RELEASE_SQL.format(reservations=(
+            "SELECT id FROM reservation WHERE user_id = :user_id AND status = 'active' FOR UPDATE"))), {
+            'status': md.Reservation.Status.released.name,
+            'user_id': user_id,
+        })).one()
+
+        allocations = {}
+        for product_id in sorted(items):
+            amount = items[product_id]
+            allocation = await take_from_one_warehouse(product_id, amount, session)
+            allocations[product_id] = [allocation] if allocation else await take_from_warehouses(
+                product_id, amount, session)
+
+        row = (await session.execute(insert(md.Reservation).values(
+            user_id=user_id, status=md.Reservation.Status.active,
+            expires_at=func.now() + timedelta(seconds=ttl),
+        ).returning(md.Reservation.id, md.Reservation.created_at, md.Reservation.expires_at))).one()
+        reservation_items = [
+            {'reservation_id': row.id, 'stock_id': stock_id, 'product_id': product_id,
+             'warehouse_id': warehouse_id, 'quantity': quantity}
+            for product_id, product_allocations in allocations.items()
+            for stock_id, warehouse_id, quantity in product_allocations
+        ]
+        await session.execute(insert(md.ReservationItem), reservation_items)
+
+    reservation = md.Reservation(
+        id=row.id, user_id=user_id, status=md.Reservation.Status.active,
+        created_at=row.created_at, expires_at=row.expires_at)
+    set_committed_value(reservation, 'items', [
+        md.ReservationItem(**item) for item in reservation_items])
+    return reservation, sorted(replaced.product_ids or [])
+
+
+async def release(reservation_id: int, user_id: int, session: AsyncSession) -> List[int]:
+    '''
+    Give the stock of an active reservation back. Returns the affected product ids.
+    '''
+    await end_transaction(session)
+    async with session.begin():
+        result = await session.execute(text(RELEASE_SQL.format(reservations=(
+            "SELECT id FROM reservation WHERE id = :reservation_id AND user_id = :user_id "
+            "AND status = 'active' FOR UPDATE"))), {
+            'status': md.Reservation.Status.released.name,
+            'reservation_id': reservation_id,
+            'user_id': user_id,
+        })
+        row = result.one()
+        if not row.reservation_ids:
+            raise ReservationNotFound(reservation_id)
+    return sorted(row.product_ids or [])
+
+
+async def complete(reservation_id: int, user_id: int, session: AsyncSession) -> md.Reservation:
+    '''
+    Turn an active, unexpired reservation into a sale: the stock stays taken.
+    '''
+    await end_transaction(session)
+    async with session.begin():
+        reservation = await session.scalar(select(md.Reservation).where(
+            md.Reservation.id == reservation_id,
+            md.Reservation.user_id == user_id,
+            md.Reservation.status == md.Reservation.Status.active,
+            md.Reservation.expires_at > func.now(),
+        ).with_for_update())
+        if reservation is None:
+            raise ReservationNotFound(reservation_id)
+        reservation.status = md.Reservation.Status.completed
+    return reservation
+
+
+async def release_expired(session: AsyncSession,
+                          batch_size: int = RESERVATION_SWEEP_BATCH_SIZE) -> Tuple[int, List[int]]:
+    '''
+    Release one batch of expired reservations. SKIP LOCKED lets several workers sweep at once.
+    Returns the number of released reservations and the affected product ids.
+    '''
+    await end_transaction(session)
+    async with session.begin():
+        result = await session.execute(text(RELEASE_SQL.format(reservations=(
+            "SELECT id FROM reservation WHERE status = 'active' AND expires_at < now() "
+            "ORDER BY expires_at LIMIT :batch_size FOR UPDATE SKIP LOCKED"))), {
+            'status': md.Reservation.Status.expired.name,
+            'batch_size': batch_size,
+        })
+        row = result.one()
+        return len(row.reservation_ids or []), sorted(row.product_ids or [])
+
+
+class ReservationSweeper:
+    '''
+    Background task releasing expired reservations every RESERVATION_SWEEP_INTERVAL seconds.
+    on_release receives the product ids whose stock came back.
+    '''
+
+    def __init__(self, interval: float = RESERVATION_SWEEP_INTERVAL, on_release=None):
+        self.interval = interval
+        self.on_release = on_release
+        self._task: Optional[asyncio.Task] = None
+
+    async def sweep(self) -> int:
+        released = 0
+        while True:
+            async with async_session_maker() as session:
+                count, product_ids = await release_expired(session)
+            if not count:
+                return released
+            released += count
+            if self.on_release is not None and product_ids:
+                await self.on_release(product_ids)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception:
+                # Connection failures surface as OSError/TimeoutError, the sweeper keeps going
+                logger.exception('Reservation sweep failed, retrying in %ss', self.interval)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,43 @@
+from datetime import date, datetime
+from typing import Optional
+
+from sqlalchemy import Integer, String, Date, DateTime, func
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import Mapped, mapped_column
+
+from database import Base, metadata
+
+
+class DashboardSummary(Base):
+    '''
+    Computed section of the dashboard report, read by report requests as is.
+    Incremental sections keep the position they were computed up to in watermark_*.
+    '''
+    __tablename__ = 'dashboard_summary'
+
+    metadata = metadata
+
+    name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    data: Mapped[dict] = mapped_column(JSONB, nullable=False)
+    computed_at: Mapped[datetime] = mapped_column(
+        DateTime, default=func.now(), nullable=False)
+    watermark_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    watermark_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+
+
+class DashboardReviewDay(Base):
+    '''
+    Reviews per day of creation, accumulated from the review watermark.
+    '''
+    __tablename__ = 'dashboard_review_day'
+
+    metadata = metadata
+
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    count: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False)
+    total: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False)
+    star_1: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False)
+    star_2: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False)
+    star_3: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False)
+    star_4: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False)
+    star_5: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False)
@@ -0,0 +1,185 @@
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import DASHBOARD_REFRESH_INTERVAL, DASHBOARD_SNAPSHOT_TTL, DASHBOARD_REVIEW_LAG, \
+    DASHBOARD_TREND_DAYS
+from shop.dashboard import models as md
+
+
+# Namespace of the advisory lock letting one worker refresh the report at a time
+REFRESH_LOCK_NAMESPACE = 7002
+
+STAR_COLUMNS = ('star_1', 'star_2', 'star_3', 'star_4', 'star_5')
+DAY_COLUMNS = ('count', 'total') + STAR_COLUMNS
+
+# Folds the reviews past the watermark into the per day rows and returns the new watermark.
+# Reviews deleted after they were counted stay in the figures.
+MERGE_REVIEWS_SQL = f'''
+WITH new AS (
+    SELECT id, created_at,
+           CASE estimate WHEN 'ONE' THEN 1 WHEN 'TWO' THEN 2 WHEN 'THREE' THEN 3
+                         WHEN 'FOUR' THEN 4 WHEN 'FIVE' THEN 5 END AS stars
+    FROM review
+    WHERE (created_at, id) > (:watermark_at, :watermark_id)
+      AND created_at < localtimestamp - make_interval(secs => :lag)
+), merged AS (
+    INSERT INTO dashboard_review_day (day, {', '.join(DAY_COLUMNS)})
+    SELECT created_at::date, count(*), sum(stars),
+           {', '.join(f'count(*) FILTER (WHERE stars = {stars})' for stars in range(1, 6))}
+    FROM new GROUP BY 1
+    ON CONFLICT (day) DO UPDATE SET
+        {', '.join(f'{column} = dashboard_review_day.{column} + EXCLUDED.{column}' for column in DAY_COLUMNS)}
+)
+SELECT created_at, id FROM new ORDER BY created_at DESC, id DESC LIMIT 1
+'''
+
+WAREHOUSES_SQL = '''
+SELECT w.id, w.name,
+       coalesce(sum(s.quantity), 0)::integer AS quantity,
+       count(s.id) FILTER (WHERE s.quantity > 0)::integer AS products
+FROM warehouse w
+LEFT JOIN stock s ON s.warehouse_id = w.id
+GROUP BY w.id, w.name
+ORDER BY w.id
+'''
+
+# Counted from the partial index on active products, subtree totals through the closure table
+CATEGORIES_SQL = '''
+WITH direct AS (
+    SELECT category_id, count(*)::integer AS products
+    FROM product WHERE is_active GROUP BY category_id
+)
+SELECT c.id, c.name, coalesce(d.products, 0) AS products,
+       coalesce(sum(t.products), 0)::integer AS subtree_products
+FROM category c
+LEFT JOIN direct d ON d.category_id = c.id
+LEFT JOIN category_closure cc ON cc.ancestor_id = c.id
+LEFT JOIN direct t ON t.category_id = cc.descendant_id
+WHERE c.is_active
+GROUP BY c.id, c.name, d.products
+ORDER BY subtree_products DESC, c.id
+'''
+
+
+def average(total: int, count: int) -> Optional[float]:
+    return round(total / count, 2) if count else None
+
+
+def review_figures(days: List[md.DashboardReviewDay]) -> dict:
+    count = sum(day.count for day in days)
+    total = sum(day.total for day in days)
+    return {'count': count, 'average': average(total, count)}
+
+
+async def save(session: AsyncSession, name: str, data: dict, **watermark):
+    values = {'name': name, 'data': data, 'computed_at': func.localtimestamp(), **watermark}
+    stmt = insert(md.DashboardSummary).values(**values)
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=[md.DashboardSummary.name],
+        set_={key: stmt.excluded[key] for key in values if key != 'name'}))
+
+
+async def refresh_reviews(session: AsyncSession, summary: Optional[md.DashboardSummary],
+                          days: int = DASHBOARD_TREND_DAYS):
+    '''
+    Count the reviews created since the watermark, then rebuild the rating trend
+    from the per day rows.
+    '''
+    watermark_at = summary.watermark_at if summary is not None else None
+    watermark_id = summary.watermark_id if summary is not None else None
+    row = (await session.execute(text(MERGE_REVIEWS_SQL), {
+        'watermark_at': watermark_at or datetime.min,
+        'watermark_id': watermark_id or 0,
+        'lag': DASHBOARD_REVIEW_LAG,
+    })).first()
+    if row is not None:
+        watermark_at, watermark_id = row.created_at, row.id
+
+    today = await session.scalar(select(func.current_date()))
+    result = await session.execute(select(md.DashboardReviewDay).where(
+        md.DashboardReviewDay.day > today - timedelta(days=days)).order_by(md.DashboardReviewDay.day))
+    trend = result.scalars().all()
+    totals = (await session.execute(select(
+        func.coalesce(func.sum(md.DashboardReviewDay.count), 0),
+        func.coalesce(func.sum(md.DashboardReviewDay.total), 0)))).one()
+
+    week_start = today - timedelta(days=6)
+    await save(session, 'reviews', {
+        'count': totals[0],
+        'average': average(totals[1], totals[0]),
+        'this_week': review_figures([day for day in trend if day.day >= week_start]),
+        'previous_week': review_figures([
+            day for day in trend if week_start - timedelta(days=7) <= day.day < week_start]),
+        'trend': [{
+            'day': day.day.isoformat(),
+            'count': day.count,
+            'average': average(day.total, day.count),
+            'stars': [getattr(day, column) for column in STAR_COLUMNS],
+        } for day in trend],
+    }, watermark_at=watermark_at, watermark_id=watermark_id)
+
+
+async def refresh_warehouses(session: AsyncSession):
+    '''
+    Snapshot of the stock per warehouse. Stock rows carry no change time and a running
+    total per warehouse would serialise every checkout on it, so this one is recounted.
+    '''
+    rows = (await session.execute(text(WAREHOUSES_SQL))).mappings().all()
+    await save(session, 'warehouses', {'warehouses': [dict(row) for row in rows]})
+
+
+async def refresh_categories(session: AsyncSession):
+    rows = (await session.execute(text(CATEGORIES_SQL))).mappings().all()
+    await save(session, 'categories', {'categories': [dict(row) for row in rows]})
+
+
+SECTIONS = {
+    'reviews': (DASHBOARD_REFRESH_INTERVAL, refresh_reviews),
+    'warehouses': (DASHBOARD_SNAPSHOT_TTL, lambda session, summary: refresh_warehouses(session)),
+    'categories': (DASHBOARD_SNAPSHOT_TTL, lambda session, summary: refresh_categories(session)),
+}
+
+
+async def load(session: AsyncSession) -> Dict[str, tuple]:
+    '''
+    {name: (summary, age in seconds)} of the computed sections.
+    '''
+    result = await session.execute(select(
+        md.DashboardSummary,
+        func.extract('epoch', func.localtimestamp() - md.DashboardSummary.computed_at),
+    ).execution_options(populate_existing=True))
+    return {summary.name: (summary, age) for summary, age in result.all()}
+
+
+async def refresh(session: AsyncSession, force: bool = False) -> bool:
+    '''
+    Recompute the stale sections of the report. Returns False when another worker
+    is refreshing it already.
+    '''
+    async with session.begin():
+        locked = await session.scalar(select(func.pg_try_advisory_xact_lock(REFRESH_LOCK_NAMESPACE)))
+        if not locked:
+            return False
+        sections = await load(session)
+        for name, (ttl, refresh_section) in SECTIONS.items():
+            summary, age = sections.get(name, (None, None))
+            if force or summary is None or age >= ttl:
+                await refresh_section(session, summary)
+    return True
+
+
+async def get_report(session: AsyncSession) -> Dict[str, dict]:
+    '''
+    The dashboard report as stored, refreshed first when a section is stale.
+    '''
+    sections = await load(session)
+    if any(name not in sections or sections[name][1] >= ttl for name, (ttl, _) in SECTIONS.items()):
+        await session.commit()
+        await refresh(session)
+        sections = await load(session)
+    await session.commit()
+    return {name: summary.data for name, (summary, _) in sections.items()}
@@ -1,2 +1,4 @@
-from .products.models import Product, ProductPhoto, Stock, Warehouse
+from .products.models import Category, CategoryClosure, Product, ProductPhoto, ProductRating, ProductStockDelta, Stock, Warehouse
 from .cart.models import Cart
+from .checkout.models import Reservation, ReservationItem
+from .dashboard.models import DashboardReviewDay, DashboardSummary
@@ -2,8 +2,9 @@ from datetime import datetime
 from typing import List, Optional
 from enum import Enum
 
-from sqlalchemy import Integer, String, Boolean, Text, DECIMAL, ForeignKey, \
-    Enum as EnumType, DateTime, func
+from sqlalchemy import BigInteger, Integer, String, Boolean, Text, DECIMAL, ForeignKey, \
+    Enum as EnumType, DateTime, Computed, Index, UniqueConstraint, func, text
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from database import Base, metadata
@@ -21,7 +22,7 @@ class Category(Base):
     discount: Mapped[int] = mapped_column(Integer, nullable=True)
     is_active: Mapped[bool] = mapped_column(Boolean, default=True)
     parent_id: Mapped[int] = mapped_column(Integer, ForeignKey(
-        'category.id', ondelete='CASCADE'), nullable=True)
+        'category.id', ondelete='CASCADE'), nullable=True, index=True)
     photo_url: Mapped[str] = mapped_column(String, nullable=True)
 
     children: Mapped['Category'] = relationship(
@@ -31,8 +32,42 @@ class Category(Base):
         return f'Category(id={self.id}, name={self.name})'
 
 
+class CategoryClosure(Base):
+    '''
+    Ancestor/descendant pairs of the category tree, including a (id, id, 0) row for every category.
+    '''
+    __tablename__ = 'category_closure'
+
+    metadata = metadata
+
+    ancestor_id: Mapped[int] = mapped_column(Integer, ForeignKey(
+        'category.id', ondelete='CASCADE'), primary_key=True)
+    descendant_id: Mapped[int] = mapped_column(Integer, ForeignKey(
+        'category.id', ondelete='CASCADE'), primary_key=True, index=True)
+    depth: Mapped[int] = mapped_column(Integer, default=0)
+
+    def __repr__(self) -> str:
+        return f'CategoryClosure(ancestor_id={self.ancestor_id!r}, descendant_id={self.descendant_id!r}, depth={self.depth!r})'
+
+
 class Product(Base):
     __tablename__ = 'product'
+    __table_args__ = (
+        # Keyset pagination of active products by id, (price, id) and (category_id, id)
+        Index('ix_product_active_id', 'id', postgresql_where=text('is_active')),
+        Index('ix_product_active_price_id', 'price', 'id',
+              postgresql_where=text('is_active')),
+        Index('ix_product_active_category_id_id', 'category_id', 'id',
+              postgresql_where=text('is_active')),
+        # Listing of active products that are in stock
+        Index('ix_product_active_in_stock_id', 'id',
+              postgresql_where=text('is_active AND in_stock')),
+        # Product search: full text and articul typos (pg_trgm), GiST returns the
+        # articuls in distance order (<->)
+        Index('ix_product_search_vector', 'search_vector', postgresql_using='gin'),
+        Index('ix_product_articul_trgm', 'articul', postgresql_using='gist',
+              postgresql_ops={'articul': 'gist_trgm_ops'}),
+    )
 
     metadata = metadata
 
@@ -45,7 +80,19 @@ class Product(Base):
     price: Mapped[DECIMAL] = mapped_column(
         DECIMAL(precision=8, scale=2), default=0.0)
     category_id: Mapped[int] = mapped_column(
-        Integer, ForeignKey('category.id'))
+        Integer, ForeignKey('category.id'), index=True)
+    # Stock summary: the product_stock_summary trigger on stock appends changes to
+    # product_stock_delta, the stock summary folder adds them here a moment later
+    stock_quantity: Mapped[int] = mapped_column(
+        Integer, default=0, server_default='0', nullable=False)
+    stock_warehouses: Mapped[int] = mapped_column(
+        Integer, default=0, server_default='0', nullable=False)
+    in_stock: Mapped[bool] = mapped_column(
+        Boolean, Computed('stock_quantity > 0', persisted=True))
+    search_vector: Mapped[str] = mapped_column(TSVECTOR, Computed(
+        "setweight(to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(articul, '')), 'A') || "
+        "setweight(to_tsvector('simple', coalesce(description, '')), 'B')", persisted=True),
+        deferred=True)
 
     stocks: Mapped[Optional[List['Stock']]] = relationship(
         'Stock', back_populates='product')
@@ -54,6 +101,8 @@ class Product(Base):
     reviews: Mapped[Optional[List['Review']]] = relationship(
         'Review', back_populates='product'
     )
+    rating: Mapped[Optional['ProductRating']] = relationship(
+        'ProductRating', uselist=False, viewonly=True)
 
     def __repr__(self) -> str:
         return f'Product(id={self.id!r}, name={self.name!r}, articul={self.articul!r}, is_active={self.is_active!r}, price={self.price!r})'
@@ -67,7 +116,7 @@ class ProductPhoto(Base):
     id: Mapped[int] = mapped_column(
         Integer, primary_key=True, autoincrement=True)
     product_id: Mapped[int] = mapped_column(
-        Integer, ForeignKey('product.id', ondelete='CASCADE'))
+        Integer, ForeignKey('product.id', ondelete='CASCADE'), index=True)
     photo_url: Mapped[str] = mapped_column(String(255), default='')
 
     product: Mapped['Product'] = relationship(
@@ -92,6 +141,10 @@ class Warehouse(Base):
 
 class Stock(Base):
     __tablename__ = 'stock'
+    __table_args__ = (
+        UniqueConstraint('warehouse_id', 'product_id',
+                         name='uq_stock_warehouse_id_product_id'),
+    )
 
     metadata = metadata
 
@@ -100,7 +153,8 @@ class Stock(Base):
     warehouse_id: Mapped[int] = mapped_column(Integer,
                                               ForeignKey('warehouse.id', ondelete='CASCADE'))
     product_id: Mapped[int] = mapped_column(Integer,
-                                            ForeignKey('product.id', ondelete='CASCADE'))
+                                            ForeignKey('product.id', ondelete='CASCADE'),
+                                            index=True)
     quantity: Mapped[int] = mapped_column(Integer, default=1)
 
     warehouse: Mapped['Warehouse'] = relationship(
@@ -109,6 +163,21 @@ class Stock(Base):
         'Product', back_populates='stocks')
 
 
+class ProductStockDelta(Base):
+    '''
+    Pending change of the stock summary of a product, folded into product and deleted by
+    the stock summary folder. Not a foreign key, so stock writes never lock the product row.
+    '''
+    __tablename__ = 'product_stock_delta'
+
+    metadata = metadata
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    product_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    quantity: Mapped[int] = mapped_column(Integer, nullable=False)
+    warehouses: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
 class Review(Base):
     class ReviewRating(Enum):
         ONE = '1'
@@ -118,6 +187,11 @@ class Review(Base):
         FIVE = '5'
 
     __tablename__ = 'review'
+    __table_args__ = (
+        Index('ix_review_product_id_created_at', 'product_id', 'created_at', 'id'),
+        # Dashboard reports read new reviews past a (created_at, id) watermark
+        Index('ix_review_created_at_id', 'created_at', 'id'),
+    )
 
     metadata = metadata
 
@@ -143,3 +217,28 @@ class Review(Base):
 
     product: Mapped['Product'] = relationship(
         'Product', back_populates='reviews')
+
+
+class ProductRating(Base):
+    '''
+    Review aggregate of a product, maintained by the product_rating_summary trigger on review.
+    Products without reviews have no row.
+    '''
+    __tablename__ = 'product_rating'
+
+    metadata = metadata
+
+    product_id: Mapped[int] = mapped_column(Integer, ForeignKey(
+        'product.id', ondelete='CASCADE'), primary_key=True)
+    count: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False)
+    total: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False)
+    star_1: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False)
+    star_2: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False)
+    star_3: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False)
+    star_4: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False)
+    star_5: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False)
+    average: Mapped[DECIMAL] = mapped_column(DECIMAL(precision=3, scale=2), Computed(
+        'CASE WHEN count > 0 THEN round(total::numeric / count, 2) END', persisted=True))
+
+    def __repr__(self) -> str:
+        return f'ProductRating(product_id={self.product_id!r}, count={self.count!r}, average={self.average!r})'
@@ -1,28 +1,42 @@
+import os
+from decimal import Decimal
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Body
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Body, Query
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import selectinload, aliased
-from sqlalchemy import select, delete
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy import select, delete, insert, update, func, union
 from fastapi_cache.decorator import cache
 from schemas import Response
+from cache import catalog_cache
 
 from database import get_async_session
 from shop.products import utils as ut
 from shop.products import models as md
 from shop.products import schemas as sc
+from shop.products import stock_import
+from shop.checkout import service as checkout
 from fastapi.responses import JSONResponse
 from responses import ResponseData
+from pagination import apply_keyset, parse_int, split_page
+from serializers import encode
+from storage import storage, UploadTooLarge
+from config import PRODUCT_BATCH_MAX_SIZE, SEARCH_SIMILARITY_THRESHOLD, SEARCH_CANDIDATE_LIMIT
 
 router = APIRouter(
     prefix='',
     tags=['Shop[Products]'],
 )
 
+# Reviews embedded into the product detail, the rest is paged from /products/{product_id}/reviews
+PRODUCT_REVIEWS_PAGE_SIZE = 10
+
 # Category #
 
 
 @router.get('/category/list', response_model=Response[List[sc.Category]])
+@catalog_cache.cached(tags=lambda **_: ['category:list'])
 async def get_category_list(session: AsyncSession = Depends(get_async_session)):
     '''
     Getting a list of category
@@ -30,8 +44,7 @@ async def get_category_list(session: AsyncSession = Depends(get_async_session)):
     # try:
     query = select(md.Category).where(md.Category.is_active == True)
     result = await session.execute(query)
-    print(result.scalars().all())
-    return ResponseData(result.scalars().all())
+    return ResponseData(result.scalars().all(), schema=sc.Category)
 
     # except Exception:
     #     # raise HTTPException(detail={
@@ -52,25 +65,29 @@ async def create_category(
         photo: Optional[UploadFile] = File(default=None),
         session: AsyncSession = Depends(get_async_session)):
     try:
-        async with session.begin():
-            category = md.Category(**new_category.dict())
+        # временное хранилище файлов
+        async with storage.saved([photo] if photo else [], 'category') as photo_urls:
+            photo_url = photo_urls[0] if photo_urls else os.path.join(storage.root, 'category', 'default.png')
 
-            session.add(category)
-            await session.flush()
+            async with session.begin():
+                category = md.Category(**new_category.dict())
+                category.photo_url = photo_url
 
-            if photo:
-                photo_data = await photo.read()
-                # временное хранилище файлов
-                photo_url = f'./path/category/{photo.filename}'
-                with open(photo_url, 'wb') as file:
-                    file.write(photo_data)
-            else:
-                photo_url = f'./path/category/default.png'
-            category.photo_url = photo_url
+                session.add(category)
+                await session.flush()
+                await ut.add_category_to_tree(category, session)
 
-            await session.commit()
+                await session.commit()
 
+        ut.category_tree.invalidate()
+        await catalog_cache.invalidate('category:list')
         return {'status': 'success'}
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(e)
+        })
     except SQLAlchemyError as e:
         error = str(e.__dict__['orig'])
         raise HTTPException(status_code=500, detail={
@@ -86,19 +103,160 @@ async def create_category(
         })
 
 
+@router.patch('/category/update/{id}', response_model=Response[sc.Category])
+async def update_category(
+    id: int,
+    updated_data: sc.CategoryUpdate,
+    session: AsyncSession = Depends(get_async_session)
+):
+    '''
+    Update(Patch) for category. Changing parent_id moves the whole subtree.
+    '''
+    try:
+        stmt = select(md.Category).filter(md.Category.id == id)
+        result = await session.execute(stmt)
+        stored_item = result.scalar_one_or_none()
+
+        if not stored_item:
+            raise HTTPException(status_code=404, detail={
+                'status': 'error',
+                'data': None,
+                'details': 'Object not found'
+            })
+
+        update_data = updated_data.dict(exclude_unset=True)
+        if 'parent_id' in update_data:
+            parent_id = update_data.pop('parent_id')
+            if parent_id != stored_item.parent_id:
+                await ut.move_category_in_tree(stored_item, parent_id, session)
+        for field, value in update_data.items():
+            setattr(stored_item, field, value)
+
+        await session.commit()
+        await session.refresh(stored_item)
+        ut.category_tree.invalidate()
+        await catalog_cache.invalidate('category:list', f'category:{id}')
+
+        return ResponseData(stored_item, schema=sc.Category)
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(e)
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(e)
+        })
+
+
+@router.delete('/category/delete/{id}')
+async def delete_category(
+    id: int,
+    session: AsyncSession = Depends(get_async_session)
+):
+    '''
+    Delete category by id together with its subcategories
+    '''
+    try:
+        stmt = delete(md.Category).where(md.Category.id == id)
+        await session.execute(stmt)
+        await session.commit()
+        ut.category_tree.invalidate()
+        await catalog_cache.invalidate('category:list', f'category:{id}')
+
+        return {
+            'status': 'success',
+            'data': f'Deleted category.id = {id}',
+            'details': None
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(e)
+        })
+
+
 # Products #
+
+# Keyset columns and cursor value parsers for every supported ordering
+PRODUCT_ORDERINGS = {
+    sc.ProductOrdering.id: ((md.Product.id,), (parse_int,)),
+    sc.ProductOrdering.price: ((md.Product.price, md.Product.id), (Decimal, parse_int)),
+    sc.ProductOrdering.category_id: (
+        (md.Product.category_id, md.Product.id), (parse_int, parse_int)),
+}
+
+
+def parse_fields(fields: Optional[str], schema) -> Optional[List[str]]:
+    try:
+        return ut.parse_fields(fields, schema)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(e)
+        })
+
+
+def fields_key(schema):
+    '''
+    Cache key value of fields=: the names in schema order, so id,name and name,id share an entry.
+    '''
+    def normalize(fields: Optional[str]) -> Optional[str]:
+        try:
+            names = ut.parse_fields(fields, schema)
+        except ValueError:
+            return fields
+        return None if names is None else ','.join(names)
+    return normalize
+
+
 @router.get('/products/list', response_model=Response[List[sc.ProductForList]])
-# @cache(expire=300)
-async def get_products_list(session: AsyncSession = Depends(get_async_session)):
+@catalog_cache.cached(tags=lambda **_: ['product:list', 'stock:list'],
+                      normalize={'fields': fields_key(sc.ProductForList)})
+async def get_products_list(
+    limit: int = Query(25, ge=1, le=100),
+    cursor: Optional[str] = None,
+    order_by: sc.ProductOrdering = sc.ProductOrdering.id,
+    in_stock: Optional[bool] = None,
+    fields: Optional[str] = Query(None, description='Comma separated fields to return, e.g. id,name,price'),
+    session: AsyncSession = Depends(get_async_session)
+):
     '''
-    Getting a list of products
+    Getting a list of products.
+    Pass next_cursor from the previous page as cursor to get the next one.
+    With fields only those columns are selected and only the listed relationships loaded.
     '''
+    names = parse_fields(fields, sc.ProductForList)
+    keys, parsers = PRODUCT_ORDERINGS[order_by]
+    if names is None:
+        query = select(md.Product).options(selectinload(md.Product.photos))
+    else:
+        query = ut.sparse_product_query(names, keys)
+    query = query.where(md.Product.is_active == True)
+    if in_stock is not None:
+        query = query.where(md.Product.in_stock == in_stock)
+    query = apply_keyset(query, keys, cursor, limit, parsers=parsers)
 
     try:
-        query = select(md.Product).options(selectinload(
-            md.Product.photos)).where(md.Product.is_active == True)
         result = await session.execute(query)
-        return ResponseData(result.scalars().all())
+        if names is None:
+            products, next_cursor = split_page(
+                result.scalars().all(), limit,
+                key=lambda product: [getattr(product, key.key) for key in keys])
+            return ResponseData(products, next_cursor=next_cursor, schema=sc.ProductForList)
+
+        rows, next_cursor = split_page(
+            result.mappings().all(), limit, key=lambda row: [row[key.key] for key in keys])
+        products = [dict(row) for row in rows]
+        await ut.load_sparse_relations(products, names, session)
+        return ResponseData(ut.project(products, names, sc.ProductForList), next_cursor=next_cursor)
     except Exception:
         raise HTTPException(status_code=500, detail={
             'status': 'error',
@@ -107,20 +265,140 @@ async def get_products_list(session: AsyncSession = Depends(get_async_session)):
         })
 
 
+@router.get('/products/search', response_model=Response[List[sc.ProductForList]])
+@catalog_cache.cached(
+    tags=lambda category_id=None, **_: ['product:list', 'stock:list'] + (
+        ['category:list', f'category:{category_id}'] if category_id is not None else []))
+async def search_products(
+    q: str = Query(..., min_length=2, max_length=100),
+    category_id: Optional[int] = None,
+    in_stock: Optional[bool] = None,
+    limit: int = Query(25, ge=1, le=100),
+    session: AsyncSession = Depends(get_async_session)
+):
+    '''
+    Search active products by name, description and articul, best matches first.
+    Articuls also match with typos (trigram similarity).
+    At most SEARCH_CANDIDATE_LIMIT full text and as many articul matches are ranked: the best
+    full text matches and the articuls closest to q, read in distance order from the trigram index.
+    '''
+    try:
+        ts_query = func.websearch_to_tsquery('simple', q)
+        conditions = [md.Product.is_active == True]
+        if category_id is not None:
+            category_ids = await ut.category_tree.get_subtree(session, category_id)
+            conditions.append(md.Product.category_id.in_(category_ids))
+        if in_stock is not None:
+            conditions.append(md.Product.in_stock == in_stock)
+
+        text_rank = func.ts_rank_cd(md.Product.search_vector, ts_query)
+        text_matches = select(md.Product.id).where(
+            *conditions, md.Product.search_vector.bool_op('@@')(ts_query)).order_by(
+            text_rank.desc(), md.Product.id).limit(SEARCH_CANDIDATE_LIMIT)
+        articul_matches = select(md.Product.id).where(
+            *conditions, md.Product.articul.bool_op('%')(q)).order_by(
+            md.Product.articul.op('<->')(q), md.Product.id).limit(SEARCH_CANDIDATE_LIMIT)
+        candidates = union(text_matches, articul_matches).subquery()
+
+        rank = func.greatest(text_rank, func.similarity(md.Product.articul, q))
+        query = select(md.Product).options(selectinload(md.Product.photos)).join(
+            candidates, candidates.c.id == md.Product.id).order_by(
+            rank.desc(), md.Product.id).limit(limit)
+
+        # The % operator reads its threshold from the (transaction local) setting
+        await session.execute(select(func.set_config(
+            'pg_trgm.similarity_threshold', str(SEARCH_SIMILARITY_THRESHOLD), True)))
+        result = await session.execute(query)
+
+        return ResponseData(result.scalars().all(), schema=sc.ProductForList)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(e.__dict__['orig'])
+        })
+
+
+@router.get('/products/filter', response_model=Response[sc.ProductFilterResult])
+@catalog_cache.cached(
+    tags=lambda category_id=None, **_: ['product:list', 'stock:list'] + (
+        ['category:list', f'category:{category_id}'] if category_id is not None else []))
+async def filter_products(
+    price_min: Optional[float] = Query(None, ge=0),
+    price_max: Optional[float] = Query(None, ge=0),
+    category_id: Optional[int] = None,
+    in_stock: bool = False,
+    min_rating: Optional[float] = Query(None, ge=1, le=5),
+    limit: int = Query(25, ge=1, le=100),
+    cursor: Optional[str] = None,
+    session: AsyncSession = Depends(get_async_session)
+):
+    '''
+    Active products matching the filters, ordered by id.
+    The first page (without cursor) also carries the facet counts of all matching products
+    per category, price bucket and availability, computed in the same query.
+    '''
+    try:
+        conditions = [md.Product.is_active == True]
+        if price_min is not None:
+            conditions.append(md.Product.price >= price_min)
+        if price_max is not None:
+            conditions.append(md.Product.price <= price_max)
+        if category_id is not None:
+            category_ids = await ut.category_tree.get_subtree(session, category_id)
+            conditions.append(md.Product.category_id.in_(category_ids))
+        if in_stock:
+            conditions.append(md.Product.in_stock == True)
+        if min_rating is not None:
+            conditions.append(md.Product.id.in_(
+                select(md.ProductRating.product_id).where(md.ProductRating.average >= min_rating)))
+
+        columns = [md.Product]
+        if cursor is None:
+            columns.append(ut.product_facets_query(conditions).label('facets'))
+        query = select(*columns).options(selectinload(md.Product.photos)).where(*conditions)
+        query = apply_keyset(query, (md.Product.id,), cursor, limit, parsers=(parse_int,))
+
+        rows = (await session.execute(query)).all()
+        products, next_cursor = split_page(
+            [row[0] for row in rows], limit, key=lambda product: [product.id])
+        facets = None
+        if cursor is None:
+            facets = ut.parse_product_facets(rows[0][1] if rows else None)
+
+        return ResponseData({
+            'products': encode(products, sc.ProductForList),
+            'facets': facets,
+        }, next_cursor=next_cursor)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(e.__dict__['orig'])
+        })
+
+
 @router.get('/products/{product_id}', response_model=Response[sc.Product])
-# @cache(expire=300)
+@catalog_cache.cached(
+    tags=lambda product_id, **_: [f'product:{product_id}', f'stock:{product_id}'],
+    normalize={'fields': fields_key(sc.Product)})
 async def get_product_by_id(
     product_id: int,
+    fields: Optional[str] = Query(None, description='Comma separated fields to return, e.g. id,name,price'),
     session: AsyncSession = Depends(get_async_session)
 ):
     '''
-    Get product by id
+    Get product by id with its rating and the first page of reviews.
+    With fields only those columns are selected and only the listed relationships loaded.
     '''
+    names = parse_fields(fields, sc.Product)
+    if names is not None:
+        return await get_sparse_product(product_id, names, session)
+
     try:
         query = select(md.Product).options(
-            selectinload(md.Product.stocks),
             selectinload(md.Product.photos),
-            selectinload(md.Product.reviews)).where(md.Product.id == product_id)
+            selectinload(md.Product.rating)).where(md.Product.id == product_id)
         result = await session.execute(query)
         product = result.scalar_one_or_none()
 
@@ -131,7 +409,13 @@ async def get_product_by_id(
                 'details': 'Object not found'
             })
 
-        return ResponseData(product)
+        reviews, next_cursor = await ut.get_reviews_page(
+            product_id, None, PRODUCT_REVIEWS_PAGE_SIZE, session)
+        set_committed_value(product, 'reviews', reviews)
+
+        data = encode(product, sc.Product)
+        data['reviews_next_cursor'] = next_cursor
+        return ResponseData(data)
     except Exception as e:
         raise HTTPException(status_code=500, detail={
             'status': 'error',
@@ -140,28 +424,57 @@ async def get_product_by_id(
         })
 
 
+async def get_sparse_product(product_id: int, names: List[str], session: AsyncSession):
+    try:
+        result = await session.execute(
+            ut.sparse_product_query(names).where(md.Product.id == product_id))
+        row = result.mappings().one_or_none()
+        if row is None:
+            raise HTTPException(status_code=404, detail={
+                'status': 'error',
+                'data': None,
+                'details': 'Object not found'
+            })
+
+        product = dict(row)
+        await ut.load_sparse_relations([product], names, session)
+        if 'reviews' in names or 'reviews_next_cursor' in names:
+            reviews, product['reviews_next_cursor'] = await ut.get_reviews_page(
+                product_id, None, PRODUCT_REVIEWS_PAGE_SIZE, session)
+            product['reviews'] = encode(reviews, sc.Review)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(getattr(e, 'orig', e))
+        })
+    return ResponseData(ut.project([product], names, sc.Product)[0])
+
+
 @router.get('/products/list_in_category/{category_id}')
-async def get_product_list_in_category(category_id: int, session: AsyncSession = Depends(get_async_session)):
+@catalog_cache.cached(
+    tags=lambda category_id, **_: [
+        'product:list', 'stock:list', 'category:list', f'category:{category_id}'])
+async def get_product_list_in_category(
+    category_id: int,
+    in_stock: Optional[bool] = None,
+    session: AsyncSession = Depends(get_async_session)
+):
     '''
     This endpoint returns a list of all active products for the selected category and its subcategories.
     '''
     try:
-        cte = select(md.Category.id, md.Category.parent_id).cte(recursive=True)
-        cte_alias = aliased(cte, name='cte_alias')
-        recursive_part = select(md.Category.id, md.Category.parent_id).where(
-            md.Category.parent_id == cte_alias.c.id)
-
-        cte = cte.union_all(recursive_part)
+        category_ids = await ut.category_tree.get_subtree(session, category_id)
 
-        subquery = select(cte.c.id).where(
-            cte_alias.c.parent_id == category_id).correlate_except(cte_alias)
-
-        query = select(md.Product).where(md.Product.category_id.in_(
-            subquery)).order_by(md.Product.category_id)
+        query = select(md.Product).options(selectinload(md.Product.photos)).where(
+            md.Product.is_active == True,
+            md.Product.category_id.in_(category_ids)).order_by(md.Product.category_id)
+        if in_stock is not None:
+            query = query.where(md.Product.in_stock == in_stock)
 
         result = await session.execute(query)
 
-        return ResponseData(result.scalars().all())
+        return ResponseData(result.scalars().all(), schema=sc.ProductForList)
     except Exception:
         raise HTTPException(status_code=500, detail={
             'status': 'error',
@@ -178,18 +491,120 @@ async def create_product(
     '''
     Create product
     '''
+    try:
+        # Photos are uploaded before the transaction so no connection is held during the upload
+        async with ut.uploaded_product_photos(photos) as photo_urls:
+            async with session.begin():
+                product = md.Product(**new_product.dict())
+                session.add(product)
+                await session.flush()
+
+                await ut.save_product_photos(product.id, photo_urls, session)
+
+                await session.commit()
+
+        await catalog_cache.invalidate('product:list')
+        return {'status': 'success'}
+    except SQLAlchemyError as e:
+        error = str(e.__dict__['orig'])
+        raise HTTPException(status_code=500, detail={
+            'status': 'error',
+            'data': error,
+            'details': None
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(e)
+        })
+
+
+def check_batch_size(items: list):
+    if not 0 < len(items) <= PRODUCT_BATCH_MAX_SIZE:
+        raise HTTPException(status_code=400, detail={
+            'status': 'error',
+            'data': None,
+            'details': f'Batch must contain from 1 to {PRODUCT_BATCH_MAX_SIZE} products'
+        })
+
+
+@router.post('/products/batch_create', response_model=Response[sc.ProductBatchResult])
+async def create_products_batch(
+    new_products: List[sc.ProductBatchCreate],
+    session: AsyncSession = Depends(get_async_session)
+):
+    '''
+    Create many products with multi-row INSERT ... RETURNING.
+    Ids are returned in the order of the payload, photos are added with /products/{id}/photos.
+    '''
+    check_batch_size(new_products)
     try:
         async with session.begin():
-            product = md.Product(**new_product.dict())
-            session.add(product)
-            await session.flush()
+            stmt = insert(md.Product).returning(
+                md.Product.id, sort_by_parameter_order=True)
+            result = await session.execute(
+                stmt, [product.dict() for product in new_products])
+            ids = result.scalars().all()
+            await session.commit()
 
-            for photo in photos:
-                product_photo = await ut.save_product_photo(product, photo, session)
+        await catalog_cache.invalidate('product:list')
+        return ResponseData({'ids': ids})
+    except SQLAlchemyError as e:
+        error = str(e.__dict__['orig'])
+        raise HTTPException(status_code=500, detail={
+            'status': 'error',
+            'data': error,
+            'details': None
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(e)
+        })
+
+
+@router.patch('/products/batch_update', response_model=Response[sc.ProductBatchResult])
+async def update_products_batch(
+    updated_products: List[sc.ProductBatchUpdate],
+    session: AsyncSession = Depends(get_async_session)
+):
+    '''
+    Update(Patch) many products at once. Only the fields sent for a product are changed.
+    '''
+    check_batch_size(updated_products)
+    ids = [product.id for product in updated_products]
+    if len(set(ids)) != len(ids):
+        raise HTTPException(status_code=400, detail={
+            'status': 'error',
+            'data': None,
+            'details': 'Product ids must be unique within a batch'
+        })
 
+    try:
+        async with session.begin():
+            query = select(md.Product.id).where(md.Product.id.in_(ids))
+            found = set((await session.execute(query)).scalars().all())
+            missing = [id for id in ids if id not in found]
+            if missing:
+                raise HTTPException(status_code=404, detail={
+                    'status': 'error',
+                    'data': missing,
+                    'details': 'Object not found'
+                })
+
+            # ORM bulk UPDATE by primary key, one executemany per set of changed fields
+            await session.execute(update(md.Product), [
+                product.dict(exclude_unset=True) for product in updated_products
+            ])
             await session.commit()
 
-        return {'status': 'success'}
+        await catalog_cache.invalidate(
+            'product:list', *(f'product:{id}' for id in ids))
+        return ResponseData({'ids': ids})
+    except HTTPException:
+        raise
     except SQLAlchemyError as e:
         error = str(e.__dict__['orig'])
         raise HTTPException(status_code=500, detail={
@@ -205,6 +620,42 @@ async def create_product(
         })
 
 
+@router.post('/products/{product_id}/photos')
+async def add_product_photos(
+    product_id: int,
+    photos: List[UploadFile] = File(...),
+    session: AsyncSession = Depends(get_async_session)
+):
+    '''
+    Upload photos of an existing product
+    '''
+    try:
+        product = await session.get(md.Product, product_id)
+        if product is None:
+            raise HTTPException(status_code=404, detail={
+                'status': 'error',
+                'data': None,
+                'details': 'Object not found'
+            })
+        # Give the connection back to the pool while the photos are uploaded
+        await session.rollback()
+
+        async with ut.uploaded_product_photos(photos) as photo_urls:
+            await ut.save_product_photos(product_id, photo_urls, session)
+            await session.commit()
+
+        await catalog_cache.invalidate('product:list', f'product:{product_id}')
+        return {'status': 'success'}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(e)
+        })
+
+
 @router.patch('/products/update/{id}', response_model=Response[sc.Product])
 async def update_product_by_id(
     id: int,
@@ -236,30 +687,33 @@ async def update_product_by_id(
             # await session.
 
         # Добавление новых фотографий
-        for photo in new_photos:
-            photo_data = await photo.read()
-            # временное хранилище файлов
-            photo_url = f'./path/{photo.filename}'
-            product_photo = md.ProductPhoto(
-                product_id=stored_item.id, photo_url=photo_url)
-            session.add(product_photo)
-
-            with open(photo_url, 'wb') as file:
-                file.write(photo_data)
-
-        # Обновление остальных полей продукта
-        update_data = updated_data.dict(exclude_unset=True)
-        for field, value in update_data.items():
-            setattr(stored_item, field, value)
+        # временное хранилище файлов
+        async with storage.saved(new_photos) as photo_urls:
+            for photo_url in photo_urls:
+                product_photo = md.ProductPhoto(
+                    product_id=stored_item.id, photo_url=photo_url)
+                session.add(product_photo)
+
+            # Обновление остальных полей продукта
+            update_data = updated_data.dict(exclude_unset=True)
+            for field, value in update_data.items():
+                setattr(stored_item, field, value)
 
-        await session.commit()
+            await session.commit()
         await session.refresh(stored_item)
+        await catalog_cache.invalidate('product:list', f'product:{id}')
 
         return {
             'status': 'success',
             'data': stored_item,
             'details': None
         }
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(e)
+        })
     except Exception as e:
         raise HTTPException(status_code=500, detail={
             'status': 'error',
@@ -280,6 +734,8 @@ async def delete_product_by_id(
         stmt = delete(md.Product).where(md.Product.id == id)
         await session.execute(stmt)
         await session.commit()
+        await catalog_cache.invalidate(
+            'product:list', f'product:{id}', 'stock:list', f'stock:{id}')
 
         return {
             'status': 'success',
@@ -299,13 +755,20 @@ async def delete_product_by_id(
 @router.get('/products/{product_id}/reviews', response_model=Response[List[sc.Review]])
 async def get_reviews_by_product_id(
     product_id: int,
+    limit: int = Query(25, ge=1, le=100),
+    cursor: Optional[str] = None,
     session: AsyncSession = Depends(get_async_session)
 ):
+    '''
+    Reviews of a product, newest first.
+    Pass next_cursor from the previous page as cursor to get the next one.
+    '''
     try:
-        query = select(md.Review).where(md.Review.product_id == product_id)
-        result = await session.execute(query)
+        reviews, next_cursor = await ut.get_reviews_page(product_id, cursor, limit, session)
 
-        return ResponseData(result.scalars().all())
+        return ResponseData(reviews, next_cursor=next_cursor, schema=sc.Review)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail={
             'status': 'error',
@@ -318,20 +781,25 @@ async def get_reviews_by_product_id(
 
 
 @router.get('/stocks/list', response_model=Response[List[sc.Stock]])
+@catalog_cache.cached(tags=lambda **_: ['stock:list'])
 async def get_stocks_list(
-    limit: int = 25,
-    offset: int = 0,
+    limit: int = Query(25, ge=1, le=100),
+    cursor: Optional[str] = None,
     session: AsyncSession = Depends(get_async_session)
 ):
     '''
-    Getting a list of stock
+    Getting a list of stock.
+    Pass next_cursor from the previous page as cursor to get the next one.
     '''
+    query = apply_keyset(select(md.Stock), (md.Stock.id,), cursor, limit,
+                         parsers=(parse_int,))
+
     try:
-        query = select(md.Stock).limit(limit).offset(offset)
         result = await session.execute(query)
-        stocks = result.scalars().all()
+        stocks, next_cursor = split_page(
+            result.scalars().all(), limit, key=lambda stock: [stock.id])
 
-        return ResponseData(stocks)
+        return ResponseData(stocks, next_cursor=next_cursor, schema=sc.Stock)
     except Exception as e:
         raise HTTPException(status_code=500, detail={
             'status': 'error',
@@ -353,7 +821,47 @@ async def create_stocks(
             stock = md.Stock(**new_stock.dict())
             session.add(stock)
             await session.commit()
-        return ResponseData(stock)
+        await catalog_cache.invalidate('stock:list', f'stock:{stock.product_id}')
+        return ResponseData(stock, schema=sc.Stock)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(e)
+        })
+
+
+@router.post('/stocks/import', response_model=Response[sc.StockImportResult])
+async def import_stocks(
+    file: UploadFile = File(...),
+    session: AsyncSession = Depends(get_async_session)
+):
+    '''
+    Bulk upsert of stock quantities from a CSV (warehouse_id,product_id,quantity header)
+    or NDJSON file. Existing warehouse/product pairs get the new quantity, less the units
+    held by active reservations.
+    '''
+    try:
+        async with session.begin():
+            report = await stock_import.import_stocks(file, session)
+            await session.commit()
+
+        await catalog_cache.invalidate(
+            'stock:list', *(f'stock:{product_id}' for product_id in report.product_ids))
+        return ResponseData(report.as_dict())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={
+            'status': 'error',
+            'data': None,
+            'details': str(e)
+        })
+    except SQLAlchemyError as e:
+        error = str(e.__dict__['orig'])
+        raise HTTPException(status_code=500, detail={
+            'status': 'error',
+            'data': error,
+            'details': None
+        })
     except Exception as e:
         raise HTTPException(status_code=500, detail={
             'status': 'error',
@@ -372,7 +880,7 @@ async def update_stock(
     Update(Patch) for stock
     '''
     try:
-        stmt = select(md.Stock).filter(md.Stock.id == id)
+        stmt = select(md.Stock).filter(md.Stock.id == id).with_for_update()
         result = await session.execute(stmt)
         stored_item = result.scalar_one_or_none()
 
@@ -383,18 +891,33 @@ async def update_stock(
                 'details': 'Object not found'
             })
 
+        previous_product_id = stored_item.product_id
         update_data = updated_data.dict(exclude_unset=True)
+        if 'quantity' in update_data:
+            # The new quantity is what is on hand, units held by active reservations stay taken
+            held = await checkout.held_quantity(id, session)
+            if update_data['quantity'] < held:
+                raise HTTPException(status_code=409, detail={
+                    'status': 'error',
+                    'data': {'held': held},
+                    'details': f'{held} units of the stock are reserved'
+                })
+            update_data['quantity'] -= held
         for field, value in update_data.items():
             setattr(stored_item, field, value)
 
         await session.commit()
         await session.refresh(stored_item)
+        await catalog_cache.invalidate(
+            'stock:list', f'stock:{previous_product_id}', f'stock:{stored_item.product_id}')
 
         return {
             'status': 'success',
             'data': stored_item,
             'details': None
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail={
             'status': 'error',
@@ -412,9 +935,11 @@ async def delete_stock(
     Delete stock by id
     '''
     try:
-        stmt = delete(md.Stock).where(md.Stock.id == id)
-        await session.execute(stmt)
+        stmt = delete(md.Stock).where(md.Stock.id == id).returning(md.Stock.product_id)
+        product_ids = (await session.execute(stmt)).scalars().all()
         await session.commit()
+        await catalog_cache.invalidate(
+            'stock:list', *(f'stock:{product_id}' for product_id in product_ids))
 
         return {
             'status': 'success',
@@ -441,7 +966,7 @@ async def get_warehouses_list(session: AsyncSession = Depends(get_async_session)
             md.Warehouse.stocks))
         result = await session.execute(query)
 
-        return ResponseData(result.scalars().all())
+        return ResponseData(result.scalars().all(), schema=sc.Warehouse)
     except Exception as e:
         raise HTTPException(status_code=500, detail={
             'status': 'error',
@@ -526,9 +1051,15 @@ async def delete_warehouse(
     Delete warehouse by id
     '''
     try:
+        # Stocks of the warehouse are removed by ON DELETE CASCADE
+        query = select(md.Stock.product_id).where(md.Stock.warehouse_id == id)
+        product_ids = (await session.execute(query)).scalars().all()
+
         stmt = delete(md.Warehouse).where(md.Warehouse.id == id)
         await session.execute(stmt)
         await session.commit()
+        await catalog_cache.invalidate(
+            'stock:list', *(f'stock:{product_id}' for product_id in product_ids))
 
         return {
             'status': 'success',
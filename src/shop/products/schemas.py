@@ -1,8 +1,11 @@
 from typing import List, Optional
 from datetime import datetime
+from enum import Enum
 
 import json
 
+from pydantic import validator
+
 from schemas import BaseOrmModel
 
 
@@ -28,6 +31,13 @@ class CategoryCreate(CategoryBase):
         return value
 
 
+class CategoryUpdate(BaseOrmModel):
+    name: Optional[str] = None
+    discount: Optional[int] = None
+    is_active: Optional[bool] = None
+    parent_id: Optional[int] = None
+
+
 class Category(CategoryBase):
     id: int
     photo_url: Optional[str] = None
@@ -49,6 +59,19 @@ class Stock(StockBase):
     id: int
 
 
+class StockImportReject(BaseOrmModel):
+    line: int
+    error: str
+
+
+class StockImportResult(BaseOrmModel):
+    received: int
+    imported: int
+    rejected: int
+    rejects: List[StockImportReject]
+    rows_per_second: Optional[float] = None
+
+
 # Product schemas
 
 
@@ -85,14 +108,77 @@ class ProductUpdate(ProductBase):
         return value
 
 
+class ProductOrdering(str, Enum):
+    id = 'id'
+    price = 'price'
+    category_id = 'category_id'
+
+
+class ProductBatchCreate(ProductBase):
+    pass
+
+
+class ProductBatchUpdate(BaseOrmModel):
+    id: int
+    name: Optional[str] = None
+    articul: Optional[str] = None
+    description: Optional[str] = None
+    is_active: Optional[bool] = None
+    price: Optional[float] = None
+    category_id: Optional[int] = None
+
+    @validator('name', 'articul', 'is_active', 'price', 'category_id')
+    def not_null(cls, value):
+        # Optional only so it can be left out, the columns are NOT NULL
+        if value is None:
+            raise ValueError('may be omitted but not null')
+        return value
+
+
+class ProductBatchResult(BaseOrmModel):
+    ids: List[int]
+
+
+class ProductPhoto(BaseOrmModel):
+    id: int
+    product_id: int
+    photo_url: str
+
+
 class ProductForList(ProductBase):
     id: int
-    photos: List
+    stock_quantity: int = 0
+    stock_warehouses: int = 0
+    in_stock: bool = False
+    photos: List[ProductPhoto]
 
 
-class Product(ProductForList):
-    stocks: List[Stock]
-    reviews: List
+class CategoryFacet(BaseOrmModel):
+    category_id: Optional[int] = None
+    count: int
+
+
+class PriceFacet(BaseOrmModel):
+    price_from: float
+    price_to: Optional[float] = None
+    count: int
+
+
+class AvailabilityFacet(BaseOrmModel):
+    in_stock: bool
+    count: int
+
+
+class ProductFacets(BaseOrmModel):
+    categories: List[CategoryFacet]
+    prices: List[PriceFacet]
+    availability: List[AvailabilityFacet]
+
+
+class ProductFilterResult(BaseOrmModel):
+    products: List[ProductForList]
+    facets: Optional[ProductFacets] = None
+
 
 ### Reviews ###
 
@@ -145,3 +231,23 @@ class ReviwsCreate(ReviewBase):
 
 class Review(ReviewBase):
     id: int
+    created_at: datetime
+
+
+class ProductRating(BaseOrmModel):
+    count: int
+    average: Optional[float] = None
+    star_1: int
+    star_2: int
+    star_3: int
+    star_4: int
+    star_5: int
+
+
+# Product detail schema
+
+
+class Product(ProductForList):
+    rating: Optional[ProductRating] = None
+    reviews: List[Review]
+    reviews_next_cursor: Optional[str] = None
@@ -0,0 +1,197 @@
+import csv
+import json
+import time
+from typing import AsyncIterator, List, Optional, Tuple
+
+from fastapi import UploadFile
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import UPLOAD_CHUNK_SIZE
+from shop.checkout.service import HELD_SQL
+
+
+COLUMNS = ('warehouse_id', 'product_id', 'quantity')
+# Rows sent to COPY at once, bounds memory for files of any size
+COPY_BATCH_SIZE = 10000
+# Rejects listed in the response, the rest is only counted
+MAX_REPORTED_REJECTS = 1000
+
+StockRow = Tuple[int, int, int, int]
+
+# Range of the integer columns of the staging table, larger values would fail the whole COPY
+INT4_MIN, INT4_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+class StockImportReport:
+    def __init__(self):
+        self.received = 0
+        self.imported = 0
+        self.rejected = 0
+        self.rejects: List[dict] = []
+        self.product_ids: List[int] = []
+        self._started_at = time.perf_counter()
+
+    def reject(self, line: int, error: str):
+        self.rejected += 1
+        if len(self.rejects) < MAX_REPORTED_REJECTS:
+            self.rejects.append({'line': line, 'error': error})
+
+    def as_dict(self) -> dict:
+        elapsed = time.perf_counter() - self._started_at
+        return {
+            'received': self.received,
+            'imported': self.imported,
+            'rejected': self.rejected,
+            'rejects': self.rejects,
+            'rows_per_second': round(self.received / elapsed, 1) if elapsed else None,
+        }
+
+
+def is_ndjson(upload: UploadFile) -> bool:
+    filename = (upload.filename or '').lower()
+    return filename.endswith(('.ndjson', '.jsonl')) or upload.content_type in (
+        'application/x-ndjson', 'application/jsonl', 'application/json')
+
+
+async def iter_lines(upload: UploadFile) -> AsyncIterator[str]:
+    '''
+    Decoded lines of the upload, read chunk by chunk.
+    '''
+    tail = b''
+    while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8-sig').rstrip('\r')
+    if tail:
+        yield tail.decode('utf-8-sig').rstrip('\r')
+
+
+def parse_int(column: str, value) -> int:
+    # Floats from NDJSON would be truncated by int(), CSV values are strings
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f'{column} must be an integer')
+    value = int(value)
+    if not INT4_MIN <= value <= INT4_MAX:
+        raise ValueError(f'{column} is out of range')
+    return value
+
+
+def parse_values(line: int, values) -> StockRow:
+    warehouse_id, product_id, quantity = (
+        parse_int(column, value) for column, value in zip(COLUMNS, values))
+    if quantity < 0:
+        raise ValueError('quantity must not be negative')
+    return line, warehouse_id, product_id, quantity
+
+
+async def iter_rows(upload: UploadFile, report: StockImportReport) -> AsyncIterator[StockRow]:
+    '''
+    Valid rows of a CSV (with a warehouse_id,product_id,quantity header) or NDJSON upload.
+    Invalid rows are recorded in the report.
+    '''
+    ndjson = is_ndjson(upload)
+    header: Optional[List[str]] = None
+    line = 0
+    async for raw in iter_lines(upload):
+        line += 1
+        if not raw.strip():
+            continue
+        if not ndjson and header is None:
+            header = [name.strip() for name in next(csv.reader([raw]))]
+            missing = set(COLUMNS) - set(header)
+            if missing:
+                raise ValueError(f'CSV header misses columns: {", ".join(sorted(missing))}')
+            continue
+
+        report.received += 1
+        try:
+            if ndjson:
+                item = json.loads(raw)
+                values = [item[column] for column in COLUMNS]
+            else:
+                item = dict(zip(header, next(csv.reader([raw]))))
+                values = [item[column] for column in COLUMNS]
+            yield parse_values(line, values)
+        except KeyError as e:
+            report.reject(line, f'Missing column {e}')
+        except (ValueError, TypeError) as e:
+            report.reject(line, f'Invalid row: {e}')
+
+
+async def import_stocks(upload: UploadFile, session: AsyncSession) -> StockImportReport:
+    '''
+    COPY the upload into a temporary staging table and merge it into stock with one
+    INSERT ... ON CONFLICT. The last row wins when a file repeats a warehouse/product pair,
+    imported counts the stock rows written, so such repeats count once. Quantities are on
+    hand: units held by active reservations are taken off, a last row below them is
+    rejected and leaves the pair as it was.
+    Must run inside a transaction, the staging table is dropped on commit.
+    '''
+    report = StockImportReport()
+
+    await session.execute(text(
+        'CREATE TEMP TABLE stock_import '
+        '(line integer, warehouse_id integer, product_id integer, quantity integer) '
+        'ON COMMIT DROP'))
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+    driver_connection = raw_connection.driver_connection
+
+    batch: List[StockRow] = []
+    async for row in iter_rows(upload, report):
+        batch.append(row)
+        if len(batch) >= COPY_BATCH_SIZE:
+            await driver_connection.copy_records_to_table(
+                'stock_import', records=batch, columns=('line',) + COLUMNS)
+            batch = []
+    if batch:
+        await driver_connection.copy_records_to_table(
+            'stock_import', records=batch, columns=('line',) + COLUMNS)
+
+    unknown = await session.execute(text(
+        'SELECT s.line, p.id IS NULL AS no_product, w.id IS NULL AS no_warehouse '
+        'FROM stock_import s '
+        'LEFT JOIN product p ON p.id = s.product_id '
+        'LEFT JOIN warehouse w ON w.id = s.warehouse_id '
+        'WHERE p.id IS NULL OR w.id IS NULL ORDER BY s.line'))
+    for line, no_product, no_warehouse in unknown:
+        report.reject(line, 'Unknown product' if no_product else 'Unknown warehouse')
+
+    # The last row wins when a file repeats a warehouse/product pair, the earlier ones are
+    # dropped before checking the holds, so a rejected last row does not let them through
+    await session.execute(text(
+        'DELETE FROM stock_import WHERE line IN ('
+        'SELECT line FROM ('
+        'SELECT line, row_number() OVER ('
+        'PARTITION BY warehouse_id, product_id ORDER BY line DESC) AS position '
+        'FROM stock_import) ranked WHERE position > 1)'))
+
+    # Locked so no checkout changes the holds of these rows before the commit
+    await session.execute(text(
+        'SELECT stock.id FROM stock '
+        'JOIN stock_import s ON s.warehouse_id = stock.warehouse_id AND s.product_id = stock.product_id '
+        'ORDER BY stock.id FOR UPDATE OF stock'))
+    short = await session.execute(text(
+        'DELETE FROM stock_import s '
+        f'USING stock, LATERAL ({HELD_SQL.format(stock_id="stock.id")}) AS held(quantity) '
+        'WHERE stock.warehouse_id = s.warehouse_id AND stock.product_id = s.product_id '
+        'AND s.quantity < held.quantity '
+        'RETURNING s.line, held.quantity'))
+    for line, held in sorted(short.all()):
+        report.reject(line, f'Quantity is below the {held} reserved units')
+
+    merged = await session.execute(text(
+        'INSERT INTO stock (warehouse_id, product_id, quantity) '
+        'SELECT s.warehouse_id, s.product_id, s.quantity '
+        'FROM stock_import s '
+        'JOIN product p ON p.id = s.product_id '
+        'JOIN warehouse w ON w.id = s.warehouse_id '
+        'ON CONFLICT (warehouse_id, product_id) DO UPDATE '
+        f'SET quantity = EXCLUDED.quantity - ({HELD_SQL.format(stock_id="stock.id")}) '
+        'RETURNING product_id'))
+    product_ids = merged.scalars().all()
+    report.product_ids = sorted(set(product_ids))
+    report.imported = len(product_ids)
+    return report
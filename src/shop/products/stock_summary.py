@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import STOCK_SUMMARY_INTERVAL, STOCK_SUMMARY_BATCH_SIZE
+from database import async_session_maker
+
+
+logger = logging.getLogger(__name__)
+
+# Takes a batch of the stock changes appended by the product_stock_summary trigger and adds
+# them to the product rows, locked in id order so concurrent folds cannot deadlock.
+# Changes of deleted products are dropped with the batch.
+FOLD_SQL = '''
+WITH taken AS (
+    DELETE FROM product_stock_delta
+    WHERE id IN (
+        SELECT id FROM product_stock_delta ORDER BY id LIMIT :batch_size FOR UPDATE SKIP LOCKED
+    )
+    RETURNING product_id, quantity, warehouses
+), changes AS (
+    SELECT product_id, sum(quantity)::integer AS quantity, sum(warehouses)::integer AS warehouses
+    FROM taken GROUP BY product_id
+), locked AS (
+    SELECT id FROM product WHERE id IN (SELECT product_id FROM changes) ORDER BY id FOR UPDATE
+), folded AS (
+    UPDATE product SET stock_quantity = product.stock_quantity + changes.quantity,
+                       stock_warehouses = product.stock_warehouses + changes.warehouses
+    FROM changes
+    WHERE product.id = changes.product_id AND product.id IN (SELECT id FROM locked)
+      AND (changes.quantity <> 0 OR changes.warehouses <> 0)
+    RETURNING product.id
+)
+SELECT (SELECT count(*) FROM taken) AS taken,
+       (SELECT array_agg(id) FROM folded) AS product_ids
+'''
+
+
+async def fold_stock_changes(session: AsyncSession,
+                             batch_size: int = STOCK_SUMMARY_BATCH_SIZE) -> Tuple[int, List[int]]:
+    '''
+    Fold one batch of pending stock changes into the product stock summary.
+    Returns the number of changes taken and the product ids whose summary changed.
+    '''
+    async with session.begin():
+        row = (await session.execute(text(FOLD_SQL), {'batch_size': batch_size})).one()
+        return row.taken, sorted(row.product_ids or [])
+
+
+class StockSummaryFolder:
+    '''
+    Background task keeping product.stock_quantity/stock_warehouses/in_stock up to date,
+    they trail stock by about STOCK_SUMMARY_INTERVAL seconds.
+    on_fold receives the product ids whose summary changed.
+    '''
+
+    def __init__(self, interval: float = STOCK_SUMMARY_INTERVAL, on_fold=None):
+        self.interval = interval
+        self.on_fold = on_fold
+        self._task: Optional[asyncio.Task] = None
+
+    async def fold(self) -> int:
+        folded = 0
+        while True:
+            async with async_session_maker() as session:
+                count, product_ids = await fold_stock_changes(session)
+            if not count:
+                return folded
+            folded += count
+            if self.on_fold is not None and product_ids:
+                await self.on_fold(product_ids)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.fold()
+            except Exception:
+                logger.exception('Stock summary fold failed, retrying in %ss', self.interval)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -1,38 +1,356 @@
-import tempfile
+import asyncio
+import logging
 import os
+import time
+import uuid
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, Type
 from fastapi import UploadFile, Depends
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
+from sqlalchemy import select, insert, delete, literal, func, tuple_
+from sqlalchemy.dialects.postgresql import array
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
+from cache import catalog_cache
 from database import get_async_session
+from pagination import apply_keyset, parse_int, split_page
+from serializers import encode
 from shop.products import models as md
+from shop.products import schemas as sc
 
 
-from aws_config import s3_client, AWS_FILTEPATH_GET
+from aws_config import s3_client, s3_transfer_config, AWS_FILTEPATH_GET
+from config import CATEGORY_TREE_TTL, AWS_BUCKET, S3_UPLOAD_CONCURRENCY, PRICE_FACET_BOUNDS
 
 
-test_bucket_name = 'bat_test'
+logger = logging.getLogger(__name__)
 
+# Bounds the uploads of all requests handled by this worker process
+upload_semaphore = asyncio.Semaphore(S3_UPLOAD_CONCURRENCY)
 
-async def save_product_photo(product: md.Product, photo: UploadFile, session: AsyncSession):
-    aws_filename = f'product_{product.id}.png'
-    s3_key = f'static/product/{aws_filename}'
 
-    # Сохраняем файл во временное хранилище
-    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-        temp_url = temp_file.name
-        temp_file.write(await photo.read())
+async def upload_product_photo(photo: UploadFile) -> str:
+    '''
+    Stream an uploaded photo to S3 from a worker thread and return its public url.
+    '''
+    extension = os.path.splitext(photo.filename or '')[1] or '.png'
+    s3_key = f'static/product/{uuid.uuid4().hex}{extension}'
+    extra_args = {'ContentType': photo.content_type} if photo.content_type else None
 
+    async with upload_semaphore:
+        await photo.seek(0)
+        await run_in_threadpool(
+            s3_client.upload_fileobj, photo.file, AWS_BUCKET, s3_key,
+            ExtraArgs=extra_args, Config=s3_transfer_config)
+
+    return f'{AWS_FILTEPATH_GET}/{s3_key}'
+
+
+async def delete_product_photos(photo_urls: List[str]):
+    '''
+    Remove uploaded photos from S3. Failures are logged, the objects are left behind.
+    '''
+    keys = [{'Key': photo_url[len(AWS_FILTEPATH_GET) + 1:]} for photo_url in photo_urls]
+    if not keys:
+        return
+    try:
+        await run_in_threadpool(s3_client.delete_objects, Bucket=AWS_BUCKET, Delete={'Objects': keys})
+    except Exception:
+        logger.exception('Could not delete orphaned photos %s', photo_urls)
+
+
+async def upload_product_photos(photos: List[UploadFile]) -> List[str]:
+    '''
+    Upload all photos of one request concurrently. When one fails the others are removed.
+    '''
+    results = await asyncio.gather(
+        *(upload_product_photo(photo) for photo in photos), return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        await delete_product_photos([result for result in results if isinstance(result, str)])
+        raise errors[0]
+    return results
+
+
+@asynccontextmanager
+async def uploaded_product_photos(photos: List[UploadFile]):
+    '''
+    Upload the photos and yield their urls. The photos are removed again when the block
+    raises, e.g. because the transaction storing them failed.
+    '''
+    photo_urls = await upload_product_photos(photos)
     try:
-        # Загружаем файл на сервер Amazon S3
-        s3_client.upload_file(temp_url, test_bucket_name, s3_key)
-
-        # Обновляем информацию о фотографии продукта
-        product_photo = md.ProductPhoto(product_id=product.id, photo_url=f'{AWS_FILTEPATH_GET}/{s3_key}')
-        session.add(product_photo)
-        await session.flush()
-
-        # return product_photo
-        print('Uploaded')
-    finally:
-        # Удаляем временный файл
-        os.remove(temp_url)
+        yield photo_urls
+    except BaseException:
+        await delete_product_photos(photo_urls)
+        raise
+
+
+async def save_product_photos(product_id: int, photo_urls: List[str], session: AsyncSession):
+    session.add_all([
+        md.ProductPhoto(product_id=product_id, photo_url=photo_url)
+        for photo_url in photo_urls
+    ])
+    await session.flush()
+
+
+# Reviews #
+
+
+async def get_reviews_page(
+    product_id: int, cursor: Optional[str], limit: int, session: AsyncSession
+) -> Tuple[List[md.Review], Optional[str]]:
+    '''
+    Newest reviews of a product first, paged by (created_at, id) on ix_review_product_id_created_at.
+    '''
+    keys = (md.Review.created_at, md.Review.id)
+    query = apply_keyset(
+        select(md.Review).where(md.Review.product_id == product_id), keys, cursor, limit,
+        descending=True, parsers=(datetime.fromisoformat, parse_int))
+    result = await session.execute(query)
+    return split_page(
+        result.scalars().all(), limit, key=lambda review: [review.created_at, review.id])
+
+
+# Product lists #
+
+
+# Schema fields a fields= parameter selects as plain columns, the other fields are relationships
+PRODUCT_COLUMNS = {
+    column.key: column for column in (
+        md.Product.id, md.Product.name, md.Product.articul, md.Product.description,
+        md.Product.is_active, md.Product.price, md.Product.category_id,
+        md.Product.stock_quantity, md.Product.stock_warehouses, md.Product.in_stock)
+}
+
+
+def parse_fields(fields: Optional[str], schema: Type[BaseModel]) -> Optional[List[str]]:
+    '''
+    Schema fields listed in a comma separated fields= parameter, None when it is not given.
+    Raises ValueError for names the schema does not have.
+    '''
+    if fields is None:
+        return None
+    names = {name.strip() for name in fields.split(',') if name.strip()}
+    unknown = names - set(schema.__fields__)
+    if unknown:
+        raise ValueError(f'Unknown fields: {", ".join(sorted(unknown))}')
+    if not names:
+        raise ValueError('No fields selected')
+    return [name for name in schema.__fields__ if name in names]
+
+
+def sparse_product_query(names: List[str], keys: Sequence = ()):
+    '''
+    Column only select of the requested fields. id (to attach relationships) and the
+    keyset keys (for the next cursor) are always selected.
+    '''
+    columns = {}
+    for column in [md.Product.id, *keys, *(PRODUCT_COLUMNS[name] for name in names if name in PRODUCT_COLUMNS)]:
+        columns.setdefault(column.key, column)
+    return select(*columns.values())
+
+
+async def load_sparse_relations(products: List[dict], names: List[str], session: AsyncSession):
+    '''
+    Attach the requested relationships to sparse products, one query per relationship.
+    '''
+    product_ids = [product['id'] for product in products]
+    if 'photos' in names:
+        photos = defaultdict(list)
+        result = await session.execute(select(md.ProductPhoto).where(
+            md.ProductPhoto.product_id.in_(product_ids)).order_by(md.ProductPhoto.id))
+        for photo in result.scalars():
+            photos[photo.product_id].append(encode(photo, sc.ProductPhoto))
+        for product in products:
+            product['photos'] = photos[product['id']]
+    if 'rating' in names:
+        result = await session.execute(select(md.ProductRating).where(
+            md.ProductRating.product_id.in_(product_ids)))
+        ratings = {rating.product_id: encode(rating, sc.ProductRating) for rating in result.scalars()}
+        for product in products:
+            product['rating'] = ratings.get(product['id'])
+
+
+def project(products: List[dict], names: List[str], schema: Type[BaseModel]) -> List[dict]:
+    # Numeric columns the schema declares as float (price) are numbers as in full responses
+    floats = {name for name in names if schema.__fields__[name].type_ is float}
+    projected = []
+    for product in products:
+        row = {name: product.get(name) for name in names}
+        for name in floats:
+            if row[name] is not None:
+                row[name] = float(row[name])
+        projected.append(row)
+    return projected
+
+
+# GROUPING() bitmask of (category_id, price_bucket, in_stock) for every grouping set
+FACET_GROUPINGS = {0b011: 'categories', 0b101: 'prices', 0b110: 'availability'}
+
+
+def product_facets_query(conditions: list):
+    '''
+    Scalar subquery counting the products matching the conditions per category, price
+    bucket and availability with one GROUPING SETS scan. Returns a JSON array of
+    [grouping, category_id, price_bucket, in_stock, count] rows, see parse_product_facets.
+    '''
+    matched = select(
+        md.Product.category_id,
+        md.Product.in_stock,
+        func.width_bucket(md.Product.price, array(PRICE_FACET_BOUNDS)).label('price_bucket'),
+    ).where(*conditions).subquery()
+    columns = (matched.c.category_id, matched.c.price_bucket, matched.c.in_stock)
+    rows = select(
+        func.grouping(*columns).label('grouping'), *columns, func.count().label('count'),
+    ).group_by(func.grouping_sets(*(tuple_(column) for column in columns))).subquery()
+    return select(func.json_agg(func.json_build_array(
+        rows.c.grouping, rows.c.category_id, rows.c.price_bucket, rows.c.in_stock, rows.c.count,
+    ))).scalar_subquery()
+
+
+def parse_product_facets(rows: Optional[list]) -> dict:
+    facets = {'categories': [], 'prices': [], 'availability': []}
+    for grouping, category_id, price_bucket, in_stock, count in rows or []:
+        name = FACET_GROUPINGS[grouping]
+        if name == 'categories':
+            facets[name].append({'category_id': category_id, 'count': count})
+        elif name == 'prices' and price_bucket is not None:
+            facets[name].append({
+                'price_from': PRICE_FACET_BOUNDS[price_bucket - 1] if price_bucket else 0,
+                'price_to': PRICE_FACET_BOUNDS[price_bucket] if price_bucket < len(PRICE_FACET_BOUNDS) else None,
+                'count': count,
+            })
+        elif name == 'availability':
+            facets[name].append({'in_stock': in_stock, 'count': count})
+    for items, key in ((facets['categories'], 'category_id'), (facets['prices'], 'price_from')):
+        items.sort(key=lambda item: (item[key] is None, item[key] or 0))
+    return facets
+
+
+# Category tree #
+
+
+# Namespace of the advisory lock serialising changes of the closure table
+TREE_LOCK_NAMESPACE = 7003
+
+
+async def lock_category_tree(session: AsyncSession):
+    '''
+    Hold the category tree until the transaction ends, so a move checks for cycles
+    against a tree no other move or insert is changing.
+    '''
+    await session.execute(select(func.pg_advisory_xact_lock(TREE_LOCK_NAMESPACE)))
+
+
+async def add_category_to_tree(category: md.Category, session: AsyncSession):
+    '''
+    Link a flushed category with itself and with every ancestor of its parent.
+    '''
+    closure = md.CategoryClosure
+    await lock_category_tree(session)
+    ancestors = select(
+        closure.ancestor_id, literal(category.id), closure.depth + 1
+    ).where(closure.descendant_id == category.parent_id)
+    itself = select(literal(category.id), literal(category.id), literal(0))
+
+    await session.execute(insert(closure).from_select(
+        ['ancestor_id', 'descendant_id', 'depth'], ancestors.union_all(itself)))
+
+
+async def move_category_in_tree(category: md.Category, parent_id: Optional[int], session: AsyncSession):
+    '''
+    Re-attach the subtree of a category under a new parent (None makes it a root).
+    Raises ValueError when the parent does not exist or is inside the subtree.
+    '''
+    closure = md.CategoryClosure
+    await lock_category_tree(session)
+
+    if parent_id is not None:
+        parent = await session.scalar(select(md.Category.id).where(md.Category.id == parent_id))
+        if parent is None:
+            raise ValueError(f'Parent category {parent_id} does not exist')
+        query = select(closure.ancestor_id).where(
+            closure.ancestor_id == category.id, closure.descendant_id == parent_id)
+        if (await session.execute(query)).first() is not None:
+            raise ValueError('Category cannot be moved into its own subtree')
+
+    subtree = select(closure.descendant_id).where(
+        closure.ancestor_id == category.id)
+    old_ancestors = select(closure.ancestor_id).where(
+        closure.descendant_id == category.id, closure.ancestor_id != category.id)
+    await session.execute(delete(closure).where(
+        closure.descendant_id.in_(subtree), closure.ancestor_id.in_(old_ancestors)))
+
+    if parent_id is not None:
+        upper = aliased(closure)
+        lower = aliased(closure)
+        links = select(
+            upper.ancestor_id, lower.descendant_id, upper.depth + lower.depth + 1
+        ).where(upper.descendant_id == parent_id, lower.ancestor_id == category.id)
+        await session.execute(insert(closure).from_select(
+            ['ancestor_id', 'descendant_id', 'depth'], links))
+
+    category.parent_id = parent_id
+
+
+class CategoryTreeCache:
+    '''
+    In-process copy of the closure table: category id -> ids of the category and all its descendants.
+
+    The copy is tagged with the version version() returns when it is loaded (the catalog
+    cache version of category:list, bumped by every category write) and reloaded once the
+    version moves, so no worker serves, or caches a response built from, a tree older than
+    the version. Without a version (no Redis) it is trusted for ttl seconds.
+    '''
+
+    def __init__(self, ttl: float, version: Optional[Callable[[], Awaitable[Optional[str]]]] = None):
+        self.ttl = ttl
+        self.version = version
+        self._subtrees: Optional[Dict[int, List[int]]] = None
+        self._loaded_at = 0.0
+        self._loaded_version: Optional[str] = None
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self._subtrees = None
+
+    def _needs_reload(self, category_id: int, version: Optional[str]) -> bool:
+        if self._subtrees is None:
+            return True
+        if version is not None:
+            return version != self._loaded_version
+        age = time.monotonic() - self._loaded_at
+        # Unknown ids may belong to categories created by another worker,
+        # but they must not turn every request into a reload.
+        return age >= self.ttl or (category_id not in self._subtrees and age >= 1)
+
+    async def _load(self, session: AsyncSession, version: Optional[str]):
+        result = await session.execute(select(
+            md.CategoryClosure.ancestor_id, md.CategoryClosure.descendant_id))
+        subtrees: Dict[int, List[int]] = {}
+        for ancestor_id, descendant_id in result:
+            subtrees.setdefault(ancestor_id, []).append(descendant_id)
+        self._subtrees = subtrees
+        self._loaded_at = time.monotonic()
+        self._loaded_version = version
+
+    async def get_subtree(self, session: AsyncSession, category_id: int) -> List[int]:
+        '''
+        Ids of the category and all of its descendants, empty if the category does not exist.
+        '''
+        # Read before the tree, which then holds at least every write of this version
+        version = await self.version() if self.version is not None else None
+        if self._needs_reload(category_id, version):
+            async with self._lock:
+                if self._needs_reload(category_id, version):
+                    await self._load(session, version)
+        return self._subtrees.get(category_id, [])
+
+
+category_tree = CategoryTreeCache(
+    ttl=CATEGORY_TREE_TTL, version=lambda: catalog_cache.version('category:list'))
@@ -1,6 +1,7 @@
 from fastapi import APIRouter
 from .products.router import router as product_router
 from .cart.router import router as cart_router
+from .checkout.router import router as checkout_router
 
 
 router = APIRouter(
@@ -9,3 +10,4 @@ router = APIRouter(
 
 router.include_router(product_router)
 router.include_router(cart_router)
+router.include_router(checkout_router)
@@ -0,0 +1,103 @@
+import logging
+import os
+import uuid
+from contextlib import asynccontextmanager
+from typing import List
+
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+
+from config import UPLOAD_DIR, UPLOAD_MAX_SIZE, UPLOAD_CHUNK_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class LocalFileStorage:
+    '''
+    Stores uploads on the local disk.
+    Files are streamed chunk by chunk and written from the threadpool, so neither
+    memory use nor event loop blocking depends on the size of the file.
+    '''
+
+    def __init__(self, root: str, max_size: int, chunk_size: int):
+        self.root = root
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def _claim(temp_path: str, path: str) -> str:
+        '''
+        Move the finished file to path, or next to it under a unique name when path is taken:
+        a file referenced by another row is never replaced.
+        '''
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            stem, extension = os.path.splitext(path)
+            path = f'{stem}-{uuid.uuid4().hex[:12]}{extension}'
+            os.link(temp_path, path)
+        os.remove(temp_path)
+        return path
+
+    async def save(self, upload: UploadFile, folder: str = '') -> str:
+        '''
+        Save the upload under root/folder and return its path.
+        Raises UploadTooLarge once more than max_size bytes were received.
+        '''
+        directory = os.path.join(self.root, folder)
+        path = os.path.join(directory, os.path.basename(upload.filename or '') or uuid.uuid4().hex)
+        # Written under a temporary name so a rejected upload never leaves a partial file
+        temp_path = f'{path}.{uuid.uuid4().hex}.part'
+
+        await run_in_threadpool(os.makedirs, directory, exist_ok=True)
+        file = await run_in_threadpool(open, temp_path, 'wb')
+        try:
+            size = 0
+            while chunk := await upload.read(self.chunk_size):
+                size += len(chunk)
+                if size > self.max_size:
+                    raise UploadTooLarge(
+                        f'File {upload.filename} is larger than {self.max_size} bytes')
+                await run_in_threadpool(file.write, chunk)
+            await run_in_threadpool(file.close)
+            path = await run_in_threadpool(self._claim, temp_path, path)
+        except BaseException:
+            await run_in_threadpool(file.close)
+            await run_in_threadpool(os.remove, temp_path)
+            raise
+        return path
+
+    async def delete(self, *paths: str):
+        '''
+        Remove saved files. Failures are logged, the files are left behind.
+        '''
+        for path in paths:
+            try:
+                await run_in_threadpool(os.remove, path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logger.exception('Could not delete orphaned upload %s', path)
+
+    @asynccontextmanager
+    async def saved(self, uploads: List[UploadFile], folder: str = ''):
+        '''
+        Save the uploads and yield their paths. The files are removed again when saving one
+        of them or the block raises, e.g. because the transaction storing the paths failed.
+        '''
+        paths = []
+        try:
+            for upload in uploads:
+                paths.append(await self.save(upload, folder))
+            yield paths
+        except BaseException:
+            await self.delete(*paths)
+            raise
+
+
+storage = LocalFileStorage(UPLOAD_DIR, UPLOAD_MAX_SIZE, UPLOAD_CHUNK_SIZE)
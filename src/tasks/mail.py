@@ -0,0 +1,176 @@
+'''
+Mail delivery of the Celery workers: a per-process pool of authenticated SMTP connections
+and a Redis outbox that groups queued messages into batches.
+
+Point SMTP_HOST/SMTP_PORT at a local debugging server to try it out, e.g.
+
+    python -m smtpd -n -c DebuggingServer localhost:1025
+    SMTP_HOST=localhost SMTP_PORT=1025 SMTP_SSL=false celery -A tasks.tasks worker
+'''
+import json
+import logging
+import os
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+from redis import Redis
+
+from config import SMTP_HOST, SMTP_PORT, SMTP_SSL, SMTP_USER, SMTP_PASSWORD, SMTP_POOL_SIZE, \
+    SMTP_IDLE_TIMEOUT, MAIL_BATCH_DELAY, MAIL_DEDUPE_TTL, REDIS_URL
+
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPPool:
+    '''
+    Authenticated SMTP connections reused across tasks of one worker process.
+
+    Connections inherited from a parent process are dropped, connections idle for longer
+    than idle_timeout are checked with NOOP before reuse. A connection is discarded when
+    the server drops it while in use.
+    '''
+
+    def __init__(self, host: str = SMTP_HOST, port: int = SMTP_PORT, use_ssl: bool = SMTP_SSL,
+                 user: Optional[str] = SMTP_USER, password: Optional[str] = SMTP_PASSWORD,
+                 size: int = SMTP_POOL_SIZE, idle_timeout: int = SMTP_IDLE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.user = user
+        self.password = password
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle: List[Tuple[float, smtplib.SMTP]] = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _connect(self) -> smtplib.SMTP:
+        server = (smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP)(self.host, self.port)
+        if self.user:
+            server.login(self.user, self.password)
+        return server
+
+    @staticmethod
+    def _close(server: smtplib.SMTP):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    def _acquire(self) -> smtplib.SMTP:
+        with self._lock:
+            if self._pid != os.getpid():
+                # The sockets belong to the parent process
+                self._idle = []
+                self._pid = os.getpid()
+            while self._idle:
+                released_at, server = self._idle.pop()
+                if time.monotonic() - released_at < self.idle_timeout:
+                    return server
+                try:
+                    if server.noop()[0] == 250:
+                        return server
+                except (smtplib.SMTPException, OSError):
+                    pass
+                server.close()
+        return self._connect()
+
+    def _release(self, server: smtplib.SMTP):
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.size:
+                self._idle.append((time.monotonic(), server))
+                return
+        self._close(server)
+
+    @contextmanager
+    def connection(self):
+        server = self._acquire()
+        try:
+            yield server
+        except (smtplib.SMTPServerDisconnected, OSError):
+            server.close()
+            raise
+        except BaseException:
+            self._release(server)
+            raise
+        self._release(server)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, server in idle:
+            self._close(server)
+
+
+class MailOutbox:
+    '''
+    Redis list of queued messages, delivered in batches by a Celery task.
+
+    push() drops a message while an identical one (same kind and user) is still queued.
+    The first message of a batch reports that delivery has to be scheduled, the others
+    join the batch until delivery starts.
+    '''
+
+    def __init__(self, redis: Redis, prefix: str = 'mail', dedupe_ttl: int = MAIL_DEDUPE_TTL,
+                 batch_delay: float = MAIL_BATCH_DELAY):
+        self.redis = redis
+        self.prefix = prefix
+        self.dedupe_ttl = dedupe_ttl
+        self.batch_delay = batch_delay
+
+    @property
+    def _queue_key(self) -> str:
+        return f'{self.prefix}:outbox'
+
+    @property
+    def _scheduled_key(self) -> str:
+        return f'{self.prefix}:scheduled'
+
+    def _pending_key(self, kind: str, user_id: int) -> str:
+        return f'{self.prefix}:pending:{kind}:{user_id}'
+
+    def push(self, kind: str, user_id: int, **payload) -> Tuple[bool, bool]:
+        '''
+        Queue a message. Returns (queued, schedule): False when an identical message is
+        already pending, schedule when the caller has to start delivery of the batch.
+        '''
+        key = self._pending_key(kind, user_id)
+        if not self.redis.set(key, 1, nx=True, ex=self.dedupe_ttl):
+            return False, False
+        entry = json.dumps({'kind': kind, 'user_id': user_id, 'key': key, **payload})
+        pipe = self.redis.pipeline()
+        pipe.rpush(self._queue_key, entry)
+        # Expires on its own should the scheduled delivery get lost
+        pipe.set(self._scheduled_key, 1, nx=True, ex=max(int(self.batch_delay * 10), 60))
+        _, schedule = pipe.execute()
+        return True, bool(schedule)
+
+    def start_batch(self):
+        '''
+        Let messages queued from now on schedule another delivery.
+        '''
+        self.redis.delete(self._scheduled_key)
+
+    def pop(self, count: int) -> List[dict]:
+        # LRANGE + LTRIM in MULTI rather than LPOP with a count, which needs Redis 6.2
+        pipe = self.redis.pipeline()
+        pipe.lrange(self._queue_key, 0, count - 1)
+        pipe.ltrim(self._queue_key, count, -1)
+        entries, _ = pipe.execute()
+        return [json.loads(entry) for entry in entries]
+
+    def requeue(self, entries: List[dict]):
+        if entries:
+            self.redis.lpush(self._queue_key, *(json.dumps(entry) for entry in reversed(entries)))
+
+    def done(self, entries: List[dict]):
+        if entries:
+            self.redis.delete(*(entry['key'] for entry in entries))
+
+
+smtp_pool = SMTPPool()
+outbox = MailOutbox(Redis.from_url(REDIS_URL, decode_responses=True))
@@ -2,7 +2,7 @@ from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import SQLAlchemyError
 
-from auth.base_config import current_user
+from auth.base_config import current_db_user
 from .tasks import get_email_template_dashboard, send_email_report_dashboard
 
 router = APIRouter(
@@ -12,10 +12,10 @@ router = APIRouter(
 
 
 @router.get('/dashboard')
-def get_task(user=Depends(current_user)):
-    send_email_report_dashboard.delay(user.username)
+def get_task(user=Depends(current_db_user)):
+    queued = send_email_report_dashboard(user.id, user.email, user.email)
     return {
         'status': '200',
-        'data': 'Письмо отправлено',
+        'data': 'Письмо отправлено' if queued else 'Письмо уже в очереди',
         'details': None
     }
@@ -1,36 +1,144 @@
+import asyncio
+import logging
 import smtplib
 from email.message import EmailMessage
+from html import escape
+from typing import Dict
 
 from celery import Celery
-from config import SMTP_USER, SMTP_PASSWORD
+from celery.signals import worker_process_shutdown
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import NullPool
 
-SMTP_HOST = "smtp.gmail.com"
-SMTP_PORT = 465
+from config import SMTP_USER, MAIL_BATCH_DELAY, MAIL_BATCH_SIZE
+from database import DATABASE_URL
+from shop.models import *  # noqa: F401,F403
+from shop.dashboard import service as dashboard
+from .mail import outbox, smtp_pool
+
+
+logger = logging.getLogger(__name__)
 
 celery = Celery('tasks', broker='redis://localhost:6379')
 
-def get_email_template_dashboard(username: str):
+# Categories listed in the report, by active products in their subtree
+REPORT_TOP_CATEGORIES = 10
+
+
+def load_dashboard_report() -> Dict[str, dict]:
+    '''
+    The stored dashboard report, refreshed when stale. Every task runs its own event loop,
+    so the connection is not pooled.
+    '''
+    async def load():
+        engine = create_async_engine(DATABASE_URL, poolclass=NullPool)
+        try:
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                return await dashboard.get_report(session)
+        finally:
+            await engine.dispose()
+    return asyncio.run(load())
+
+
+def html_table(headers: list, rows: list) -> str:
+    head = ''.join(f'<th align="left">{escape(str(header))}</th>' for header in headers)
+    body = ''.join(
+        '<tr>' + ''.join(f'<td>{escape(str(value if value is not None else "—"))}</td>' for value in row) + '</tr>'
+        for row in rows)
+    return f'<table cellpadding="4"><tr>{head}</tr>{body}</table>'
+
+
+def get_email_template_dashboard(username: str, to: str, report: Dict[str, dict]):
     email = EmailMessage()
     email['Subject'] = 'Натрейдил Отчет Дашборд'
     email['From'] = SMTP_USER
-    email['To'] = SMTP_USER
+    email['To'] = to
+
+    reviews = report.get('reviews', {})
+    warehouses = report.get('warehouses', {}).get('warehouses', [])
+    categories = report.get('categories', {}).get('categories', [])[:REPORT_TOP_CATEGORIES]
+    this_week = reviews.get('this_week', {})
+    previous_week = reviews.get('previous_week', {})
 
     email.set_content(
         '<div>'
-        f'<h1 style="color: red;">Здравствуйте, {username}, а вот и ваш отчет. Зацените 😊</h1>'
-        '<img src="https://static.vecteezy.com/system/resources/previews/008/295/031/original/custom-relationship'
-        '-management-dashboard-ui-design-template-suitable-designing-application-for-android-and-ios-clean-style-app'
-        '-mobile-free-vector.jpg" width="600">'
+        f'<h1 style="color: red;">Здравствуйте, {escape(username)}, а вот и ваш отчет. Зацените 😊</h1>'
+        '<h2>Остатки по складам</h2>'
+        + html_table(['Склад', 'Единиц', 'Товаров в наличии'],
+                     [(row['name'], row['quantity'], row['products']) for row in warehouses]) +
+        '<h2>Активные товары по категориям</h2>'
+        + html_table(['Категория', 'Товаров', 'С подкатегориями'],
+                     [(row['name'], row['products'], row['subtree_products']) for row in categories]) +
+        '<h2>Отзывы</h2>'
+        f'<p>Всего: {reviews.get("count", 0)}, средняя оценка: {reviews.get("average") or "—"}.<br>'
+        f'За неделю: {this_week.get("count", 0)} (средняя {this_week.get("average") or "—"}), '
+        f'неделей ранее: {previous_week.get("count", 0)} (средняя {previous_week.get("average") or "—"}).</p>'
+        + html_table(['День', 'Отзывов', 'Средняя оценка'],
+                     [(day['day'], day['count'], day['average']) for day in reviews.get('trend', [])]) +
         '</div>',
         subtype='html'
     )
     return email
 
 
-@celery.task
-def send_email_report_dashboard(username: str):
-    email = get_email_template_dashboard(username)
-    with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT) as server:
-        server.login(SMTP_USER, SMTP_PASSWORD)
-        server.send_message(email)
+TEMPLATES = {
+    'dashboard': lambda entry, report: get_email_template_dashboard(entry['username'], entry['to'], report),
+}
+
+
+def send_email_report_dashboard(user_id: int, username: str, to: str) -> bool:
+    '''
+    Queue the dashboard report of a user. Returns False when one is already pending.
+    '''
+    queued, schedule = outbox.push('dashboard', user_id, username=username, to=to)
+    if schedule:
+        deliver_mail.apply_async(countdown=MAIL_BATCH_DELAY)
+    return queued
+
+
+def send_batch(entries: list, report: Dict[str, dict]):
+    '''
+    Send a batch over one pooled connection. Messages the server refuses are dropped,
+    when sending fails otherwise the unsent rest goes back to the outbox.
+    '''
+    sent = 0
+    try:
+        with smtp_pool.connection() as server:
+            for entry in entries:
+                try:
+                    server.send_message(TEMPLATES[entry['kind']](entry, report))
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+                    logger.exception('Message to %s refused', entry.get('to'))
+                sent += 1
+    except BaseException:
+        outbox.requeue(entries[sent:])
+        raise
+    finally:
+        outbox.done(entries[:sent])
+
+
+# Any failure leaves the messages in the outbox, so every error schedules another attempt
+@celery.task(autoretry_for=(Exception,), retry_backoff=True, max_retries=5)
+def deliver_mail() -> int:
+    outbox.start_batch()
+    delivered = 0
+    report = None
+    while True:
+        entries = outbox.pop(MAIL_BATCH_SIZE)
+        if not entries:
+            return delivered
+        if report is None:
+            # Computed once for every message of the run
+            try:
+                report = load_dashboard_report()
+            except BaseException:
+                outbox.requeue(entries)
+                raise
+        send_batch(entries, report)
+        delivered += len(entries)
+
+
+@worker_process_shutdown.connect
+def close_smtp_connections(**kwargs):
+    smtp_pool.close()
         
\ No newline at end of file
@@ -0,0 +1,72 @@
+import pytest
+from fastapi_users import exceptions
+
+from auth import base_config
+from auth.base_config import CachedJWTStrategy
+from auth.utils import UserCache, detached_user
+
+
+class UserTable:
+    '''
+    Stands in for the user manager the strategy loads users through.
+    '''
+
+    def __init__(self, users: dict):
+        self.users = users
+        self.loads = []
+
+    def parse_id(self, value) -> int:
+        return int(value)
+
+    async def get(self, user_id: int):
+        self.loads.append(user_id)
+        if user_id not in self.users:
+            raise exceptions.UserNotExists()
+        return detached_user(self.users[user_id])
+
+
+def user_data(**flags) -> dict:
+    return {'id': 1, 'email': 'buyer@example.com', 'registered_at': None,
+            'is_active': True, 'is_superuser': False, 'is_verified': True, **flags}
+
+
+@pytest.fixture
+def user_cache(monkeypatch):
+    cache = UserCache(ttl=60, max_size=10, token_lifetime=3600)
+    monkeypatch.setattr(base_config, 'user_cache', cache)
+    return cache
+
+
+async def issue_token(strategy: CachedJWTStrategy, **flags) -> str:
+    return await strategy.write_token(detached_user(user_data(**flags)))
+
+
+async def test_trusted_strategy_uses_the_cache_and_the_claims(user_cache):
+    strategy = CachedJWTStrategy(secret='secret', lifetime_seconds=3600)
+    table = UserTable({1: user_data()})
+    token = await issue_token(strategy)
+
+    user = await strategy.read_token(token, table)
+
+    assert user.id == 1 and user.is_active
+    assert table.loads == []
+
+
+async def test_db_strategy_sees_a_user_deactivated_by_another_process(user_cache):
+    strategy = CachedJWTStrategy(secret='secret', lifetime_seconds=3600, trust_claims=False)
+    token = await issue_token(strategy)
+    # Cached as active here, deactivated through another worker since
+    user_cache.set(detached_user(user_data()))
+    table = UserTable({1: user_data(is_active=False)})
+
+    user = await strategy.read_token(token, table)
+
+    assert not user.is_active
+    assert table.loads == [1]
+
+
+async def test_db_strategy_rejects_deleted_users(user_cache):
+    strategy = CachedJWTStrategy(secret='secret', lifetime_seconds=3600, trust_claims=False)
+    token = await issue_token(strategy)
+
+    assert await strategy.read_token(token, UserTable({})) is None
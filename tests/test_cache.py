@@ -0,0 +1,138 @@
+import pytest
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+from cache import CatalogCache
+
+
+def make_request(etag: str = None) -> Request:
+    headers = [(b'if-none-match', etag.encode())] if etag else []
+    return Request({'type': 'http', 'method': 'GET', 'path': '/', 'headers': headers})
+
+
+@pytest.fixture
+def cache(redis):
+    cache = CatalogCache(prefix='test')
+    cache.init(redis)
+    return cache
+
+
+@pytest.fixture
+def route(cache):
+    calls = []
+
+    @cache.cached(tags=lambda product_id, **_: [f'product:{product_id}'])
+    async def get_product(product_id: int):
+        calls.append(product_id)
+        return JSONResponse({'id': product_id, 'calls': len(calls)})
+
+    get_product.calls = calls
+    return get_product
+
+
+async def test_miss_runs_the_route_and_stores_the_body(route):
+    response = await route(product_id=1, request=make_request())
+    cached = await route(product_id=1, request=make_request())
+
+    assert response.status_code == 200
+    assert route.calls == [1]
+    assert cached.body == response.body
+
+
+async def test_responses_carry_a_weak_etag_that_stays_while_cached(route):
+    response = await route(product_id=1, request=make_request())
+    cached = await route(product_id=1, request=make_request())
+
+    assert response.headers['etag'].startswith('W/"')
+    assert cached.headers['etag'] == response.headers['etag']
+
+
+async def test_matching_etag_of_a_cached_body_is_answered_with_304(route):
+    etag = (await route(product_id=1, request=make_request())).headers['etag']
+
+    response = await route(product_id=1, request=make_request(etag))
+
+    assert response.status_code == 304
+    assert response.headers['etag'] == etag
+    assert route.calls == [1]
+
+
+async def test_matching_etag_on_a_miss_is_answered_with_304(cache, redis):
+    @cache.cached(tags=lambda **_: ['product:list'])
+    async def get_list():
+        return JSONResponse({'items': []})
+
+    etag = (await get_list(request=make_request())).headers['etag']
+    # The entry expired, the rebuilt body is the same
+    await redis.delete(*await redis.keys('test:test_cache.*'))
+
+    response = await get_list(request=make_request(etag))
+
+    assert response.status_code == 304
+    assert response.headers['etag'] == etag
+    assert await redis.keys('test:test_cache.*')
+
+
+async def test_other_etags_get_the_full_body(route):
+    await route(product_id=1, request=make_request())
+
+    response = await route(product_id=1, request=make_request('W/"outdated", "other"'))
+
+    assert response.status_code == 200
+    assert response.body
+
+
+async def test_invalidate_changes_the_etag(cache, route):
+    etag = (await route(product_id=1, request=make_request())).headers['etag']
+
+    await cache.invalidate('product:1')
+    response = await route(product_id=1, request=make_request(etag))
+
+    assert response.status_code == 200
+    assert response.headers['etag'] != etag
+
+
+async def test_invalidate_purges_only_the_tagged_responses(cache, route):
+    await route(product_id=1, request=make_request())
+    await route(product_id=2, request=make_request())
+
+    await cache.invalidate('product:1')
+    await route(product_id=1, request=make_request())
+    await route(product_id=2, request=make_request())
+
+    assert route.calls == [1, 2, 1]
+
+
+async def test_response_built_while_its_tag_was_invalidated_is_not_stored(cache, redis):
+    @cache.cached(tags=lambda **_: ['category:list'])
+    async def get_categories():
+        await cache.invalidate('category:list')
+        return JSONResponse({'categories': []})
+
+    response = await get_categories(request=make_request())
+
+    assert response.status_code == 200
+    assert not await redis.keys('test:test_cache.*')
+
+
+async def test_errors_are_not_cached(cache, redis):
+    @cache.cached(tags=lambda **_: ['product:list'])
+    async def get_failing():
+        return JSONResponse({'status': 'error'}, status_code=500)
+
+    response = await get_failing(request=make_request())
+
+    assert response.status_code == 500
+    assert 'etag' not in response.headers
+    assert not await redis.keys('test:test_cache.*')
+
+
+async def test_version_is_seeded_by_lookups_and_moves_on_invalidate(cache, route):
+    assert await cache.version('product:1') is None
+
+    await route(product_id=1, request=make_request())
+    version = await cache.version('product:1')
+    await cache.invalidate('product:1')
+
+    assert version is not None
+    assert int(await cache.version('product:1')) == int(version) + 1
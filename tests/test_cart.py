@@ -0,0 +1,194 @@
+import pytest
+from sqlalchemy import select
+
+from auth.models import User
+from shop.cart import models as md
+from shop.cart import service
+from shop.cart.service import LOADED_FIELD, CartStore
+from shop.products.models import Product
+
+
+class CartTable:
+    '''
+    Stands in for the session CartStore reads a cart from the cart table with.
+    carts: {user_id: {product_id: amount}}
+    '''
+
+    def __init__(self, carts: dict):
+        self.carts = carts
+        self.loads = []
+
+    def __call__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def execute(self, query):
+        user_id, = query.compile().params.values()
+        self.loads.append(user_id)
+        return self
+
+    def all(self):
+        return list(self.carts.get(self.loads[-1], {}).items())
+
+
+@pytest.fixture
+def table(monkeypatch):
+    table = CartTable({1: {10: 2, 11: 1}})
+    monkeypatch.setattr(service, 'async_session_maker', table)
+    return table
+
+
+@pytest.fixture
+def store(redis):
+    store = CartStore(prefix='test-cart', ttl=600, max_amount=100)
+    store.init(redis)
+    return store
+
+
+async def test_first_access_loads_the_cart_from_the_table(store, table, redis):
+    assert await store.get(1) == {10: 2, 11: 1}
+    assert await store.get(1) == {10: 2, 11: 1}
+
+    assert table.loads == [1]
+    assert await redis.hget('test-cart:1', LOADED_FIELD) == '1'
+    assert 0 < await redis.ttl('test-cart:1') <= 600
+
+
+async def test_add_changes_the_loaded_cart_and_marks_it_dirty(store, table, redis):
+    assert await store.add(1, 10, 3) == 5
+    assert await store.add(1, 12, 1) == 1
+
+    assert await store.get(1) == {10: 5, 11: 1, 12: 1}
+    assert table.loads == [1]
+    assert await redis.smembers('test-cart:dirty') == {'1'}
+    assert 0 < await redis.ttl('test-cart:1') <= 600
+
+
+async def test_add_caps_the_amount_and_drops_products_reaching_zero(store, table):
+    assert await store.add(1, 10, 1000) == 100
+    assert await store.add(1, 11, -5) == 0
+
+    assert await store.get(1) == {10: 100}
+
+
+async def test_set_replaces_or_removes_an_amount(store, table):
+    await store.set(1, 10, 7)
+    await store.set(1, 11, 0)
+
+    assert await store.get(1) == {10: 7}
+
+
+async def test_write_to_an_expired_cart_reloads_it_first(store, table, redis):
+    await store.get(1)
+    await redis.delete('test-cart:1')
+
+    assert await store.add(1, 10, 1) == 3
+
+    assert table.loads == [1, 1]
+    assert await store.get(1) == {10: 3, 11: 1}
+
+
+@pytest.mark.parametrize('write', [
+    lambda store: store.add(1, 10, 1),
+    lambda store: store.set(1, 10, 3),
+])
+async def test_write_never_leaves_a_partial_hash_without_ttl(store, table, redis, write):
+    # What an increment after the hash expired used to create: one line, no TTL, no marker
+    await redis.hset('test-cart:1', 10, 1)
+
+    await write(store)
+
+    assert await redis.hget('test-cart:1', LOADED_FIELD) == '1'
+    assert await redis.hget('test-cart:1', 11) == '1'
+    assert 0 < await redis.ttl('test-cart:1') <= 600
+
+
+async def test_cleared_cart_stays_empty_without_reloading(store, table):
+    await store.get(1)
+    await store.clear(1)
+
+    assert await store.get(1) == {}
+    assert table.loads == [1]
+
+
+async def test_failed_flush_keeps_the_carts_dirty(store, table, redis, monkeypatch):
+    await store.add(1, 10, 1)
+
+    def unreachable():
+        raise OSError('connection refused')
+
+    monkeypatch.setattr(service, 'async_session_maker', unreachable)
+
+    with pytest.raises(OSError):
+        await store.flush()
+    assert await redis.smembers('test-cart:dirty') == {'1'}
+
+
+# Write-behind to the cart table, needs TEST_DATABASE_URL
+
+
+@pytest.fixture
+async def shop(session):
+    session.add_all([
+        User(id=1, email='buyer@example.com', hashed_password='-'),
+        Product(id=10, name='Liquid', articul='L-10', price=5),
+        Product(id=11, name='Coil', articul='C-11', price=2),
+    ])
+    await session.commit()
+
+
+async def cart_rows(session, user_id: int) -> dict:
+    result = await session.execute(select(md.Cart.product_id, md.Cart.amount).where(md.Cart.user_id == user_id))
+    return dict(result.all())
+
+
+async def test_flush_writes_dirty_carts_to_the_table(store, redis, session_maker, session, shop, monkeypatch):
+    monkeypatch.setattr(service, 'async_session_maker', session_maker)
+    await store.add(1, 10, 2)
+    await store.add(1, 11, 1)
+
+    assert await store.flush() == 1
+    assert await cart_rows(session, 1) == {10: 2, 11: 1}
+    assert not await redis.scard('test-cart:dirty')
+
+    await store.set(1, 10, 0)
+    await store.flush()
+    assert await cart_rows(session, 1) == {11: 1}
+
+
+async def test_cart_is_reloaded_from_the_table_after_expiring(store, redis, session_maker, shop, monkeypatch):
+    monkeypatch.setattr(service, 'async_session_maker', session_maker)
+    await store.add(1, 10, 4)
+    await store.flush()
+    await redis.delete('test-cart:1')
+
+    assert await store.add(1, 11, 1) == 1
+    assert await store.get(1) == {10: 4, 11: 1}
+
+
+async def test_flush_drops_deleted_products_without_failing_the_batch(
+        store, redis, session_maker, session, shop, monkeypatch):
+    monkeypatch.setattr(service, 'async_session_maker', session_maker)
+    await store.add(1, 10, 1)
+    await store.add(1, 99, 1)
+
+    assert await store.flush() == 1
+    assert await cart_rows(session, 1) == {10: 1}
+
+
+async def test_flush_skips_carts_that_expired_before_flushing(
+        store, redis, session_maker, session, shop, monkeypatch):
+    monkeypatch.setattr(service, 'async_session_maker', session_maker)
+    await store.add(1, 10, 1)
+    await store.flush()
+    await store.add(1, 10, 1)
+    await redis.delete('test-cart:1')
+
+    assert await store.flush() == 0
+    assert await cart_rows(session, 1) == {10: 1}
+    assert not await redis.scard('test-cart:dirty')
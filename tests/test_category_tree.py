@@ -0,0 +1,163 @@
+import pytest
+from fastapi import FastAPI
+from httpx import AsyncClient
+from sqlalchemy import select
+
+from database import get_async_session
+from shop.products import models as md
+from shop.products.router import router
+from shop.products.utils import CategoryTreeCache, add_category_to_tree, move_category_in_tree
+
+
+class ClosureTable:
+    '''
+    Stands in for the session CategoryTreeCache reads the closure table with.
+    '''
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+        self.loads = 0
+
+    async def execute(self, query):
+        self.loads += 1
+        return list(self.pairs)
+
+
+class Versions:
+    def __init__(self, version=None):
+        self.current = version
+
+    async def __call__(self):
+        return self.current
+
+
+async def test_tree_is_reused_while_the_version_stays():
+    table = ClosureTable([(1, 1), (1, 2), (2, 2)])
+    tree = CategoryTreeCache(ttl=0, version=Versions('5'))
+
+    assert sorted(await tree.get_subtree(table, 1)) == [1, 2]
+    assert await tree.get_subtree(table, 2) == [2]
+    # Unknown ids do not reload either, a new category would have moved the version
+    assert await tree.get_subtree(table, 3) == []
+    assert table.loads == 1
+
+
+async def test_tree_is_reloaded_once_the_version_moves():
+    table = ClosureTable([(1, 1)])
+    versions = Versions('5')
+    tree = CategoryTreeCache(ttl=3600, version=versions)
+    await tree.get_subtree(table, 1)
+
+    # Another worker moved category 2 under 1 and bumped the version
+    table.pairs = [(1, 1), (1, 2), (2, 2)]
+    versions.current = '6'
+
+    assert sorted(await tree.get_subtree(table, 1)) == [1, 2]
+    assert table.loads == 2
+
+
+async def test_tree_without_version_is_trusted_for_the_ttl():
+    table = ClosureTable([(1, 1)])
+    tree = CategoryTreeCache(ttl=3600, version=Versions(None))
+
+    await tree.get_subtree(table, 1)
+    await tree.get_subtree(table, 1)
+    assert table.loads == 1
+
+    tree.invalidate()
+    await tree.get_subtree(table, 1)
+    assert table.loads == 2
+
+
+# Closure table maintenance, needs TEST_DATABASE_URL
+
+
+async def add_category(session, id: int, parent_id=None) -> md.Category:
+    category = md.Category(id=id, name=f'Category {id}', parent_id=parent_id)
+    session.add(category)
+    await session.flush()
+    await add_category_to_tree(category, session)
+    return category
+
+
+async def closure(session) -> set:
+    result = await session.execute(select(
+        md.CategoryClosure.ancestor_id, md.CategoryClosure.descendant_id, md.CategoryClosure.depth))
+    return set(result.all())
+
+
+@pytest.fixture
+async def tree(session):
+    '''
+    1 ── 2 ── 3
+    4
+    '''
+    categories = {}
+    for id, parent_id in ((1, None), (2, 1), (3, 2), (4, None)):
+        categories[id] = await add_category(session, id, parent_id)
+    await session.commit()
+    return categories
+
+
+async def test_insert_links_a_category_with_itself_and_every_ancestor(session, tree):
+    assert await closure(session) == {
+        (1, 1, 0), (1, 2, 1), (1, 3, 2),
+        (2, 2, 0), (2, 3, 1),
+        (3, 3, 0),
+        (4, 4, 0),
+    }
+
+
+async def test_move_reattaches_the_whole_subtree(session, tree):
+    await move_category_in_tree(tree[2], 4, session)
+    await session.commit()
+
+    assert await closure(session) == {
+        (1, 1, 0),
+        (4, 4, 0), (4, 2, 1), (4, 3, 2),
+        (2, 2, 0), (2, 3, 1),
+        (3, 3, 0),
+    }
+    assert tree[2].parent_id == 4
+
+
+async def test_move_to_the_root(session, tree):
+    await move_category_in_tree(tree[3], None, session)
+    await session.commit()
+
+    assert {row for row in await closure(session) if 3 in row[:2]} == {(3, 3, 0)}
+    assert tree[3].parent_id is None
+
+
+@pytest.mark.parametrize('category_id, parent_id', [(1, 3), (1, 2), (2, 2)])
+async def test_move_into_its_own_subtree_is_rejected(session, tree, category_id, parent_id):
+    before = await closure(session)
+
+    with pytest.raises(ValueError, match='own subtree'):
+        await move_category_in_tree(tree[category_id], parent_id, session)
+    await session.rollback()
+
+    assert await closure(session) == before
+
+
+async def test_move_under_a_missing_parent_is_rejected(session, tree):
+    with pytest.raises(ValueError, match='does not exist'):
+        await move_category_in_tree(tree[2], 99, session)
+
+
+async def test_update_category_moves_it_and_answers_with_the_category(session_maker, session, tree):
+    app = FastAPI()
+    app.include_router(router)
+
+    async def get_test_session():
+        async with session_maker() as route_session:
+            yield route_session
+
+    app.dependency_overrides[get_async_session] = get_test_session
+    async with AsyncClient(app=app, base_url='http://test') as client:
+        response = await client.patch('/category/update/2', json={'parent_id': 4, 'name': 'Moved'})
+
+    assert response.status_code == 200
+    assert response.json()['result'] == {
+        'id': 2, 'name': 'Moved', 'discount': None, 'is_active': True, 'parent_id': 4, 'photo_url': None}
+    assert (4, 3, 2) in await closure(session)
@@ -0,0 +1,110 @@
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+from pagination import apply_keyset, decode_cursor, encode_cursor, parse_int, split_page
+from shop.products import models as md
+
+
+def compile_query(query) -> str:
+    return str(query.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+
+
+@pytest.mark.parametrize('values, parsers', [
+    ([42], (parse_int,)),
+    ([Decimal('19.90'), 7], (Decimal, parse_int)),
+    ([datetime(2026, 10, 18, 12, 30, 5, 123456), 3], (datetime.fromisoformat, parse_int)),
+])
+def test_cursor_round_trip(values, parsers):
+    cursor = encode_cursor(values)
+
+    assert '=' not in cursor
+    assert decode_cursor(cursor, len(values), parsers) == values
+
+
+@pytest.mark.parametrize('cursor', [
+    'not base64!',
+    encode_cursor([1, 2]),  # one value too many
+    encode_cursor(['abc']),
+    encode_cursor([True]),
+    encode_cursor([2 ** 63]),
+    encode_cursor([1.5]),
+])
+def test_decode_cursor_rejects_invalid_cursors(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor, 1, (parse_int,))
+
+    assert error.value.status_code == 400
+
+
+def test_decode_cursor_rejects_values_the_parser_cannot_read():
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(encode_cursor(['12.x', 1]), 2, (Decimal, parse_int))
+
+    assert error.value.status_code == 400
+
+
+def test_apply_keyset_without_cursor_orders_by_every_key():
+    query = apply_keyset(select(md.Product.id), (md.Product.price, md.Product.id), None, 25)
+    sql = compile_query(query)
+
+    assert 'WHERE' not in sql
+    assert 'ORDER BY product.price, product.id' in sql
+    assert 'LIMIT 26' in sql
+
+
+def test_apply_keyset_compares_the_whole_key_so_ties_are_broken_by_id():
+    cursor = encode_cursor([Decimal('10.00'), 5])
+    query = apply_keyset(select(md.Product.id), (md.Product.price, md.Product.id), cursor, 10,
+                         parsers=(Decimal, parse_int))
+    sql = compile_query(query)
+
+    assert '(product.price, product.id) > (10.00, 5)' in sql
+    assert 'ORDER BY product.price, product.id' in sql
+
+
+def test_apply_keyset_descending():
+    cursor = encode_cursor(['2026-10-18T12:00:00', 9])
+    query = apply_keyset(select(md.Review.id), (md.Review.created_at, md.Review.id), cursor, 10,
+                         descending=True, parsers=(datetime.fromisoformat, parse_int))
+    sql = compile_query(query)
+
+    assert '(review.created_at, review.id) < (' in sql
+    assert 'ORDER BY review.created_at DESC, review.id DESC' in sql
+
+
+def test_split_page_without_look_ahead_row_has_no_next_cursor():
+    items, cursor = split_page([1, 2, 3], 3, key=lambda item: [item])
+
+    assert items == [1, 2, 3]
+    assert cursor is None
+
+
+def test_split_page_continues_after_the_last_row_of_the_page():
+    # (price, id) rows, two products share a price across the page boundary
+    rows = [(Decimal('5.00'), 1), (Decimal('7.50'), 2), (Decimal('7.50'), 3)]
+    items, cursor = split_page(rows, 2, key=lambda row: list(row))
+
+    assert items == rows[:2]
+    assert decode_cursor(cursor, 2, (Decimal, parse_int)) == [Decimal('7.50'), 2]
+
+
+def test_pages_of_tied_keys_neither_skip_nor_repeat_rows():
+    rows = sorted([(Decimal(price), id) for id, price in enumerate(
+        ['3.00', '1.00', '3.00', '3.00', '2.00', '1.00', '3.00'], start=1)])
+    seen = []
+    cursor = None
+    while True:
+        after = decode_cursor(cursor, 2, (Decimal, parse_int)) if cursor else None
+        # What the keyset condition and LIMIT limit + 1 select from the ordered rows
+        page = [row for row in rows if after is None or row > tuple(after)][:3]
+        items, cursor = split_page(page, 2, key=lambda row: list(row))
+        seen += items
+        if cursor is None:
+            break
+
+    assert seen == rows